@@ -1,88 +1,73 @@
 import datetime
+import gzip
+import io
 import json
 import os
-import subprocess
+import shutil
+import sys
 import threading
-import multiprocessing
 import time
-import sys
 
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
 
-import yt_dlp
 import requests
 
-from flask import Flask, render_template, request, send_from_directory
-from flask_socketio import SocketIO
-from itu_p1203 import extractor, P1203Standalone
+from flask import Flask, abort, render_template, request, send_from_directory
+from flask_socketio import SocketIO, emit, join_room
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import dash_downloader
+import database
+import event_store
+import instrumentation
+import job_queue
+import mos_cache
+import mos_pool
+import qp_cache
+import qp_extraction
+import session_input
+import swarm_telemetry
+import timeline
+from scheduler import Scheduler
 
 
 # Functions
 
-def read_db():
-    db_path = os.path.join("video_db", "video_db.json")
-    for _ in range(10):
-        try:
-            with open(db_path, 'r') as file_db:
-                return json.loads(file_db.read())
-        except Exception:
-            time.sleep(3)
-    raise RuntimeError(f"Could not read database from {db_path} after 10 retries.")
-
-def write_db(db_data):
-    with open(os.path.join("video_db", "video_db.json"), 'w') as file_db:
-        file_db.write(json.dumps(db_data, indent=2))
-
-def get_video_id():
-    return len(read_db()["videos"])
-
-def get_metrics_id():
-    return len(read_db()["metrics"])
-
 def is_downloaded(id):
-    isAlreadyDownloaded = False
-    for video in read_db()["videos"]:
-        if video["id"] == id and video["downloaded"]: isAlreadyDownloaded = True
-    return isAlreadyDownloaded
+    video = database.get_video(id)
+    return video is not None and video["downloaded"]
 
 def is_extracted(id):
-    isAlreadyExtracted = False
-    for video in read_db()["videos"]:
-        if video["id"] == id and video["qp_extracted"]: isAlreadyExtracted = True
-    return isAlreadyExtracted
+    video = database.get_video(id)
+    return video is not None and video["qp_extracted"]
+
+def is_rendition_extracted(id, name):
+    if is_extracted(id):
+        return True
+    rendition = database.get_rendition(id, name)
+    return rendition is not None and rendition["qp_extracted"]
 
 def is_result_ready(id):
-    isReady = False
-    for metric in read_db()["metrics"]:
-        if metric["id"] == id and metric["result_obtained"]: isReady = True
-    return isReady
+    metric = database.get_metric(id)
+    return metric is not None and metric["result_obtained"]
 
 def is_input_built(id):
-    isAlreadyBuilt = False
-    for metric in read_db()["metrics"]:
-        if metric["id"] == id and metric["json_prepared"]: isAlreadyBuilt = True
-    return isAlreadyBuilt
+    metric = database.get_metric(id)
+    return metric is not None and metric["json_prepared"]
 
 def set_processing(id):
-    db = read_db()
-    for metric in db["metrics"]:
-        if metric["id"] == id: metric["processing"] = True
-    write_db(db)
+    database.update_metric(id, processing=True)
 
 def unset_processing(id):
-    db = read_db()
-    for metric in db["metrics"]:
-        if metric["id"] == id: metric["processing"] = False
-    write_db(db)
-
-def is_cpu_free():
-    for metric in read_db()["metrics"]:
-        if metric["processing"]: return False
-    return True
+    database.update_metric(id, processing=False)
 
 def get_mos_result(id):
-    for metric in read_db()["metrics"]:
-        if metric["id"] == id: return metric["result"]
+    metric = database.get_metric(id)
+    if metric is not None: return metric["result"]
 
     return 0
 
@@ -97,320 +82,336 @@ def get_videos_from_folder(dir):
     return video_paths
 
 def get_id_from_mpd(mpd):
-    for video in read_db()["videos"]:
-        if video["mpd_url"] == mpd:
-            return video["id"]
-    return None
+    # Any URL of the MPD (mirror, signed URL...) leads to the same video. Videos registered
+    # before URLs were normalized are also found by their exact URL.
+    id = database.get_video_id_by_url(dash_downloader.normalize_url(mpd))
+    if id is None:
+        id = database.get_video_id_by_url(mpd)
+    return id
 
 def get_video_from_id(id):
-    db = read_db()
-    for video in db["videos"]:
-        if video["id"] == id:
-            return video
-    return None
+    return database.get_video(id)
+
+def save_metric_events(id, metrics):
+    event_store.save_events(id, metrics)
+
+def get_request_json():
+    # JSON body of the request, which may be compressed with gzip or zstd (Content-Encoding header)
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    body = request.get_data()
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "zstd" and zstandard is not None:
+        body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read()
+    elif encoding != "identity":
+        abort(415, f"Unsupported Content-Encoding: {encoding}")
+    return json.loads(body)
 
 def get_metric_from_id(id):
-    with open(os.path.join("video_db","metrics",str(id),f"{str(id)}-metric.json"), 'r') as file:
-        return json.loads(file.read())
-
-def get_json_from_file(path, file):
-    with open(os.path.join(path,file), 'r') as json_file:
-        return json.loads(json_file.read())
-
-def run_command(command):
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    for line in process.stdout:
-        print(line, end='')
-    process.wait()
-    if process.returncode != 0:
-        print(f"Error executing: {command}", file=sys.stderr)
-        sys.exit(1)
-
-import xml.etree.ElementTree as ET
-
-def parse_mpd(mpd_file):
-    tree = ET.parse(mpd_file)
-    root = tree.getroot()
-
-    # Namespace
-    ns = {'mpd': root.tag.split('}')[0].strip('{')}
-
-    video_representations = []
-
-    # Check for mimeType in AdaptationSet
-    for adaptation_set in root.findall(".//mpd:AdaptationSet", ns):        
-        as_mimetype = adaptation_set.get("mimeType")
-
-        for representation in adaptation_set.findall("mpd:Representation", ns):
-            rep_mimetype = representation.get("mimeType")
-            mimetype = rep_mimetype or as_mimetype
-
-            if mimetype == "video/mp4":
-                rep_id = representation.get("id")
-                bandwidth = int(representation.get("bandwidth"))
-                video_representations.append((rep_id, bandwidth))
-
-    video_representations.sort(key=lambda x: x[1], reverse=True)
-
-    return [rep[0] for rep in video_representations]
-
-
-def rename_with_convention(id, ordered_IDs):
-    print("Ordered_IDs: ", ordered_IDs)
+    return event_store.load_events(id)
+
+def link_path(source, destination):
+    # Hard links the files of source (a file or a folder) into destination, copying them if
+    # the file system does not support links. Files shared by several videos are then only
+    # freed when the last video that uses them is deleted.
+    def link_file(source_file, destination_file):
+        if os.path.exists(destination_file):
+            os.remove(destination_file)
+        try:
+            os.link(source_file, destination_file)
+        except OSError:
+            shutil.copy2(source_file, destination_file)
+
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, copy_function=link_file, dirs_exist_ok=True)
+    elif os.path.exists(source):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        link_file(source, destination)
+
+def is_same_rendition(rendition, content_key):
+    # Checks the segment files of a stored rendition against a content key before sharing them
+    video = database.get_video(rendition["video_id"])
+    rep_id = next((rep_id for rep_id, name in video["bitrates"].items() if name == rendition["name"]), None) if video else None
+    if rep_id is None:
+        return False
+    directory = os.path.join("video_db", "videos", str(video["id"]))
+    representations = dash_downloader.get_representations(os.path.join(directory, f"{video['id']}.mpd"), video["mpd_url"])
+    representation = next((rep for rep in representations if rep["id"] == rep_id), None)
+    if representation is None:
+        return False
+    probe = dash_downloader.read_probe(directory, rendition["name"], representation)
+    return probe is not None and dash_downloader.rendition_key(representation, video["mpd_url"], probe) == content_key
+
+def share_rendition(id, name, content_key):
+    # Takes the files of an identical rendition of another video instead of downloading and
+    # extracting it again. Returns the rendition that was shared, or None if there is none.
+    source = database.find_rendition_by_content(content_key, id)
+    if source is None or not is_same_rendition(source, content_key):
+        return None
+    source_directory = os.path.join("video_db", "videos", str(source["video_id"]))
     directory = os.path.join("video_db", "videos", str(id))
+    print(f"Sharing rendition {source['name']} of video {source['video_id']} as {name}")
 
-    db = read_db()
-
-    video_data = {}
-    temp_extractor = extractor.Extractor([], 0)
+    link_path(os.path.join(source_directory, f"{source['name']}.mp4"), os.path.join(directory, f"{name}.mp4"))
+    link_path(os.path.join(source_directory, "segments", source["name"]), os.path.join(directory, "segments", name))
+    if source["qp_extracted"]:
+        link_path(os.path.join(source_directory, "extracted_qp", source["name"]), os.path.join(directory, "extracted_qp", name))
+        link_path(os.path.join(source_directory, "extracted_qp", f"{source['name']}.json"), os.path.join(directory, "extracted_qp", f"{name}.json"))
 
-    for filename in os.listdir(directory):
-        file_ext = os.path.splitext(filename)[1].lower()[1:]
-        valid_video_exts = ["avi", "mp4", "mkv", "nut", "mpeg", "mpg", "ts"]
-        if file_ext in valid_video_exts:
-            filepath = os.path.join(directory, filename)
-            bitrate_filepath = temp_extractor.get_format_info(filepath)["bit_rate"]
-            video_data[filename] = bitrate_filepath
-
-    sorted_video_data = dict(sorted(video_data.items(), key=lambda item: item[1], reverse=True))
-
-    for idx, (filename, br) in enumerate(sorted_video_data.items(), start=1):
-        file_extension = os.path.splitext(filename)[1]
-        new_filename = f"{id}-{idx}{file_extension}"
-        old_path = os.path.join(directory, filename)
-        new_path = os.path.join(directory, new_filename)
-
-        # Save bitrate to DB
-        db["videos"][id]["bitrates"][ordered_IDs[idx-1]] = f"{id}-{idx}"
-
-        # Rename file
-        try:
-            os.rename(old_path, new_path)
-        except Exception as e:
-            print(f"Error renaming {filename}: {e}")
-            exit(1)
-
-    write_db(db)
-
-    return
+    database.update_rendition(id, name, downloaded=True, qp_extracted=source["qp_extracted"], content_key=content_key)
+    return source
 
+def remove_video_files(id):
+    qp_cache.invalidate(id)
+    mos_cache.invalidate(id)
+    shutil.rmtree(os.path.join("video_db", "videos", str(id)), ignore_errors=True)
 
 
 # Background functions
 
-def download_video(mpd, id, mpd_response):
+def save_mpd(id, mpd_response):
+    output_path = os.path.join("video_db", "videos", str(id))
+    os.makedirs(output_path, exist_ok=True)
+    mpd_path = os.path.join(output_path, f"{id}.mpd")
+    with open(mpd_path, "wb") as f:
+        f.write(mpd_response.content)
+        print(f"Downloaded MPD: {mpd_path}")
+
+def download_video(mpd, id, mpd_response=None):
+    # Without mpd_response, the MPD has already been saved (by the API node in queue mode)
     if not is_downloaded(id):
         print("Downloading video from MPD:", mpd)
         output_path = os.path.join("video_db", "videos", str(id))
-        os.makedirs(output_path, exist_ok=True)
-
-        # Save MPD
         mpd_path = os.path.join(output_path, f"{id}.mpd")
-        with open(mpd_path, "wb") as f:
-            f.write(mpd_response.content)
-            print(f"Downloaded MPD: {mpd_path}")
-
-        # Download all video/audio segments
-        ydl_opts = {
-            'outtmpl': os.path.join(output_path, '%(format_id)s.%(ext)s'),
-            'format': 'all',
-            'merge_output_format': 'mp4',
-            'concurrent_fragments': 5
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([mpd])
 
-        ordered_video_IDs = parse_mpd(mpd_path)
-        rename_with_convention(id, ordered_video_IDs)
-
-        db = read_db()
-        for video in db["videos"]:
-            if video["id"] == id: video["downloaded"] = True
-        write_db(db)
+        # Save MPD
+        if mpd_response is not None:
+            save_mpd(id, mpd_response)
+
+        # Download the segments of all video representations and merge them into <id>-<n>.mp4,
+        # numbered from the highest to the lowest bandwidth
+        representations = dash_downloader.get_representations(mpd_path, mpd)
+        bitrates = {rep["id"]: f"{id}-{idx}" for idx, rep in enumerate(representations, start=1)}
+        probes = dash_downloader.probe_representations(representations)
+        content_keys = {rep["id"]: dash_downloader.rendition_key(rep, mpd, probes[rep["id"]]) for rep in representations}
+        if LAZY_RENDITIONS:
+            # Only register the renditions, each one is fetched by the first session that watches it
+            for rep_id, name in bitrates.items():
+                database.update_rendition(id, name, content_key=content_keys[rep_id])
+            database.update_video(id, bitrates=bitrates)
+            return
+
+        # Renditions already downloaded by other videos are not downloaded again
+        missing = [rep for rep in representations if share_rendition(id, bitrates[rep["id"]], content_keys[rep["id"]]) is None]
+        dash_downloader.get_downloader().download(missing, output_path, bitrates)
+        for rep in missing:
+            database.update_rendition(id, bitrates[rep["id"]], downloaded=True, content_key=content_keys[rep["id"]])
+
+        database.update_video(id, bitrates=bitrates, downloaded=True)
 
     return
 
 
-def extract_qp_single_video(video_id, path):
-    command = f"python extract_info.py --mode 3 --accept-notice --cpu-count 1 --id {video_id} {path}"
-    run_command(command)
-    return
-
 def extract_qp(id):
     if not is_extracted(id):
         print("Starting QP extraction")
-        while not is_downloaded(id):
-            time.sleep(3)
+        if not is_downloaded(id):
+            raise RuntimeError(f"Video {id} has not been downloaded")
 
         directory = os.path.join("video_db", "videos", str(id))
         output_directory = os.path.join(directory, "extracted_qp")
         os.makedirs(output_directory, exist_ok=True)
 
-        threads_list = []
+        # Skip the renditions shared with other videos that were already extracted
+        videos = []
         for video in get_videos_from_folder(directory):
-            print(f"Extracting QP values from {video}")
-            t = multiprocessing.Process(target=extract_qp_single_video, args=(id, video))
-            t.start()
-            threads_list.append(t)
-            if len(threads_list) == 3:
-                for thread in threads_list:
-                    thread.join()
-                threads_list = []
-
-        for thread in threads_list:
-            thread.join()
+            rendition = database.get_rendition(id, os.path.splitext(os.path.basename(video))[0])
+            if rendition is None or not rendition["qp_extracted"]:
+                videos.append(video)
+        print(f"Extracting QP values from {videos}")
+        qp_cache.invalidate(id)
+        results = qp_extraction.extract_video(videos, output_directory)
+        qp_cache.invalidate(id)
+        mos_cache.invalidate(id)
+
+        failed = [result for result in results if not result["ok"]]
+        for result in failed:
+            print(f"Error extracting QP values from {result['file']}: {result['error']}", file=sys.stderr)
+        if failed:
+            raise RuntimeError(f"QP extraction failed for {len(failed)} of {len(results)} renditions of video {id}")
+        for video in videos:
+            database.update_rendition(id, os.path.splitext(os.path.basename(video))[0], qp_extracted=True)
 
         # Set qp_extracted to true in database
-        db = read_db()
-        for video in db["videos"]:
-            if video["id"] == id: video["qp_extracted"] = True
-        write_db(db)
+        database.update_video(id, qp_extracted=True)
 
 
-def build_input_json(metrics_id, mpd_id):
-    while not is_extracted(mpd_id) or not is_cpu_free():
-        time.sleep(3)
+def fetch_rendition(id, name):
+    # Lazy mode: download and extract a single rendition
+    if not is_rendition_extracted(id, name):
+        video = get_video_from_id(id)
+        rep_id = next(rep_id for rep_id, rep_name in video["bitrates"].items() if rep_name == name)
+        directory = os.path.join("video_db", "videos", str(id))
+        output_directory = os.path.join(directory, "extracted_qp")
+        os.makedirs(output_directory, exist_ok=True)
+
+        rendition = database.get_rendition(id, name)
+        if rendition is not None and not rendition["downloaded"] and rendition["content_key"] is not None:
+            shared = share_rendition(id, name, rendition["content_key"])
+            if shared is not None and shared["qp_extracted"]:
+                return
+            rendition = database.get_rendition(id, name)
+        if rendition is None or not rendition["downloaded"]:
+            print(f"Downloading rendition {name} of video {id}")
+            representations = dash_downloader.get_representations(os.path.join(directory, f"{id}.mpd"), video["mpd_url"])
+            representation = next(rep for rep in representations if rep["id"] == rep_id)
+            dash_downloader.get_downloader().download([representation], directory, {rep_id: name})
+            database.update_rendition(id, name, downloaded=True)
+
+        print(f"Extracting QP values from rendition {name} of video {id}")
+        result = qp_extraction.extract_video([os.path.join(directory, f"{name}.mp4")], output_directory)[0]
+        if not result["ok"]:
+            raise RuntimeError(f"QP extraction failed for rendition {name} of video {id}: {result['error']}")
+        database.update_rendition(id, name, qp_extracted=True)
+
+def require_renditions(id, names):
+    # Waits until the given renditions are extracted, fetching the missing ones. Sessions that
+    # need the same rendition at the same time share its job.
+    if QUEUE_MODE:
+        # Run the job here unless another worker already has it, so this never waits for a free worker
+        for name in sorted(set(names)):
+            if is_rendition_extracted(id, name):
+                continue
+            key = ("rendition", id, name)
+            job_queue.enqueue(key, "extract", "fetch_rendition", [id, name])
+            job = job_queue.claim(["extract"], job_queue.get_owner(), key=key)
+            succeeded = job_queue.run(job, JOB_FUNCTIONS) if job is not None else job_queue.wait(key)
+            if not succeeded:
+                raise RuntimeError(f"Rendition {name} of video {id} could not be fetched")
+        return
+
+    jobs = [
+        scheduler.submit(("rendition", id, name), "extract", fetch_rendition, id, name)
+        for name in sorted(set(names)) if not is_rendition_extracted(id, name)
+    ]
+    for job in jobs:
+        if not job.wait():
+            raise RuntimeError(f"Rendition {job.args[1]} of video {id} could not be fetched")
+
+
+def build_input_json(metrics_id, mpd_id, session=None):
+    if not LAZY_RENDITIONS and not is_extracted(mpd_id):
+        raise RuntimeError(f"QP values of video {mpd_id} have not been extracted")
 
     print("Starting input JSON build")
     # Build the JSON that will be the input of the MOS extraction algorithm and write it to a file
 
-    set_processing(metrics_id)
-
-    metrics = get_metric_from_id(metrics_id)
-
-    qp_path = os.path.join("video_db", "videos", str(mpd_id), "extracted_qp")
-
-    # Loop that gets stalls
-    stalls = [[0,0]]    # Adds an initial stall of 0s to avoid timestamp shift during MOS extraction.
-    stall_found = False
-    start_timestamp = 0
-    media_timestamp = 0
-    for metric_st in metrics:
-        if metric_st["type"] == "stall_ini":
-            media_timestamp = metric_st["media_time"]
-            start_timestamp = metric_st["clock_time"]
-            stall_found = True
-        elif stall_found and metric_st["type"] == "stall_end":
-            stall_found = False
-            end_timestamp = metric_st["clock_time"]
-            duration = (end_timestamp - start_timestamp) / 1000
-            if not media_timestamp == 0 and not start_timestamp == 0:
-                stalls.append([media_timestamp, duration])
+    if session is None:
+        stalls, quality_segments = timeline.get_timeline(event_store.load_columns(metrics_id))
+        prepared_segments = {}
+    else:
+        # Streamed session, its timeline and part of its I13 segments are already built
+        with session["lock"]:
+            stalls = list(session["timeline"].stalls)
+            quality_segments = list(session["timeline"].quality_segments)
+            prepared_segments = dict(session["i13_segments"])
 
     print(stalls)
-
-    # Loop that gets qualities
-    quality_changes = []
-    for metric_qp in metrics:
-        if metric_qp["type"] == "playback_started":
-            quality_changes.append([metric_qp["current_rep_id"], metric_qp["media_time"]])
-        elif metric_qp["type"] == "quality_change":
-            quality_changes.append([metric_qp["current_rep_id"], metric_qp["media_time"]])
-        elif metric_qp["type"] == "playback_ended":
-            quality_changes.append(["end", metric_qp["media_time"]])
-
-    quality_segments = []
-    for q_index, q_change in enumerate(quality_changes):
-        if q_index + 1 < len(quality_changes):
-            seg_ini = quality_changes[q_index][1]
-            seg_end = quality_changes[q_index + 1][1]
-            curr_rep_id = q_change[0]
-            quality_segments.append([curr_rep_id, seg_ini, seg_end])
-
     print(quality_segments) # [['video-avc1-2', 0, 0.187864], ['video-avc1-1', 0.187864, 734.166666]]
 
     # Obtain the relationship between representation and ID
     rep_id_rel = get_video_from_id(mpd_id)["bitrates"]
 
-    # Only load the needed QP values
-    needed_qp_values = {}
-    for quality_segment in quality_segments:
-        seg_rep = quality_segment[0]
-        if seg_rep not in needed_qp_values.keys():
-            needed_qp_values[seg_rep] = get_json_from_file(qp_path, f"{rep_id_rel[seg_rep]}.json")
-    print("Finished loading needed QP values. Loaded values:", list(needed_qp_values.keys()))
-
-    # START INPUT JSON BUILD
-
-    # 1st (most important): I13 - video info
-    segments_list_i13 = []
-    for segment in quality_segments:
-        segment_fps = needed_qp_values[segment[0]]["I13"]["segments"][0]["fps"]
-        built_segment = {
-            "codec": needed_qp_values[segment[0]]["I13"]["segments"][0]["codec"],
-            "start": segment[1],
-            "duration": segment[2] - segment[1],
-            "resolution": needed_qp_values[segment[0]]["I13"]["segments"][0]["resolution"],
-            "bitrate": needed_qp_values[segment[0]]["I13"]["segments"][0]["bitrate"],
-            "fps": segment_fps,
-            "frames": needed_qp_values[segment[0]]["I13"]["segments"][0]["frames"][round(segment[1]*segment_fps):round(segment[2]*segment_fps)]
-        }
-        segments_list_i13.append(built_segment)
-    i13 = {"streamId": 42, "segments": segments_list_i13}
-
-    print("Finished building I13 input parameter")
-
-    # 2nd: I11 - audio info
-    i11 = needed_qp_values[quality_segments[0][0]]["I11"]
-
-    # 2nd: I23 - stall info
-    i23 = {
-        "streamId": 42,
-        "stalling": stalls
-    }
-
-    # 3rd: IGen - player hardware info
-    iGen = needed_qp_values[quality_segments[0][0]]["IGen"]
-
-    json_input = {"I11": i11, "I13": i13, "I23": i23, "IGen": iGen}
+    # Sessions with the same segments and stalls on the same video have the same result
+    mos_key = mos_cache.session_key(
+        mpd_id,
+        [[rep_id_rel[segment[0]], segment[1], segment[2]] for segment in quality_segments],
+        stalls
+    )
+    cached_result = mos_cache.get(mos_key)
+    if cached_result is not None:
+        print("Found MOS result of an identical session")
+        instrumentation.trace(metrics_id, "mos_cache_hit")
+        save_mos_result(metrics_id, cached_result, json_prepared=True, mos_key=mos_key)
+        return
+
+    if LAZY_RENDITIONS:
+        require_renditions(mpd_id, [rep_id_rel[segment[0]] for segment in quality_segments])
+
+    json_input = session_input.build_input(mpd_id, rep_id_rel, stalls, quality_segments, prepared_segments)
+    print("Finished building input JSON")
 
     # Save JSON input file
 
     json_input_file_path = os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-input.json")
+    json_input_text = json.dumps(json_input)
     with open(json_input_file_path, 'w') as json_input_file:
-        json_input_file.write(json.dumps(json_input))
+        json_input_file.write(json_input_text)
+    instrumentation.json_bytes.inc(len(json_input_text), kind="input_written")
+    instrumentation.trace(metrics_id, "input_written", bytes=len(json_input_text), segments=len(quality_segments))
 
     # Set metric input JSON generated to true
-    db = read_db()
-    for metric in db["metrics"]:
-        if metric["id"] == metrics_id: metric["json_prepared"] = True
-    write_db(db)
+    database.update_metric(metrics_id, json_prepared=True, mos_key=mos_key)
+    notify_progress(metrics_id, "input_built")
 
     return
 
 
+def save_mos_result(metrics_id, result, **fields):
+    # Write result to file
+    result_text = json.dumps(result)
+    with open(os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-result.json"), 'w') as file_result:
+        file_result.write(result_text)
+    instrumentation.json_bytes.inc(len(result_text), kind="result_written")
+
+    # Set metric JSON output generated to true
+    mos_result = {
+        "O23": result["O23"],
+        "O35": result["O35"],
+        "O46": result["O46"]
+    }
+    database.update_metric(
+        metrics_id,
+        result_obtained=True,
+        processing=False,
+        result=mos_result,
+        **fields
+    )
+
+    notify_result(metrics_id, mos_result)
+    instrumentation.session_finished(
+        metrics_id, os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-trace.json")
+    )
+
+
 def extract_mos(metrics_id):
-    while not is_input_built(metrics_id):
-        time.sleep(3)
+    if is_result_ready(metrics_id):
+        # Result taken from the cache while building the input
+        return
+    if not is_input_built(metrics_id):
+        raise RuntimeError(f"Input JSON of metric {metrics_id} has not been built")
 
     print("Extracting MOS from media session")
 
-    # Extract the MOS from the input JSON
+    # Extract the MOS from the input JSON in the process pool. The processing flag only
+    # covers this session and is cleared even if the computation fails.
     json_input_file_path = os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-input.json")
 
-    with open(json_input_file_path, 'r') as file_input:
-        file_input = json.loads(file_input.read())
-
-    result = P1203Standalone(file_input).calculate_complete()
+    set_processing(metrics_id)
+    notify_progress(metrics_id, "computing")
+    try:
+        with p1203_seconds.time() as timer:
+            result = mos_pool.calculate_complete(json_input_file_path)
+        instrumentation.trace(metrics_id, "p1203", seconds=timer.elapsed)
+    except BaseException:
+        unset_processing(metrics_id)
+        raise
 
-    # Write result to file
-    with open(os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-result.json"), 'w') as file_result:
-        file_result.write(json.dumps(result))
+    save_mos_result(metrics_id, result)
 
-    # Set metric JSON output generated to true
-    db = read_db()
-    for metric in db["metrics"]:
-        if metric["id"] == metrics_id:
-            metric["result_obtained"] = True
-            metric["result"] = {
-                "O23": result["O23"],
-                "O35": result["O35"],
-                "O46": result["O46"]
-            }
-    write_db(db)
-
-    unset_processing(metrics_id)
+    metric = database.get_metric(metrics_id)
+    if metric["mos_key"] is not None:
+        mos_cache.put(metric["mos_key"], metric["mpd_url"], result)
 
     # Delete input file to free space
     os.remove(os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-input.json"))
@@ -418,27 +419,306 @@ def extract_mos(metrics_id):
     return
 
 
+# Result notifications
+
+# Clients join the room of their metric_id and get "progress" events with the stage of the
+# session (queued, input_built, computing) and a "result" event with the MOS values.
+# The latest results are also kept in memory so /result polls do not need the database.
+RECENT_RESULTS_SIZE = 10000
+recent_results = OrderedDict()
+recent_results_lock = threading.Lock()
+
+def metric_room(metrics_id):
+    return f"metric-{metrics_id}"
+
+def notify_progress(metrics_id, stage):
+    socketio.emit("progress", {"metric_id": metrics_id, "stage": stage}, to=metric_room(metrics_id))
+
+def notify_result(metrics_id, result):
+    with recent_results_lock:
+        recent_results[metrics_id] = result
+        if len(recent_results) > RECENT_RESULTS_SIZE:
+            recent_results.popitem(last=False)
+    socketio.emit("result", {"metric_id": metrics_id, "result": result}, to=metric_room(metrics_id))
+
+def get_recent_result(metrics_id):
+    with recent_results_lock:
+        return recent_results.get(metrics_id)
+
+
+# Instrumentation
+
+p1203_seconds = instrumentation.registry.histogram("qoe_p1203_seconds", "P.1203 computation time of a session")
+job_wait_seconds = instrumentation.registry.histogram(
+    "qoe_job_wait_seconds", "Time jobs waited for the jobs they depend on", ["stage"]
+)
+job_queue_seconds = instrumentation.registry.histogram(
+    "qoe_job_queue_seconds", "Time jobs waited for a free worker of their stage", ["stage"]
+)
+job_run_seconds = instrumentation.registry.histogram("qoe_job_run_seconds", "Run time of jobs", ["stage"])
+jobs_total = instrumentation.registry.counter("qoe_jobs_total", "Finished jobs", ["stage", "state"])
+
+def record_job(job):
+    # Called by the scheduler for every finished, failed or cancelled job
+    jobs_total.inc(stage=job.stage, state=job.state)
+    spans = {}
+    if job.queued_at is not None:
+        spans["wait"] = job.queued_at - job.created_at
+        job_wait_seconds.observe(spans["wait"], stage=job.stage)
+    if job.started_at is not None:
+        spans["queue"] = job.started_at - job.queued_at
+        spans["run"] = job.finished_at - job.started_at
+        job_queue_seconds.observe(spans["queue"], stage=job.stage)
+        job_run_seconds.observe(spans["run"], stage=job.stage)
+
+    if job.key[0] in ("input", "mos"):
+        instrumentation.trace(job.key[1], job.stage, state=job.state, **spans)
+        if job.state == "failed":
+            instrumentation.session_failed(job.key[1])
+
+def collect_status():
+    # Gauges of the /status information
+    jobs = [
+        ({"stage": stage, "state": state}, count)
+        for stage, counts in (job_queue.stats() if QUEUE_MODE else scheduler.stats()).items() for state, count in counts.items() if state != "workers"
+    ]
+    caches = [
+        ({"cache": name, "stat": stat}, value)
+        for name, stats in (("qp", qp_cache.stats()), ("mos", mos_cache.stats())) for stat, value in stats.items()
+    ]
+    return [
+        ("qoe_jobs", "Jobs of each stage by state", jobs),
+        ("qoe_cache", "Size, hits, misses and evictions of the caches", caches)
+    ]
+
+instrumentation.registry.add_collector(collect_status)
+
+
+# Job pipeline
+
+# In lazy mode, a new MPD is only registered. Each rendition is downloaded and extracted the
+# first time a session watches it, instead of the whole ladder up front.
+LAZY_RENDITIONS = os.environ.get("QOE_LAZY_RENDITIONS", "0") == "1"
+
+# In queue mode (QOE_JOB_QUEUE=sqlite), this process only serves HTTP and adds the jobs to the
+# jobs table. They are run by worker processes (worker.py) that may run on other machines
+# sharing video_db.
+QUEUE_MODE = os.environ.get("QOE_JOB_QUEUE", "") == "sqlite"
+QUEUE_POLL_SECONDS = float(os.environ.get("QOE_JOB_POLL_SECONDS", 0.5))
+
+# Functions the queued jobs refer to by name
+JOB_FUNCTIONS = {
+    "download_video": download_video,
+    "extract_qp": extract_qp,
+    "fetch_rendition": fetch_rendition,
+    "build_input_json": build_input_json,
+    "extract_mos": extract_mos
+}
+
+# Workers per stage. MOS jobs are admitted only while a process of the MOS pool is free,
+# the rest wait in the scheduler queue.
+scheduler = Scheduler({
+    "download": int(os.environ.get("QOE_DOWNLOAD_WORKERS", 2)),
+    "extract": int(os.environ.get("QOE_EXTRACT_WORKERS", 4)),
+    "input": int(os.environ.get("QOE_INPUT_WORKERS", 2)),
+    "mos": int(os.environ.get("QOE_MOS_WORKERS", mos_pool.POOL_SIZE))
+}, on_finish=record_job)
+
+def schedule_video(id, mpd, mpd_response):
+    # Download -> QP extraction (lazy mode: MPD registration only)
+    if QUEUE_MODE:
+        if mpd_response is not None:
+            save_mpd(id, mpd_response)
+        job_queue.enqueue(("download", id), "download", "download_video", [mpd, id])
+        if not LAZY_RENDITIONS:
+            job_queue.enqueue(("extract", id), "extract", "extract_qp", [id], deps=[("download", id)])
+        return
+
+    scheduler.submit(("download", id), "download", download_video, mpd, id, mpd_response)
+    if not LAZY_RENDITIONS:
+        scheduler.submit(("extract", id), "extract", extract_qp, id, deps=[("download", id)])
+
+def schedule_metric(metrics_id, mpd_id, session=None):
+    # QP extraction of the video + uploaded session -> input JSON build -> MOS extraction
+    instrumentation.session_started(metrics_id)
+    if QUEUE_MODE:
+        # Workers rebuild the timeline of streamed sessions from their saved events
+        job_queue.enqueue(("input", metrics_id), "input", "build_input_json", [metrics_id, mpd_id],
+                          deps=[("download", mpd_id), ("extract", mpd_id)])
+        job_queue.enqueue(("mos", metrics_id), "mos", "extract_mos", [metrics_id], deps=[("input", metrics_id)])
+        notify_progress(metrics_id, "queued")
+        return
+
+    scheduler.submit(("input", metrics_id), "input", build_input_json, metrics_id, mpd_id, session, deps=[("download", mpd_id), ("extract", mpd_id)])
+    scheduler.submit(("mos", metrics_id), "mos", extract_mos, metrics_id, deps=[("input", metrics_id)])
+    notify_progress(metrics_id, "queued")
+
+def is_job_pending(key):
+    if QUEUE_MODE:
+        job = job_queue.get(key)
+        return job is not None and job["state"] in (job_queue.QUEUED, job_queue.RUNNING)
+    return scheduler.get(key) is not None
+
+def watch_queue():
+    # Queue mode: the jobs finish in other processes, their progress and results are pushed from here
+    last_update = time.time()
+    while True:
+        time.sleep(QUEUE_POLL_SECONDS)
+        try:
+            jobs = job_queue.finished_since(last_update)
+        except Exception as e:
+            print(f"Error reading the job queue: {e}", file=sys.stderr)
+            continue
+        for job in jobs:
+            last_update = max(last_update, job["updated"])
+            if job["stage"] not in ("input", "mos"):
+                continue
+            metrics_id = job["key"][1]
+            if job["state"] == job_queue.FAILED:
+                instrumentation.session_failed(metrics_id)
+            elif job["stage"] == "input":
+                notify_progress(metrics_id, "input_built")
+            elif is_result_ready(metrics_id):
+                notify_result(metrics_id, get_mos_result(metrics_id))
+                instrumentation.session_finished(
+                    metrics_id, os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-trace.json")
+                )
+
+queue_watcher_started = False
+queue_watcher_lock = threading.Lock()
+
+def start_queue_watcher():
+    # Started with the first request, so worker processes that import this module never run it.
+    # A thread like the scheduler workers, the server (app.run) has no eventlet hub for green tasks.
+    global queue_watcher_started
+    with queue_watcher_lock:
+        if not queue_watcher_started:
+            queue_watcher_started = True
+            threading.Thread(target=watch_queue, name="queue-watcher", daemon=True).start()
+
+
+# Recovery
+
+# Work interrupted by the last stop of the server is scheduled again on startup. Only the
+# unfinished videos and sessions are read, through partial indexes, so startup takes the
+# same time however many finished sessions the database holds.
+RECOVER_JOBS = os.environ.get("QOE_RECOVER_JOBS", "1") == "1"
+
+def recover_jobs():
+    if QUEUE_MODE:
+        # Jobs of workers that stopped are queued again. Jobs that are still queued or running
+        # are left as they are, enqueuing them below does nothing.
+        requeued = job_queue.requeue_expired()
+        if requeued:
+            print(f"Queued again {requeued} jobs of stopped workers")
+
+    videos = 0
+    for video in database.get_incomplete_videos():
+        id = video["id"]
+        if not os.path.exists(os.path.join("video_db", "videos", str(id), f"{id}.mpd")):
+            continue
+        if LAZY_RENDITIONS and video["bitrates"]:
+            # Registered, its renditions are fetched by the sessions that need them
+            continue
+        schedule_video(id, video["mpd_url"], None)
+        videos += 1
+
+    sessions = 0
+    for metric in database.get_incomplete_metrics():
+        metrics_id = metric["id"]
+        if metric["mpd_url"] is None or not event_store.has_events(metrics_id):
+            # Streamed session that never ended, its events were only in memory
+            continue
+        input_path = os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-input.json")
+        if metric["json_prepared"] and os.path.exists(input_path):
+            instrumentation.session_started(metrics_id)
+            if QUEUE_MODE:
+                job_queue.enqueue(("mos", metrics_id), "mos", "extract_mos", [metrics_id])
+            else:
+                scheduler.submit(("mos", metrics_id), "mos", extract_mos, metrics_id)
+        else:
+            schedule_metric(metrics_id, metric["mpd_url"])
+        sessions += 1
+
+    if videos or sessions:
+        print(f"Recovered {videos} videos and {sessions} sessions interrupted by the last stop")
+
+
+# Streamed sessions
+
+# Sessions whose events are being uploaded in chunks while the video plays:
+# {metric id: {"mpd_id", "events", "timeline", "i13_segments", "lock"}}
+streaming_sessions = {}
+streaming_sessions_lock = threading.Lock()
+
+def add_session_events(session, events):
+    with session["lock"]:
+        session["events"].extend(events)
+        closed_segments = session["timeline"].add_events(events)
+        first_index = len(session["timeline"].quality_segments) - len(closed_segments)
+
+        # Build the I13 segments as soon as their quality segment is closed, so little work is left
+        # when playback ends. Segments of renditions not extracted yet are built with the input JSON.
+        if closed_segments:
+            rep_id_rel = get_video_from_id(session["mpd_id"])["bitrates"]
+            qp_path = session_input.get_qp_path(session["mpd_id"])
+            for index, segment in enumerate(closed_segments, start=first_index):
+                if segment[0] in rep_id_rel and is_rendition_extracted(session["mpd_id"], rep_id_rel[segment[0]]):
+                    rendition = qp_cache.get_rendition(session["mpd_id"], rep_id_rel[segment[0]], qp_path)
+                    session["i13_segments"][index] = session_input.build_i13_segment(rendition, segment)
+
+
+# Swarm telemetry
+
+# Dashboards join the swarm room and get a "swarm" event with the aggregates of the swarm
+# every SWARM_PUSH_SECONDS while new transfer records arrive.
+SWARM_ROOM = "swarm"
+SWARM_PUSH_SECONDS = float(os.environ.get("QOE_SWARM_PUSH_SECONDS", 2))
+
+swarm_records_total = instrumentation.registry.counter(
+    "qoe_swarm_records_total", "Swarm transfer records received, by whether they fell inside the window", ["state"]
+)
+
+def push_swarm_stats():
+    pushed_version = swarm_telemetry.get_version()
+    while True:
+        time.sleep(SWARM_PUSH_SECONDS)
+        version = swarm_telemetry.get_version()
+        if version != pushed_version:
+            pushed_version = version
+            socketio.emit("swarm", swarm_telemetry.snapshot(), to=SWARM_ROOM)
+
+swarm_pusher_started = False
+swarm_pusher_lock = threading.Lock()
+
+def start_swarm_pusher():
+    # A thread, like the queue watcher: app.run has no eventlet hub for green tasks
+    global swarm_pusher_started
+    with swarm_pusher_lock:
+        if not swarm_pusher_started:
+            swarm_pusher_started = True
+            threading.Thread(target=push_swarm_stats, name="swarm-pusher", daemon=True).start()
+
+
 # Flask Server
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 socketio = SocketIO(app, debug=True, cors_allowed_origins='*', async_mode='eventlet')
 
 print("Initializing app")
-if os.path.exists(os.path.join("video_db", "video_db.json")):
-    db = read_db()
-    for metric in db["metrics"]:
-        if metric["processing"]:
-            metric["processing"] = False
-    write_db(db)
-
-# Create all necessary folders and files
-if not os.path.exists("video_db"):
-    os.makedirs("video_db")
-    os.makedirs(os.path.join("video_db", "videos"))
-    os.makedirs(os.path.join("video_db", "metrics"))
-    video_db_structure = {"videos": [], "metrics": []}
-    with open(os.path.join("video_db", "video_db.json"), 'w') as video_db_file:
-        video_db_file.write(json.dumps(video_db_structure, indent=2))
+
+# Create all necessary folders and the database, migrating the old JSON database if present
+database.init_db()
+if QUEUE_MODE:
+    app.before_request(start_queue_watcher)
+    # Sessions whose MOS job a worker is still running keep their flag
+    database.reset_processing(keep=[key[1] for key in job_queue.running_keys("mos")])
+else:
+    database.reset_processing()
+if RECOVER_JOBS:
+    # In the background, so the first requests are served while the jobs are submitted. In queue
+    # mode this also runs when a worker starts, which only adds the jobs that are missing.
+    threading.Thread(target=recover_jobs, name="recover-jobs", daemon=True).start()
 
 
 @app.route('/')
@@ -450,34 +730,23 @@ def process_mpd():
     print("Processing MPD")
 
     # 1st: Check whether the MPD is in the database or not
-    db = read_db()
-    mpd_urls = [video["mpd_url"] for video in db["videos"]]
     post_url = request.get_json()["mpd_url"]
     response_code = 400
-    if not post_url in mpd_urls:
+    if get_id_from_mpd(post_url) is None:
         # 2nd: If the MPD is not in the database, try to download it
         try:
             response = requests.get(post_url)
             response_code = response.status_code
             if response_code == 200:
-                # 3rd: If the MPD is available, add it to the database, save it and download the video
-                id = get_video_id()
-                db["videos"].append(
-                    {
-                        "id": id,
-                        "mpd_url": post_url,
-                        "downloaded": False,
-                        "qp_extracted": False,
-                        "bitrates": {}
-                    }
-                )
-                write_db(db)
-
-                # Download video
-                threading.Thread(target=download_video, args=(post_url, id, response)).start()
-
-                # Extract qp
-                threading.Thread(target=extract_qp, args=(id,)).start()
+                # 3rd: If the MPD is available, add it to the database, save it and download the video.
+                # An MPD with the same content as a known one is only added as another URL of that video.
+                representations = dash_downloader.get_representations(io.BytesIO(response.content), post_url)
+                probes = dash_downloader.probe_representations(representations)
+                content_key = dash_downloader.manifest_key(representations, post_url, probes)
+                id, created = database.register_video(dash_downloader.normalize_url(post_url), post_url, content_key)
+                if created:
+                    # Download video and extract qp
+                    schedule_video(id, post_url, response)
 
             else:
                 print("There was an error downloading the MPD:", response_code)
@@ -488,55 +757,129 @@ def process_mpd():
 
     return '', response_code
 
+@app.delete("/mpd")
+def remove_mpd():
+    # Forget an MPD URL. The files of the video are deleted with its last URL.
+    mpd_url = request.get_json()["mpd_url"]
+    url_key = dash_downloader.normalize_url(mpd_url)
+    if database.get_video_id_by_url(url_key) is None:
+        url_key = mpd_url
+    id = database.get_video_id_by_url(url_key)
+    if id is None:
+        return '', 404
+    if is_job_pending(("download", id)) or is_job_pending(("extract", id)):
+        return 'The video is still being processed', 409
+
+    id, deleted = database.remove_video_url(url_key)
+    if deleted:
+        print(f"Deleting video {id}, it has no MPD URLs left")
+        remove_video_files(id)
+    return '', 200
+
 @app.post("/metrics")
 def process_metrics():
 
     mpd_url = request.get_json()["mpd_url"]
     mpd_id = get_id_from_mpd(mpd_url)
     metrics = request.get_json()["metrics"]
-    metrics_id = get_metrics_id()
+    metrics_id = database.add_metric(mpd_id, str(datetime.datetime.now()))
 
     print("Processing metrics for", mpd_url)
 
-    os.makedirs(os.path.join("video_db","metrics",str(metrics_id)), exist_ok=True)
-    with open(os.path.join("video_db","metrics",str(metrics_id),f"{str(metrics_id)}-metric.json"), 'w') as metric_file:
-        metric_file.write(json.dumps(metrics, indent=2))
-
-    # Read DB and create entry for the media session
-    db_metric = {
-        "id": metrics_id,
-        "mpd_url": mpd_id,
-        "date": str(datetime.datetime.now()),
-        "json_prepared": False,
-        "result_obtained": False,
-        "processing": False,
-        "result": 0
-    }
+    save_metric_events(metrics_id, metrics)
+
+    # Generate input JSON file for MOS extraction and extract MOS values for QoE
+    schedule_metric(metrics_id, mpd_id)
+
+    response_code = 200
+    response_json = {"metric_id": metrics_id}
+
+    return response_json, response_code
+
+@app.post("/metrics/batch")
+def process_metrics_batch():
+    # Body: {"sessions": [{"mpd_url": ..., "metrics": [...]}, ...]}, optionally gzip/zstd compressed
+    sessions = get_request_json()["sessions"]
+
+    mpd_ids = {}
+    for session in sessions:
+        if session["mpd_url"] not in mpd_ids:
+            mpd_ids[session["mpd_url"]] = get_id_from_mpd(session["mpd_url"])
+    session_mpd_ids = [mpd_ids[session["mpd_url"]] for session in sessions]
+
+    metrics_ids = database.add_metrics(session_mpd_ids, str(datetime.datetime.now()))
 
-    db = read_db()
-    db["metrics"].append(db_metric)
-    write_db(db)
+    print(f"Processing metrics for {len(sessions)} sessions")
 
-    # Generate input JSON file for MOS extraction
-    threading.Thread(target=build_input_json, args=(metrics_id, mpd_id)).start()
+    for metrics_id, session in zip(metrics_ids, sessions):
+        save_metric_events(metrics_id, session["metrics"])
 
-    # Extract MOS values for QoE
-    threading.Thread(target=extract_mos, args=(metrics_id,)).start()
+    for metrics_id, mpd_id in zip(metrics_ids, session_mpd_ids):
+        schedule_metric(metrics_id, mpd_id)
 
     response_code = 200
-    response_json = {"metric_id": metrics_id}
+    response_json = {"metric_ids": metrics_ids}
 
     return response_json, response_code
 
+@app.post("/session")
+def start_session():
+    mpd_url = get_request_json()["mpd_url"]
+    mpd_id = get_id_from_mpd(mpd_url)
+    metrics_id = database.add_metric(mpd_id, str(datetime.datetime.now()))
+
+    print("Starting streamed session for", mpd_url)
+
+    with streaming_sessions_lock:
+        streaming_sessions[metrics_id] = {
+            "mpd_id": mpd_id,
+            "events": [],
+            "timeline": timeline.SessionTimeline(),
+            "i13_segments": {},
+            "lock": threading.Lock()
+        }
+
+    return {"metric_id": metrics_id}, 200
+
+@app.post("/session/<int:metrics_id>/events")
+def process_session_events(metrics_id):
+    with streaming_sessions_lock:
+        session = streaming_sessions.get(metrics_id)
+    if session is None:
+        abort(404, f"No streamed session {metrics_id}")
+
+    add_session_events(session, get_request_json()["events"])
+
+    return {"metric_id": metrics_id}, 200
+
+@app.post("/session/<int:metrics_id>/end")
+def end_session(metrics_id):
+    with streaming_sessions_lock:
+        session = streaming_sessions.pop(metrics_id, None)
+    if session is None:
+        abort(404, f"No streamed session {metrics_id}")
+
+    # The last chunk of events can be sent with the end marker
+    events = get_request_json().get("events", []) if request.content_length else []
+    add_session_events(session, events)
+
+    save_metric_events(metrics_id, session["events"])
+
+    # Generate input JSON file for MOS extraction and extract MOS values for QoE
+    schedule_metric(metrics_id, session["mpd_id"], None if QUEUE_MODE else session)
+
+    return {"metric_id": metrics_id}, 200
+
 @app.post("/result")
 def get_result():
     metric_id = request.get_json()["metric_id"]
 
-    result_ready = is_result_ready(metric_id)
-
-    result = 0
-    if result_ready:
-        result = get_mos_result(metric_id)
+    result = get_recent_result(metric_id)
+    result_ready = result is not None
+    if not result_ready:
+        metric = database.get_metric(metric_id)
+        result_ready = metric is not None and metric["result_obtained"]
+        result = metric["result"] if result_ready else 0
 
     response_json = {
         "metric_id": metric_id,
@@ -548,6 +891,56 @@ def get_result():
     return response_json, response_code
 
 
+@socketio.on("subscribe")
+def subscribe_result(data):
+    metric_id = data["metric_id"]
+    join_room(metric_room(metric_id))
+
+    # The result may be ready before the client subscribes
+    result = get_recent_result(metric_id)
+    if result is None and is_result_ready(metric_id):
+        result = get_mos_result(metric_id)
+    if result is not None:
+        emit("result", {"metric_id": metric_id, "result": result})
+
+
+@app.post("/swarm/records")
+def process_swarm_records():
+    # Body: {"records": [{peerId, url, source, fromPeerId, bytes, timestamp}, ...]}, optionally gzip/zstd compressed
+    records = get_request_json()["records"]
+    try:
+        accepted, dropped = swarm_telemetry.add_records(records)
+    except (KeyError, TypeError, ValueError) as e:
+        abort(400, f"Invalid swarm records: {e}")
+    swarm_records_total.inc(accepted, state="accepted")
+    swarm_records_total.inc(dropped, state="dropped")
+
+    return {"accepted": accepted, "dropped": dropped}, 200
+
+@app.get("/swarm/stats")
+def get_swarm_stats():
+    return swarm_telemetry.snapshot(), 200
+
+
+@socketio.on("subscribe_swarm")
+def subscribe_swarm():
+    join_room(SWARM_ROOM)
+    start_swarm_pusher()
+    emit("swarm", swarm_telemetry.snapshot())
+
+
+@app.get("/status")
+def get_status():
+    response_json = {"jobs": job_queue.stats() if QUEUE_MODE else scheduler.stats(), "qp_cache": qp_cache.stats(), "mos_cache": mos_cache.stats()}
+    return response_json, 200
+
+
+@app.get("/metrics-export")
+def export_metrics():
+    # Prometheus text format
+    return instrumentation.registry.export(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @app.route('/<path:filename>')
 def serve_static_file(filename):
     return send_from_directory('static', filename)
@@ -0,0 +1,339 @@
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import dash_downloader
+
+
+# End-to-end benchmark of the QoE pipeline.
+#
+# A synthetic DASH ladder is encoded with ffmpeg (testsrc2) and served from a local
+# HTTP server, then every stage is timed on its own: MPD parsing, segment download,
+# QP extraction (extract_info through the extraction pool, and serially), input
+# build, MOS extraction, and the /metrics -> /result latency of concurrent clients
+# of the Flask test client. Sessions are generated with a configurable length,
+# quality switch rate and stall rate. The results are written as JSON, and
+# --compare prints the change of every stage against a previous run.
+#
+# The server runs inside the work folder, the video_db of the current folder is
+# never touched.
+
+DEFAULT_LADDER = "1920x1080:4500k,1280x720:2500k,854x480:1000k,640x360:600k"
+
+
+# Synthetic content
+
+def generate_ladder(output_directory, ladder, duration, fps, segment_duration):
+    """
+    Encode a test pattern as a DASH ladder with ffmpeg
+
+    Arguments:
+        output_directory {str} -- folder of the MPD and its segments
+        ladder {list} -- [(width, height, bitrate), ...] of the renditions
+        duration {int} -- length of the video in seconds
+        fps {int} -- frame rate
+        segment_duration {int} -- length of the DASH segments in seconds
+
+    Returns:
+        str -- path of the MPD
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    width, height = max((width, height) for width, height, _ in ladder)
+    split = f"[0:v]split={len(ladder)}" + "".join(f"[v{index}]" for index in range(len(ladder)))
+    scales = [f"[v{index}]scale={width}:{height}[o{index}]" for index, (width, height, _) in enumerate(ladder)]
+
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={duration}",
+        "-filter_complex", ";".join([split] + scales)
+    ]
+    for index, (_, _, bitrate) in enumerate(ladder):
+        command += ["-map", f"[o{index}]", f"-b:v:{index}", bitrate]
+    command += [
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-g", str(fps * segment_duration), "-keyint_min", str(fps * segment_duration), "-sc_threshold", "0",
+        "-f", "dash", "-seg_duration", str(segment_duration), "-use_template", "1", "-use_timeline", "0",
+        "-init_seg_name", "init-$RepresentationID$.m4s",
+        "-media_seg_name", "chunk-$RepresentationID$-$Number%05d$.m4s",
+        "-adaptation_sets", "id=0,streams=v",
+        os.path.join(output_directory, "manifest.mpd")
+    ]
+    subprocess.run(command, check=True)
+    return os.path.join(output_directory, "manifest.mpd")
+
+def parse_ladder(ladder):
+    renditions = []
+    for rendition in ladder.split(","):
+        size, bitrate = rendition.split(":")
+        width, height = size.split("x")
+        renditions.append((int(width), int(height), bitrate))
+    return renditions
+
+def generate_session(duration, rep_ids, switch_rate, stall_rate, stall_duration, seed):
+    """
+    Events of a synthetic media session
+
+    Arguments:
+        duration {float} -- media time played, in seconds
+        rep_ids {list} -- representation ids the player switches between
+        switch_rate {float} -- mean quality switches per minute
+        stall_rate {float} -- mean stalls per minute
+        stall_duration {float} -- mean stall length in seconds
+        seed {int} -- random seed
+
+    Returns:
+        list -- events in the format sent by the player
+    """
+    generator = random.Random(seed)
+    clock_time = 1700000000000 + seed * 1000000
+    rep_id = generator.choice(rep_ids)
+    events = [{"type": "playback_started", "media_time": 0, "clock_time": clock_time, "current_rep_id": rep_id}]
+
+    def next_time(rate):
+        return generator.expovariate(rate / 60) if rate > 0 else float("inf")
+
+    media_time = 0.0
+    next_switch = next_time(switch_rate)
+    next_stall = next_time(stall_rate)
+    while True:
+        step = min(next_switch, next_stall)
+        if media_time + step >= duration:
+            break
+        media_time += step
+        clock_time += int(step * 1000)
+        next_switch -= step
+        next_stall -= step
+
+        if next_stall <= 0:
+            stall_ms = max(1, int(generator.expovariate(1 / stall_duration) * 1000))
+            events.append({"type": "stall_ini", "media_time": round(media_time, 3), "clock_time": clock_time})
+            clock_time += stall_ms
+            events.append({"type": "stall_end", "media_time": round(media_time, 3), "clock_time": clock_time})
+            next_stall = next_time(stall_rate)
+        else:
+            rep_id = generator.choice([other for other in rep_ids if other != rep_id] or rep_ids)
+            events.append({"type": "quality_change", "media_time": round(media_time, 3), "clock_time": clock_time,
+                           "current_rep_id": rep_id})
+            next_switch = next_time(switch_rate)
+
+    clock_time += int((duration - media_time) * 1000)
+    events.append({"type": "playback_ended", "media_time": duration, "clock_time": clock_time})
+    return events
+
+
+# Measurements
+
+def summarize(durations):
+    # Statistics of a list of durations in seconds
+    if not durations:
+        return {"count": 0}
+    ordered = sorted(durations)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "total_s": sum(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000
+    }
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def serve_directory(directory):
+    # Local HTTP server for the generated ladder, returns (server, base URL)
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config):
+    stages = {}
+    work_directory = os.path.abspath(config["workdir"] or tempfile.mkdtemp(prefix="qoe-benchmark-"))
+    media_directory = os.path.join(work_directory, "media")
+    os.makedirs(work_directory, exist_ok=True)
+
+    print("Encoding the ladder")
+    encode_time, mpd_path = timed(generate_ladder, media_directory, parse_ladder(config["ladder"]),
+                                  config["duration"], config["fps"], config["segment_duration"])
+    stages["encode"] = summarize([encode_time])
+
+    server, base_url = serve_directory(media_directory)
+    mpd_url = base_url + "manifest.mpd"
+
+    print("Parsing the MPD")
+    stages["mpd"] = summarize([timed(dash_downloader.get_representations, mpd_path, mpd_url)[0] for _ in range(config["repeat"])])
+    representations = dash_downloader.get_representations(mpd_path, mpd_url)
+    rep_ids = [rep["id"] for rep in representations]
+
+    # The server keeps its database and files in the current folder
+    previous_directory = os.getcwd()
+    os.chdir(work_directory)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    import database
+    import extract_info
+    import event_store
+    import mos_cache
+    import mos_pool
+    import qp_extraction
+
+    try:
+        print("Downloading")
+        mpd_response = requests.get(mpd_url)
+        video_id, _ = database.register_video(dash_downloader.normalize_url(mpd_url), mpd_url,
+                                              dash_downloader.manifest_key(representations, mpd_url,
+                                                                           dash_downloader.probe_representations(representations)))
+        stages["download"] = summarize([timed(app.download_video, mpd_url, video_id, mpd_response)[0]])
+
+        print("Extracting QP values")
+        stages["extract"] = summarize([timed(app.extract_qp, video_id)[0]])
+        if config["serial_extract"]:
+            # One rendition after the other in this process, the reference for the extraction pool
+            video_directory = os.path.join("video_db", "videos", str(video_id))
+            stages["extract_serial"] = summarize([
+                timed(extract_info.extract_from_single_file, video_file, qp_extraction.EXTRACTION_MODE)[0]
+                for video_file in app.get_videos_from_folder(video_directory)
+            ])
+
+        def new_session(seed):
+            return generate_session(config["duration"], rep_ids, config["switch_rate"], config["stall_rate"],
+                                    config["stall_duration"], config["seed"] + seed)
+
+        print("Building inputs and extracting MOS values")
+        input_times = []
+        mos_times = []
+        timeline_times = []
+        for index in range(config["sessions"]):
+            metrics_id = database.add_metric(video_id, str(datetime.datetime.now()))
+            app.save_metric_events(metrics_id, new_session(index))
+            timeline_times.append(timed(lambda: app.timeline.get_timeline(event_store.load_columns(metrics_id)))[0])
+            input_times.append(timed(app.build_input_json, metrics_id, video_id)[0])
+            mos_times.append(timed(app.extract_mos, metrics_id)[0])
+        stages["timeline"] = summarize(timeline_times)
+        stages["input"] = summarize(input_times)
+        stages["mos"] = summarize(mos_times)
+
+        print("Measuring /metrics -> /result latency")
+        def client_session(index):
+            client = app.app.test_client()
+            start = time.perf_counter()
+            response = client.post("/metrics", json={"mpd_url": mpd_url, "metrics": new_session(config["sessions"] + index)})
+            metrics_id = response.get_json()["metric_id"]
+            while not client.post("/result", json={"metric_id": metrics_id}).get_json()["is_result_ready"]:
+                if time.perf_counter() - start > config["timeout"]:
+                    raise TimeoutError(f"No result for metric {metrics_id}")
+                time.sleep(config["poll_interval"])
+            return time.perf_counter() - start
+
+        http_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=config["concurrency"]) as executor:
+            latencies = list(executor.map(client_session, range(config["http_sessions"])))
+        stages["http"] = summarize(latencies)
+        stages["http"]["concurrency"] = config["concurrency"]
+        stages["http"]["throughput_per_s"] = len(latencies) / (time.perf_counter() - http_start)
+
+        caches = {"mos_cache": mos_cache.stats(), "qp_cache": app.qp_cache.stats()}
+    finally:
+        os.chdir(previous_directory)
+        server.shutdown()
+        app.scheduler.shutdown(wait=False)
+        mos_pool.shutdown()
+        qp_extraction.shutdown()
+        if not config["keep"]:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {
+        "date": datetime.datetime.now().isoformat(),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "stages": stages,
+        "caches": caches
+    }
+
+def compare(results, previous):
+    # Change of the mean and p95 of every stage against a previous run
+    print(f"{'stage':<16}{'mean ms':>12}{'before':>12}{'change':>10}{'p95 ms':>12}{'before':>12}{'change':>10}")
+    for stage, stats in results["stages"].items():
+        before = previous["stages"].get(stage)
+        if before is None or "mean_ms" not in stats or "mean_ms" not in before:
+            continue
+        changes = [(stats[key] - before[key]) / before[key] * 100 if before[key] else 0 for key in ("mean_ms", "p95_ms")]
+        print(f"{stage:<16}{stats['mean_ms']:>12.1f}{before['mean_ms']:>12.1f}{changes[0]:>+9.1f}%"
+              f"{stats['p95_ms']:>12.1f}{before['p95_ms']:>12.1f}{changes[1]:>+9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the QoE pipeline")
+    parser.add_argument("--output", type=str, default="benchmark.json", help="JSON file with the results")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare with")
+    parser.add_argument("--workdir", type=str, help="work folder (a temporary folder by default)")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder")
+    parser.add_argument("--ladder", type=str, default=DEFAULT_LADDER, help="renditions as WIDTHxHEIGHT:BITRATE,...")
+    parser.add_argument("--duration", type=int, default=60, help="video length in seconds")
+    parser.add_argument("--fps", type=int, default=25, help="frame rate")
+    parser.add_argument("--segment-duration", type=int, default=4, help="DASH segment length in seconds")
+    parser.add_argument("--sessions", type=int, default=10, help="sessions for the input and MOS stages")
+    parser.add_argument("--switch-rate", type=float, default=2, help="quality switches per minute")
+    parser.add_argument("--stall-rate", type=float, default=1, help="stalls per minute")
+    parser.add_argument("--stall-duration", type=float, default=2, help="mean stall length in seconds")
+    parser.add_argument("--http-sessions", type=int, default=20, help="sessions sent through /metrics")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent /metrics clients")
+    parser.add_argument("--poll-interval", type=float, default=0.01, help="seconds between /result requests")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for a result")
+    parser.add_argument("--repeat", type=int, default=20, help="runs of the MPD parsing stage")
+    parser.add_argument("--serial-extract", action="store_true", help="also extract the renditions one by one")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the sessions")
+    config = vars(parser.parse_args())
+    output, previous = config.pop("output"), config.pop("compare")
+
+    results = run(config)
+    with open(output, "w") as output_file:
+        output_file.write(json.dumps(results, indent=2))
+    print(f"Results saved in {output}")
+
+    if previous is not None:
+        with open(previous, "r") as previous_file:
+            compare(results, json.loads(previous_file.read()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import posixpath
+import re
+import threading
+
+import xml.etree.ElementTree as ET
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse, urlunparse
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Native DASH downloader. Segments of all representations are fetched through one
+# pooled HTTP session with a limit of concurrent requests per host. Every finished
+# segment is recorded with its size and SHA-256 in a manifest, so an interrupted
+# download continues where it stopped, and partial segments are resumed with
+# HTTP Range requests.
+
+CONNECTIONS_PER_HOST = int(os.environ.get("QOE_DOWNLOAD_CONNECTIONS_PER_HOST", 6))
+DOWNLOAD_THREADS = int(os.environ.get("QOE_DOWNLOAD_THREADS", 16))
+# Probes run in their own pool, so a new MPD is not queued behind the segments of other downloads
+PROBE_THREADS = int(os.environ.get("QOE_DOWNLOAD_PROBE_THREADS", 4))
+CHUNK_SIZE = 1024 * 1024
+# Bytes of each probe segment compared to tell videos apart
+PROBE_BYTES = 64 * 1024
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+# MPD parsing
+
+def parse_duration(duration):
+    # ISO 8601 duration (e.g. PT3M56.653S) in seconds
+    match = re.fullmatch(
+        r"P(?:(?P<days>[\d.]+)D)?(?:T(?:(?P<hours>[\d.]+)H)?(?:(?P<minutes>[\d.]+)M)?(?:(?P<seconds>[\d.]+)S)?)?",
+        duration.strip()
+    )
+    if match is None:
+        raise ValueError(f"Invalid duration: {duration}")
+    parts = {name: float(value) for name, value in match.groupdict().items() if value}
+    return (parts.get("days", 0) * 86400 + parts.get("hours", 0) * 3600
+            + parts.get("minutes", 0) * 60 + parts.get("seconds", 0))
+
+def fill_template(template, rep_id, bandwidth, number=None, time=None):
+    values = {"RepresentationID": rep_id, "Bandwidth": bandwidth, "Number": number, "Time": time}
+
+    def replace(match):
+        if match.group(0) == "$$":
+            return "$"
+        value = values[match.group(1)]
+        if match.group(2):
+            return f"{int(value):0{int(match.group(3))}d}"
+        return str(value)
+
+    return re.sub(r"\$\$|\$(RepresentationID|Number|Bandwidth|Time)(%0(\d+)d)?\$", replace, template)
+
+def parse_byte_range(byte_range):
+    if byte_range is None:
+        return None
+    first, last = byte_range.split("-")
+    return int(first), int(last)
+
+def get_base_url(base_url, *elements, ns):
+    for element in elements:
+        base_element = element.find("mpd:BaseURL", ns)
+        if base_element is not None and base_element.text:
+            base_url = urljoin(base_url, base_element.text.strip())
+    return base_url
+
+def find_inherited(name, elements, ns):
+    # SegmentTemplate / SegmentList / SegmentBase of the representation, merged with the
+    # ones of its AdaptationSet and Period (the most specific attributes win)
+    found = [element.find(f"mpd:{name}", ns) for element in elements]
+    found = [element for element in found if element is not None]
+    if not found:
+        return None, None
+    attributes = {}
+    for element in found:
+        attributes.update(element.attrib)
+    return attributes, found
+
+def get_template_segments(attributes, template_elements, rep_id, bandwidth, base_url, period_duration, ns):
+    segments = []
+    timescale = int(attributes.get("timescale", 1))
+    start_number = int(attributes.get("startNumber", 1))
+
+    if "initialization" in attributes:
+        init_url = urljoin(base_url, fill_template(attributes["initialization"], rep_id, bandwidth))
+        segments.append({"url": init_url, "range": None})
+
+    timeline = None
+    for element in reversed(template_elements):
+        timeline = element.find("mpd:SegmentTimeline", ns)
+        if timeline is not None:
+            break
+
+    media = attributes["media"]
+    if timeline is not None:
+        number = start_number
+        time = 0
+        period_end = period_duration * timescale if period_duration is not None else None
+        for s_element in timeline.findall("mpd:S", ns):
+            time = int(s_element.get("t", time))
+            duration = int(s_element.get("d"))
+            repeat = int(s_element.get("r", 0))
+            if repeat < 0:
+                # Repeat until the end of the period
+                repeat = math.ceil((period_end - time) / duration) - 1
+            for _ in range(repeat + 1):
+                segments.append({"url": urljoin(base_url, fill_template(media, rep_id, bandwidth, number, time)), "range": None})
+                number += 1
+                time += duration
+    else:
+        if period_duration is None:
+            raise ValueError("Can not compute the number of segments without the period duration")
+        segment_duration = int(attributes["duration"]) / timescale
+        for number in range(start_number, start_number + math.ceil(period_duration / segment_duration)):
+            segments.append({"url": urljoin(base_url, fill_template(media, rep_id, bandwidth, number)), "range": None})
+
+    return segments
+
+def get_list_segments(list_elements, base_url, ns):
+    segments = []
+    for element in list_elements:
+        initialization = element.find("mpd:Initialization", ns)
+        if initialization is not None:
+            segments = [{"url": urljoin(base_url, initialization.get("sourceURL", "")),
+                         "range": parse_byte_range(initialization.get("range"))}]
+    for element in reversed(list_elements):
+        segment_urls = element.findall("mpd:SegmentURL", ns)
+        if segment_urls:
+            for segment_url in segment_urls:
+                segments.append({"url": urljoin(base_url, segment_url.get("media", "")),
+                                 "range": parse_byte_range(segment_url.get("mediaRange"))})
+            break
+    return segments
+
+def get_representations(mpd_file, mpd_url, mimetype="video/mp4"):
+    """
+    Segments of every representation of an MPD
+
+    Arguments:
+        mpd_file {str} -- path of the downloaded MPD
+        mpd_url {str} -- URL of the MPD, relative segment URLs are resolved against it
+        mimetype {str} -- only representations of this mime type are returned
+
+    Returns:
+        list -- {"id", "bandwidth", "segments": [{"url", "range"}, ...]} of every representation,
+                from the highest to the lowest bandwidth. The first segment is the initialization
+                segment when the MPD has one.
+    """
+    root = ET.parse(mpd_file).getroot()
+    ns = {'mpd': root.tag.split('}')[0].strip('{')}
+
+    presentation_duration = root.get("mediaPresentationDuration")
+    presentation_duration = parse_duration(presentation_duration) if presentation_duration else None
+
+    representations = {}
+    for period in root.findall("mpd:Period", ns):
+        period_duration = period.get("duration")
+        period_duration = parse_duration(period_duration) if period_duration else presentation_duration
+
+        for adaptation_set in period.findall("mpd:AdaptationSet", ns):
+            for representation in adaptation_set.findall("mpd:Representation", ns):
+                if (representation.get("mimeType") or adaptation_set.get("mimeType")) != mimetype:
+                    continue
+
+                rep_id = representation.get("id")
+                bandwidth = int(representation.get("bandwidth"))
+                base_url = get_base_url(mpd_url, root, period, adaptation_set, representation, ns=ns)
+                elements = (period, adaptation_set, representation)
+
+                template, template_elements = find_inherited("SegmentTemplate", elements, ns)
+                segment_list, list_elements = find_inherited("SegmentList", elements, ns)
+                if template is not None:
+                    segments = get_template_segments(template, template_elements, rep_id, bandwidth,
+                                                     base_url, period_duration, ns)
+                elif segment_list is not None:
+                    segments = get_list_segments(list_elements, base_url, ns)
+                else:
+                    # SegmentBase or plain BaseURL: the whole representation is one file
+                    segments = [{"url": base_url, "range": None}]
+
+                if rep_id in representations:
+                    # Same representation in a later period, skip its initialization segment
+                    representations[rep_id]["segments"].extend(segments[1:] if template and "initialization" in template else segments)
+                else:
+                    representations[rep_id] = {"id": rep_id, "bandwidth": bandwidth, "segments": segments}
+
+    return sorted(representations.values(), key=lambda rep: rep["bandwidth"], reverse=True)
+
+
+# Identity of the content
+
+def normalize_url(url):
+    # Key of an MPD URL: scheme and host in lower case, no default port, no query string
+    # (signed URLs and session tokens) and no fragment
+    parts = urlparse(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    path = re.sub(r"/{2,}", "/", parts.path) or "/"
+    return urlunparse((scheme, host, path, "", "", ""))
+
+def get_relative_path(url, mpd_url):
+    # Path of a segment relative to the folder of the MPD, the same on every mirror
+    return posixpath.relpath(urlparse(url).path, posixpath.dirname(urlparse(mpd_url).path) or "/")
+
+def get_probe_indexes(representation):
+    # Segments whose first bytes identify a representation: the first one (the initialization
+    # segment when there is one), the first media segment, and the middle and last ones
+    count = len(representation["segments"])
+    return sorted({0, min(1, count - 1), count // 2, count - 1})
+
+def probe_representations(representations):
+    """
+    Hashes of the first bytes of the probe segments of some representations
+
+    Arguments:
+        representations {list} -- representations returned by get_representations
+
+    Returns:
+        dict -- {representation id: {segment index: sha256 of its first PROBE_BYTES bytes}}
+    """
+    downloader = get_downloader()
+    futures = {
+        (rep["id"], index): downloader.probe_executor.submit(downloader.get_prefix, rep["segments"][index])
+        for rep in representations for index in get_probe_indexes(rep)
+    }
+    probes = {}
+    for (rep_id, index), future in futures.items():
+        probes.setdefault(rep_id, {})[index] = hashlib.sha256(future.result()).hexdigest()
+    return probes
+
+def read_probe(output_directory, name, representation):
+    # Probe hashes of a representation downloaded to output_directory, None if a segment is missing
+    probe = {}
+    for index in get_probe_indexes(representation):
+        path = os.path.join(output_directory, "segments", name, f"{index:06d}.m4s")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as segment_file:
+            probe[index] = hashlib.sha256(segment_file.read(PROBE_BYTES)).hexdigest()
+    return probe
+
+def rendition_key(representation, mpd_url, probe):
+    # Hash of a representation: bandwidth and relative location of every segment, which are
+    # the same for different videos packaged the same way, and the bytes of its probe segments
+    description = [
+        representation["bandwidth"],
+        [[get_relative_path(segment["url"], mpd_url), segment["range"] and list(segment["range"])]
+         for segment in representation["segments"]],
+        [[index, probe[index]] for index in get_probe_indexes(representation)]
+    ]
+    return hashlib.sha256(json.dumps(description, separators=(",", ":")).encode()).hexdigest()
+
+def manifest_key(representations, mpd_url, probes):
+    # Hash of the content of an MPD: MPDs served from different URLs with the same key describe the same video
+    description = [[rep["id"], rendition_key(rep, mpd_url, probes[rep["id"]])] for rep in representations]
+    return hashlib.sha256(json.dumps(description, separators=(",", ":")).encode()).hexdigest()
+
+
+# Downloading
+
+class SegmentDownloader:
+    def __init__(self, connections_per_host=CONNECTIONS_PER_HOST, threads=DOWNLOAD_THREADS):
+        self.connections_per_host = connections_per_host
+        self.session = requests.Session()
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(connections_per_host, threads), max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="segment-download")
+        self.probe_executor = ThreadPoolExecutor(max_workers=PROBE_THREADS, thread_name_prefix="segment-probe")
+        self.host_slots = defaultdict(lambda: threading.BoundedSemaphore(self.connections_per_host))
+        self.host_slots_lock = threading.Lock()
+
+    def get_host_slot(self, url):
+        with self.host_slots_lock:
+            return self.host_slots[urlparse(url).netloc]
+
+    def get(self, url, **kwargs):
+        with self.get_host_slot(url):
+            response = self.session.get(url, timeout=60, **kwargs)
+            response.raise_for_status()
+            return response.content
+
+    def get_prefix(self, segment, size=PROBE_BYTES):
+        # First bytes of a segment
+        first, last = segment["range"] if segment["range"] is not None else (0, None)
+        end = first + size - 1 if last is None else min(last, first + size - 1)
+        with self.get_host_slot(segment["url"]):
+            with self.session.get(segment["url"], headers={"Range": f"bytes={first}-{end}"}, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                # A server that ignores the range sends the whole file
+                start = first if response.status_code != 206 else 0
+                content = bytearray()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    content += chunk
+                    if len(content) >= start + end - first + 1:
+                        break
+        return bytes(content[start:start + end - first + 1])
+
+    def fetch_segment(self, segment, path):
+        # Downloads a segment to path, resuming path + ".part" if it exists. Returns (size, sha256).
+        part_path = path + ".part"
+        sha256 = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_path):
+            with open(part_path, "rb") as part_file:
+                for chunk in iter(lambda: part_file.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    offset += len(chunk)
+
+        first, last = segment["range"] if segment["range"] is not None else (0, None)
+        if last is not None and offset == last - first + 1:
+            # The process stopped after the last byte was written, before the rename
+            os.replace(part_path, path)
+            return offset, sha256.hexdigest()
+        headers = {}
+        if offset or segment["range"] is not None:
+            headers["Range"] = f"bytes={first + offset}-{'' if last is None else last}"
+
+        with self.get_host_slot(segment["url"]):
+            with self.session.get(segment["url"], headers=headers, stream=True, timeout=60) as response:
+                if offset and response.status_code == 416:
+                    # Nothing left after offset: the part is complete if the file is as long as it
+                    total = get_total_size(response)
+                    if total is not None and total != first + offset:
+                        os.remove(part_path)
+                        raise IOError(f"Partial segment {segment['url']} longer than the file: {offset} of {total} bytes")
+                    os.replace(part_path, path)
+                    return offset, sha256.hexdigest()
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # The server ignored the range, start again
+                    sha256 = hashlib.sha256()
+                    offset = 0
+                with open(part_path, "ab" if offset else "wb") as part_file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        part_file.write(chunk)
+                        sha256.update(chunk)
+
+        size = os.path.getsize(part_path)
+        if segment["range"] is not None and last is not None and size != last - first + 1:
+            os.remove(part_path)
+            raise IOError(f"Incomplete segment {segment['url']}: {size} of {last - first + 1} bytes")
+        os.replace(part_path, path)
+        return size, sha256.hexdigest()
+
+    def download(self, representations, output_directory, names):
+        """
+        Download representations and merge each of them into <name>.mp4
+
+        Arguments:
+            representations {list} -- representations returned by get_representations
+            output_directory {str} -- folder of the video; segments go to its "segments" subfolder
+            names {dict} -- {representation id: output file name without extension}
+
+        Returns:
+            dict -- {representation id: path of the merged file}
+        """
+        segments_directory = os.path.join(output_directory, "segments")
+        os.makedirs(segments_directory, exist_ok=True)
+        manifest = Manifest(os.path.join(segments_directory, MANIFEST_FILE))
+
+        futures = []
+        for representation in representations:
+            rep_directory = os.path.join(segments_directory, names[representation["id"]])
+            os.makedirs(rep_directory, exist_ok=True)
+            for index, segment in enumerate(representation["segments"]):
+                path = os.path.join(rep_directory, f"{index:06d}.m4s")
+                if manifest.is_complete(segment, path):
+                    continue
+                futures.append(self.executor.submit(self.download_segment, manifest, segment, path))
+
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise IOError(f"{len(errors)} segments could not be downloaded, first error: {errors[0]}")
+
+        merged = {}
+        for representation in representations:
+            rep_directory = os.path.join(segments_directory, names[representation["id"]])
+            merged[representation["id"]] = merge_segments(
+                [os.path.join(rep_directory, f"{index:06d}.m4s") for index in range(len(representation["segments"]))],
+                os.path.join(output_directory, f"{names[representation['id']]}.mp4")
+            )
+        return merged
+
+    def download_segment(self, manifest, segment, path):
+        size, sha256 = self.fetch_segment(segment, path)
+        manifest.add(segment, path, size, sha256)
+
+
+class Manifest:
+    # Append-only record of the downloaded segments: one JSON line per segment
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line cut by a crash
+                        continue
+                    self.entries[entry["file"]] = entry
+
+    @staticmethod
+    def segment_key(segment):
+        return [segment["url"], segment["range"] and list(segment["range"])]
+
+    def is_complete(self, segment, path):
+        # Recorded, same source, and the file on disk still has the recorded size and hash
+        entry = self.entries.get(os.path.basename(os.path.dirname(path)) + "/" + os.path.basename(path))
+        if entry is None or entry["source"] != self.segment_key(segment) or not os.path.exists(path):
+            return False
+        if os.path.getsize(path) != entry["size"]:
+            return False
+        return file_sha256(path) == entry["sha256"]
+
+    def add(self, segment, path, size, sha256):
+        entry = {
+            "file": os.path.basename(os.path.dirname(path)) + "/" + os.path.basename(path),
+            "source": self.segment_key(segment),
+            "size": size,
+            "sha256": sha256
+        }
+        with self.lock:
+            self.entries[entry["file"]] = entry
+            with open(self.path, "a") as manifest_file:
+                manifest_file.write(json.dumps(entry) + "\n")
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+
+
+def get_total_size(response):
+    # Size of the whole file from the Content-Range header ("bytes 0-99/1234" or "bytes */1234")
+    match = re.fullmatch(r"bytes (?:\d+-\d+|\*)/(\d+)", response.headers.get("Content-Range", "").strip())
+    return int(match.group(1)) if match else None
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as segment_file:
+        for chunk in iter(lambda: segment_file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def merge_segments(segment_paths, output_path):
+    # Initialization segment + media segments of a fragmented MP4 form a playable file
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as output_file:
+        for segment_path in segment_paths:
+            with open(segment_path, "rb") as segment_file:
+                while True:
+                    chunk = segment_file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output_file.write(chunk)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def get_segment_files(output_directory, name):
+    """
+    Segment files kept by download() for one representation
+
+    Arguments:
+        output_directory {str} -- folder of the video
+        name {str} -- output file name of the representation
+
+    Returns:
+        tuple -- (path of the initialization segment or None, [paths of the media segments in order]),
+                 or (None, []) if the segments are not available
+    """
+    rep_directory = os.path.join(output_directory, "segments", name)
+    if not os.path.isdir(rep_directory):
+        return None, []
+    paths = [os.path.join(rep_directory, file) for file in sorted(os.listdir(rep_directory)) if file.endswith(".m4s")]
+    if not paths:
+        return None, []
+    # The initialization segment starts with the ftyp box, media segments with styp or moof
+    with open(paths[0], "rb") as first_segment:
+        if first_segment.read(8)[4:] == b"ftyp":
+            return paths[0], paths[1:]
+    return None, paths
+
+
+_downloader = None
+_downloader_lock = threading.Lock()
+
+def get_downloader():
+    # Shared by all downloads, so the per-host limit applies to the whole server
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = SegmentDownloader()
+        return _downloader
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the video representations of a DASH MPD")
+    parser.add_argument("mpd_url", type=str, help="URL of the MPD")
+    parser.add_argument("output", type=str, help="output folder")
+    argsdict = vars(parser.parse_args())
+
+    os.makedirs(argsdict["output"], exist_ok=True)
+    downloader = get_downloader()
+    mpd_path = os.path.join(argsdict["output"], "video.mpd")
+    with open(mpd_path, "wb") as mpd_file:
+        mpd_file.write(downloader.get(argsdict["mpd_url"]))
+
+    representations = get_representations(mpd_path, argsdict["mpd_url"])
+    names = {rep["id"]: f"video-{idx}" for idx, rep in enumerate(representations, start=1)}
+    for rep_id, path in downloader.download(representations, argsdict["output"], names).items():
+        print(f"{rep_id}: {path}")
+
+
+if __name__ == "__main__":
+    main()
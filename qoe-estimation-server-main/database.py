@@ -0,0 +1,375 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+
+import instrumentation
+
+
+# SQLite storage for videos and media sessions (metrics)
+
+DB_DIR = "video_db"
+DB_PATH = os.path.join(DB_DIR, "video_db.sqlite3")
+LEGACY_DB_PATH = os.path.join(DB_DIR, "video_db.json")
+
+# WAL needs shared memory between the processes, so it only works when they run on the
+# same machine. Workers on other machines sharing video_db need DELETE (rollback journal).
+JOURNAL_MODE = os.environ.get("QOE_DB_JOURNAL_MODE", "WAL")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    mpd_url TEXT NOT NULL UNIQUE,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    qp_extracted INTEGER NOT NULL DEFAULT 0,
+    bitrates TEXT NOT NULL DEFAULT '{}'
+);
+
+CREATE INDEX IF NOT EXISTS videos_incomplete ON videos (id) WHERE downloaded = 0 OR qp_extracted = 0;
+
+CREATE TABLE IF NOT EXISTS metrics (
+    id INTEGER PRIMARY KEY,
+    mpd_url INTEGER,
+    date TEXT NOT NULL,
+    json_prepared INTEGER NOT NULL DEFAULT 0,
+    result_obtained INTEGER NOT NULL DEFAULT 0,
+    processing INTEGER NOT NULL DEFAULT 0,
+    result TEXT NOT NULL DEFAULT '0',
+    mos_key TEXT
+);
+
+CREATE INDEX IF NOT EXISTS metrics_video ON metrics (mpd_url);
+CREATE INDEX IF NOT EXISTS metrics_processing ON metrics (processing) WHERE processing = 1;
+CREATE INDEX IF NOT EXISTS metrics_incomplete ON metrics (id) WHERE result_obtained = 0;
+
+CREATE TABLE IF NOT EXISTS mos_cache (
+    key TEXT PRIMARY KEY,
+    video_id INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS mos_cache_last_used ON mos_cache (last_used);
+CREATE INDEX IF NOT EXISTS mos_cache_video ON mos_cache (video_id);
+
+CREATE TABLE IF NOT EXISTS renditions (
+    video_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    qp_extracted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (video_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS video_urls (
+    url TEXT PRIMARY KEY,
+    video_id INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS video_urls_video ON video_urls (video_id);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    function TEXT NOT NULL,
+    args TEXT NOT NULL,
+    deps TEXT NOT NULL DEFAULT '[]',
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (stage, state, created);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+"""
+
+# Columns added after the first version of the schema: {table: [(column, definition)]}
+ADDED_COLUMNS = {
+    "metrics": [("mos_key", "TEXT")],
+    "videos": [("content_key", "TEXT")],
+    "renditions": [("content_key", "TEXT")]
+}
+
+# Indexes on added columns, created once the columns exist
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS videos_content ON videos (content_key);
+CREATE INDEX IF NOT EXISTS renditions_content ON renditions (content_key);
+"""
+
+# Data migrations run once, in order, on databases of an older version (PRAGMA user_version)
+DATA_MIGRATIONS = [
+    # Videos registered before URL aliases existed are reachable through their MPD URL
+    "INSERT OR IGNORE INTO video_urls (url, video_id) SELECT mpd_url, id FROM videos"
+]
+
+# Columns stored as JSON text, and columns stored as 0/1 integers
+JSON_COLUMNS = ("bitrates", "result")
+BOOL_COLUMNS = ("downloaded", "qp_extracted", "json_prepared", "result_obtained", "processing")
+
+VIDEO_COLUMNS = ("mpd_url", "downloaded", "qp_extracted", "bitrates", "content_key")
+METRIC_COLUMNS = ("mpd_url", "date", "json_prepared", "result_obtained", "processing", "result", "mos_key")
+RENDITION_COLUMNS = ("downloaded", "qp_extracted", "content_key")
+
+_local = threading.local()
+
+
+def get_connection():
+    # One connection per thread; WAL lets readers run while a writer commits
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+@contextlib.contextmanager
+def transaction():
+    conn = get_connection()
+    if conn.in_transaction:
+        # Already inside a transaction of this thread, join it
+        yield conn
+        return
+    with instrumentation.db_seconds.time(operation="write"):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+def fetch_one(sql, params=()):
+    with instrumentation.db_seconds.time(operation="read"):
+        return get_connection().execute(sql, params).fetchone()
+
+def row_to_dict(row):
+    if row is None:
+        return None
+    record = dict(row)
+    for column in JSON_COLUMNS:
+        if column in record:
+            record[column] = json.loads(record[column])
+    for column in BOOL_COLUMNS:
+        if column in record:
+            record[column] = bool(record[column])
+    return record
+
+def encode_fields(fields, allowed):
+    encoded = {}
+    for column, value in fields.items():
+        if column not in allowed:
+            raise KeyError(f"Unknown column: {column}")
+        if column in JSON_COLUMNS:
+            value = json.dumps(value)
+        elif column in BOOL_COLUMNS:
+            value = int(bool(value))
+        encoded[column] = value
+    return encoded
+
+
+# Initialization and migration
+
+def init_db():
+    os.makedirs(os.path.join(DB_DIR, "videos"), exist_ok=True)
+    os.makedirs(os.path.join(DB_DIR, "metrics"), exist_ok=True)
+
+    conn = get_connection()
+    conn.executescript(SCHEMA)
+    for table, columns in ADDED_COLUMNS.items():
+        existing = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+        for column, definition in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    conn.executescript(ADDED_INDEXES)
+
+    # Startup only reads the schema, whole-table migrations are not repeated
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(DATA_MIGRATIONS):
+        with transaction() as conn:
+            for migration in DATA_MIGRATIONS[version:]:
+                conn.execute(migration)
+            conn.execute(f"PRAGMA user_version = {len(DATA_MIGRATIONS)}")
+
+    if os.path.exists(LEGACY_DB_PATH):
+        migrate_json_db(LEGACY_DB_PATH)
+
+def migrate_json_db(json_path):
+    # One-time import of the old whole-file JSON database. The JSON file is kept
+    # renamed next to the new database so the migration is never repeated.
+    with open(json_path, 'r') as file_db:
+        legacy_db = json.loads(file_db.read())
+
+    print(f"Migrating {len(legacy_db['videos'])} videos and {len(legacy_db['metrics'])} metrics from {json_path}")
+
+    with transaction() as conn:
+        for video in legacy_db["videos"]:
+            conn.execute(
+                "INSERT OR REPLACE INTO videos (id, mpd_url, downloaded, qp_extracted, bitrates) VALUES (?, ?, ?, ?, ?)",
+                (video["id"], video["mpd_url"], int(video["downloaded"]), int(video["qp_extracted"]),
+                 json.dumps(video["bitrates"]))
+            )
+            conn.execute("INSERT OR IGNORE INTO video_urls (url, video_id) VALUES (?, ?)", (video["mpd_url"], video["id"]))
+        for metric in legacy_db["metrics"]:
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (id, mpd_url, date, json_prepared, result_obtained, processing, result) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (metric["id"], metric["mpd_url"], metric["date"], int(metric["json_prepared"]),
+                 int(metric["result_obtained"]), int(metric["processing"]), json.dumps(metric["result"]))
+            )
+
+    os.replace(json_path, json_path + ".migrated")
+
+
+# Videos
+
+def get_video(id):
+    return row_to_dict(fetch_one("SELECT * FROM videos WHERE id = ?", (id,)))
+
+def register_video(url_key, mpd_url, content_key):
+    """
+    Find or create the video of an MPD
+
+    Arguments:
+        url_key {str} -- normalized MPD URL
+        mpd_url {str} -- MPD URL as requested, used to download the video
+        content_key {str} -- hash of the content described by the MPD
+
+    Returns:
+        tuple -- (video id, True if the video is new and has to be downloaded)
+    """
+    with transaction() as conn:
+        row = conn.execute("SELECT video_id FROM video_urls WHERE url = ?", (url_key,)).fetchone()
+        if row is not None:
+            return row["video_id"], False
+
+        # Another URL of the same content (mirror, signed URL...), or a video registered with
+        # this exact URL before URLs were normalized
+        row = conn.execute(
+            "SELECT id FROM videos WHERE content_key = ? OR mpd_url = ? ORDER BY content_key = ? DESC LIMIT 1",
+            (content_key, mpd_url, content_key)
+        ).fetchone()
+        if row is not None:
+            id, created = row["id"], False
+        else:
+            # Ids of deleted videos are not reused, their sessions still point to them
+            cursor = conn.execute(
+                "INSERT INTO videos (id, mpd_url, content_key) VALUES ("
+                "(SELECT COALESCE(MAX(id) + 1, 0) FROM (SELECT id FROM videos UNION ALL SELECT mpd_url AS id FROM metrics)), ?, ?)",
+                (mpd_url, content_key)
+            )
+            id, created = cursor.lastrowid, True
+        conn.execute("INSERT INTO video_urls (url, video_id) VALUES (?, ?)", (url_key, id))
+        return id, created
+
+def get_video_id_by_url(url_key):
+    row = fetch_one("SELECT video_id FROM video_urls WHERE url = ?", (url_key,))
+    return row["video_id"] if row is not None else None
+
+def remove_video_url(url_key):
+    """
+    Remove an MPD URL. The video is deleted with its last URL.
+
+    Returns:
+        tuple -- (video id or None if the URL is unknown, True if the video was deleted)
+    """
+    with transaction() as conn:
+        row = conn.execute("SELECT video_id FROM video_urls WHERE url = ?", (url_key,)).fetchone()
+        if row is None:
+            return None, False
+        id = row["video_id"]
+        conn.execute("DELETE FROM video_urls WHERE url = ?", (url_key,))
+        references = conn.execute("SELECT COUNT(*) FROM video_urls WHERE video_id = ?", (id,)).fetchone()[0]
+        if references > 0:
+            return id, False
+        conn.execute("DELETE FROM videos WHERE id = ?", (id,))
+        conn.execute("DELETE FROM renditions WHERE video_id = ?", (id,))
+        return id, True
+
+def update_video(id, **fields):
+    encoded = encode_fields(fields, VIDEO_COLUMNS)
+    assignments = ", ".join(f"{column} = ?" for column in encoded)
+    with transaction() as conn:
+        conn.execute(f"UPDATE videos SET {assignments} WHERE id = ?", (*encoded.values(), id))
+
+
+# Renditions downloaded and extracted one by one (lazy mode)
+
+def get_rendition(video_id, name):
+    return row_to_dict(fetch_one(
+        "SELECT * FROM renditions WHERE video_id = ? AND name = ?", (video_id, name)
+    ))
+
+def find_rendition_by_content(content_key, exclude_video_id=None):
+    # A downloaded rendition with the same content, in any other video
+    return row_to_dict(fetch_one(
+        "SELECT * FROM renditions WHERE content_key = ? AND downloaded = 1 AND video_id IS NOT ? "
+        "ORDER BY qp_extracted DESC LIMIT 1",
+        (content_key, exclude_video_id)
+    ))
+
+def update_rendition(video_id, name, **fields):
+    encoded = encode_fields(fields, RENDITION_COLUMNS)
+    assignments = ", ".join(f"{column} = ?" for column in encoded)
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO renditions (video_id, name) VALUES (?, ?)", (video_id, name))
+        conn.execute(f"UPDATE renditions SET {assignments} WHERE video_id = ? AND name = ?",
+                     (*encoded.values(), video_id, name))
+
+
+# Metrics (media sessions)
+
+def add_metric(video_id, date):
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO metrics (id, mpd_url, date) VALUES ((SELECT COALESCE(MAX(id) + 1, 0) FROM metrics), ?, ?)",
+            (video_id, date)
+        )
+        return cursor.lastrowid
+
+def add_metrics(video_ids, date):
+    # Registers several sessions in one transaction, returns their ids in the same order
+    with transaction() as conn:
+        first_id = conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM metrics").fetchone()[0]
+        ids = list(range(first_id, first_id + len(video_ids)))
+        conn.executemany(
+            "INSERT INTO metrics (id, mpd_url, date) VALUES (?, ?, ?)",
+            [(id, video_id, date) for id, video_id in zip(ids, video_ids)]
+        )
+        return ids
+
+def get_metric(id):
+    return row_to_dict(fetch_one("SELECT * FROM metrics WHERE id = ?", (id,)))
+
+def update_metric(id, **fields):
+    encoded = encode_fields(fields, METRIC_COLUMNS)
+    assignments = ", ".join(f"{column} = ?" for column in encoded)
+    with transaction() as conn:
+        conn.execute(f"UPDATE metrics SET {assignments} WHERE id = ?", (*encoded.values(), id))
+
+def get_incomplete_videos():
+    # Videos whose download or QP extraction did not finish, read through the videos_incomplete index
+    return [row_to_dict(row) for row in get_connection().execute(
+        "SELECT * FROM videos WHERE downloaded = 0 OR qp_extracted = 0 ORDER BY id"
+    )]
+
+def get_incomplete_metrics():
+    # Sessions without a result, read through the metrics_incomplete index
+    return [row_to_dict(row) for row in get_connection().execute(
+        "SELECT * FROM metrics WHERE result_obtained = 0 ORDER BY id"
+    )]
+
+def reset_processing(keep=()):
+    # Clears flags left behind by sessions that were being processed when the server stopped,
+    # except the flags of the sessions in keep (still processed by a worker in queue mode)
+    keep = set(keep)
+    with transaction() as conn:
+        ids = [row["id"] for row in conn.execute("SELECT id FROM metrics WHERE processing = 1")]
+        reset = [(id,) for id in ids if id not in keep]
+        conn.executemany("UPDATE metrics SET processing = 0 WHERE id = ?", reset)
+        return len(reset)
@@ -0,0 +1,213 @@
+import argparse
+import datetime
+import json
+import os
+import tarfile
+
+import numpy as np
+
+import instrumentation
+
+
+# Columnar storage for the events of media sessions.
+#
+# The events of a session are saved in video_db/metrics/<id>/<id>-events.npz, a
+# compressed NumPy archive with one array per column:
+#   type            -- index of the event type in types
+#   current_rep_id  -- index of the representation id in rep_ids, -1 if the event has none
+#   media_time      -- float64, NaN if the event has none
+#   clock_time      -- float64, NaN if the event has none
+#   flags           -- per event: which times are present and which were integers, so
+#                      the original events are rebuilt exactly
+#   extra           -- only if some event has other fields: JSON list with them, UTF-8 encoded
+#
+# Sessions saved before this format (<id>-metric.json) are still read, and can be
+# converted in bulk with "python event_store.py migrate".
+
+METRICS_DIR = os.path.join("video_db", "metrics")
+
+COLUMN_FIELDS = ("type", "current_rep_id", "media_time", "clock_time")
+TIME_FIELDS = ("media_time", "clock_time")
+
+# flags bits: (present, integer) of each time field
+TIME_FLAGS = {"media_time": (1, 2), "clock_time": (4, 8)}
+
+
+def get_events_path(id):
+    return os.path.join(METRICS_DIR, str(id), f"{id}-events.npz")
+
+def get_json_path(id):
+    return os.path.join(METRICS_DIR, str(id), f"{id}-metric.json")
+
+def has_events(id):
+    return os.path.exists(get_events_path(id)) or os.path.exists(get_json_path(id))
+
+def intern(values):
+    # (table of distinct values in order of appearance, index of each value in the table)
+    table = {}
+    indexes = [table.setdefault(value, len(table)) for value in values]
+    return list(table), indexes
+
+def to_columns(events):
+    """
+    Columns of a list of events
+
+    Arguments:
+        events {list} -- events of a media session, as sent by the player
+
+    Returns:
+        dict -- {column name: numpy array}
+    """
+    types, type_indexes = intern([event.get("type") for event in events])
+    rep_ids, rep_indexes = intern([event["current_rep_id"] for event in events if "current_rep_id" in event])
+    rep_indexes = iter(rep_indexes)
+
+    columns = {
+        "types": np.array([json.dumps(value) for value in types], dtype=str),
+        "type": np.array(type_indexes, dtype=np.int32),
+        "rep_ids": np.array([json.dumps(value) for value in rep_ids], dtype=str),
+        "current_rep_id": np.array([next(rep_indexes) if "current_rep_id" in event else -1 for event in events], dtype=np.int32),
+        "flags": np.zeros(len(events), dtype=np.uint8)
+    }
+    for field in TIME_FIELDS:
+        present_flag, int_flag = TIME_FLAGS[field]
+        values = np.full(len(events), np.nan)
+        for index, event in enumerate(events):
+            value = event.get(field)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                if field in event:
+                    raise ValueError(f"Unsupported {field} value: {value!r}")
+                continue
+            values[index] = value
+            columns["flags"][index] |= present_flag | (int_flag if isinstance(value, int) else 0)
+        columns[field] = values
+
+    extra = [{key: value for key, value in event.items() if key not in COLUMN_FIELDS} for event in events]
+    if any(extra):
+        columns["extra"] = np.frombuffer(json.dumps(extra, separators=(",", ":")).encode(), dtype=np.uint8)
+    return columns
+
+def from_columns(columns):
+    # Inverse of to_columns
+    types = [json.loads(value) for value in columns["types"].tolist()]
+    rep_ids = [json.loads(value) for value in columns["rep_ids"].tolist()]
+    extra = json.loads(columns["extra"].tobytes()) if "extra" in columns else None
+    flags = columns["flags"].tolist()
+    times = {field: columns[field].tolist() for field in TIME_FIELDS}
+
+    events = []
+    for index, (type_index, rep_index) in enumerate(zip(columns["type"].tolist(), columns["current_rep_id"].tolist())):
+        event = {"type": types[type_index]}
+        for field in TIME_FIELDS:
+            present_flag, int_flag = TIME_FLAGS[field]
+            if flags[index] & present_flag:
+                value = times[field][index]
+                event[field] = int(value) if flags[index] & int_flag else value
+        if rep_index >= 0:
+            event["current_rep_id"] = rep_ids[rep_index]
+        if extra is not None:
+            event.update(extra[index])
+        events.append(event)
+    return events
+
+def save_events(id, events):
+    # Writes the events of a session, replacing the previous ones
+    path = get_events_path(id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as events_file:
+        np.savez_compressed(events_file, **to_columns(events))
+    instrumentation.json_bytes.inc(os.path.getsize(tmp_path), kind="events_written")
+    os.replace(tmp_path, path)
+
+def load_columns(id):
+    """
+    Columns of the events of a session, for readers that work on whole arrays
+
+    Returns:
+        dict -- {column name: numpy array}, see to_columns. Values of types and rep_ids are JSON encoded.
+    """
+    path = get_events_path(id)
+    if not os.path.exists(path):
+        with open(get_json_path(id), "r") as json_file:
+            json_text = json_file.read()
+        instrumentation.json_bytes.inc(len(json_text), kind="events_read")
+        return to_columns(json.loads(json_text))
+    instrumentation.json_bytes.inc(os.path.getsize(path), kind="events_read")
+    with np.load(path, allow_pickle=False) as archive:
+        return {name: archive[name] for name in archive.files}
+
+def load_events(id):
+    # Events of a session as a list of dicts, in the order they were sent
+    path = get_events_path(id)
+    if not os.path.exists(path):
+        with open(get_json_path(id), "r") as json_file:
+            json_text = json_file.read()
+        instrumentation.json_bytes.inc(len(json_text), kind="events_read")
+        return json.loads(json_text)
+    return from_columns(load_columns(id))
+
+
+# Migration
+
+def migrate(archive_directory=None):
+    """
+    Convert every <id>-metric.json session to the columnar format
+
+    Arguments:
+        archive_directory {str} -- if given, the converted JSON files are moved into one
+                                   .tar.gz archive in this folder instead of being deleted
+
+    Returns:
+        tuple -- (converted sessions, sessions that failed)
+    """
+    converted = []
+    failed = []
+    for entry in sorted(os.listdir(METRICS_DIR), key=lambda name: (len(name), name)):
+        json_path = get_json_path(entry)
+        if not entry.isdigit() or not os.path.exists(json_path):
+            continue
+        try:
+            with open(json_path, "r") as json_file:
+                events = json.loads(json_file.read())
+            save_events(entry, events)
+            if load_events(entry) != events:
+                raise ValueError("Events changed after conversion")
+            converted.append(entry)
+        except Exception as e:
+            print(f"Could not convert session {entry}: {e}")
+            if os.path.exists(get_events_path(entry)):
+                os.remove(get_events_path(entry))
+            failed.append(entry)
+
+    if converted and archive_directory is not None:
+        os.makedirs(archive_directory, exist_ok=True)
+        archive_path = os.path.join(
+            archive_directory, f"metric-json-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.tar.gz"
+        )
+        with tarfile.open(archive_path, "w:gz") as archive:
+            for entry in converted:
+                archive.add(get_json_path(entry), arcname=f"{entry}/{entry}-metric.json")
+        print(f"Archived {len(converted)} JSON files in {archive_path}")
+
+    for entry in converted:
+        os.remove(get_json_path(entry))
+    return converted, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session event storage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="convert <id>-metric.json sessions to the columnar format")
+    migrate_parser.add_argument("--archive", type=str, help="folder where the JSON files are archived")
+    migrate_parser.add_argument("--no-archive", action="store_true", help="delete the JSON files without archiving them")
+    argsdict = vars(parser.parse_args())
+
+    if argsdict["command"] == "migrate":
+        archive_directory = None if argsdict["no_archive"] else (argsdict["archive"] or os.path.join("video_db", "metrics_archive"))
+        converted, failed = migrate(archive_directory)
+        print(f"Converted {len(converted)} sessions, {len(failed)} failed")
+
+
+if __name__ == "__main__":
+    main()
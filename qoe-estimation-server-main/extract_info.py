@@ -11,6 +11,8 @@ from os.path import expanduser
 import itu_p1203
 from itu_p1203 import log, utils, errors, extractor, p1203_standalone
 
+import qp_store
+
 
 logger = log.setup_custom_logger("itu_p1203")
 
@@ -97,6 +99,76 @@ def extract_from_single_file(
     return input_report
 
 
+def merge_input_reports(input_reports):
+    """
+    Join the input reports of consecutive chunks of a video file into the report
+    of the whole file
+
+    Arguments:
+        input_reports {list} -- input reports of the chunks, in playback order
+
+    Returns:
+        dict -- input report with a single I13 segment holding the frames of all chunks
+    """
+    merged = json.loads(json.dumps(input_reports[0]))
+    video_segment = merged["I13"]["segments"][0]
+    audio_segments = merged.get("I11", {}).get("segments", [])
+    offset = video_segment["duration"]
+
+    for input_report in input_reports[1:]:
+        chunk_segment = input_report["I13"]["segments"][0]
+        video_segment["frames"].extend(chunk_segment["frames"])
+        video_segment["duration"] += chunk_segment["duration"]
+        for audio_segment in input_report.get("I11", {}).get("segments", []):
+            audio_segments.append(dict(audio_segment, start=audio_segment["start"] + offset))
+        offset += chunk_segment["duration"]
+
+    return merged
+
+
+def save_input_report(input_report, video_file, output_directory, mode=3):
+    """
+    Add the bitrate of the video file to its input report and save the report
+    in the frame-indexed format of qp_store, in the <video name> folder of the
+    output directory. Reports that can not be stored that way are saved as
+    <video name>.json
+
+    Arguments:
+        input_report {dict} -- input report returned by extract_from_single_file
+        video_file {str} -- video file the input report was extracted from
+        output_directory {str} -- folder where the report is saved
+        mode {int} -- extraction mode used
+
+    Returns:
+        str -- path of the saved report
+    """
+    # Same value as the bit_rate of ffprobe (file size over duration, in bit/s), without
+    # probing the file again. The duration of merged chunk reports is the sum of the chunks.
+    video_segment = input_report["I13"]["segments"][0]
+    if video_segment["duration"] > 0:
+        video_segment["bitrate"] = str(round(os.path.getsize(video_file) * 8 / video_segment["duration"]))
+    else:
+        video_segment["bitrate"] = extractor.Extractor([video_file], mode).get_format_info(video_file)["bit_rate"]
+
+    video_name = os.path.splitext(os.path.basename(video_file))[0]
+    output_path = os.path.join(output_directory, video_name)
+    json_output_path = os.path.join(output_directory, f"{video_name}.json")
+
+    try:
+        qp_store.write_rendition(output_path, input_report)
+    except ValueError as e:
+        logger.warning("Saving {} as JSON: {}".format(video_name, e))
+        with open(json_output_path, "w") as file_output:
+            file_output.write(json.dumps(input_report, indent=None, sort_keys=True))
+        return json_output_path
+
+    # Remove the report of a previous extraction in the old format
+    if os.path.exists(json_output_path):
+        os.remove(json_output_path)
+
+    return output_path
+
+
 def main(modules={}, quiet=False):
     """
     Runs standalone P.1203 version from the command-line.
@@ -285,19 +357,8 @@ def main(modules={}, quiet=False):
     current_id = argsdict["id"]
     output_directory = os.path.join("video_db", "videos", str(current_id), "extracted_qp")
 
-    temp_extractor = extractor.Extractor(argsdict["input"], argsdict["mode"])
-
     for i, single_result in enumerate(output_results):
-
-        video_file = argsdict["input"][i]
-        video_info = temp_extractor.get_format_info(video_file)
-        bitrate = video_info["bit_rate"]
-        single_result["I13"]["segments"][0]["bitrate"] = bitrate
-
-        video_name = os.path.splitext(os.path.basename(video_file))[0]
-
-        with open(os.path.join(output_directory, f"{video_name}.json"), "w") as file_output:
-            file_output.write(json.dumps(single_result, indent=None, sort_keys=True))
+        save_input_report(single_result, argsdict["input"][i], output_directory, argsdict["mode"])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
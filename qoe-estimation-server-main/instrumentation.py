@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+
+
+# Counters and latency histograms of the pipeline, exported in the Prometheus text
+# format by the /metrics-export endpoint, and optional per-session traces.
+#
+# With QOE_TRACE_SESSIONS=1, the spans of every session (queue wait and run time of
+# its jobs, bytes read, P.1203 time...) are saved in video_db/metrics/<id>/<id>-trace.json
+# next to its result.
+
+TRACE_SESSIONS = os.environ.get("QOE_TRACE_SESSIONS", "0") == "1"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def export(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.lock = threading.Lock()
+        self.values = {}    # {label values: [bucket counts, sum, count]}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def export(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels, key, [("le", format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Timer:
+    # Context manager that observes the time spent inside it
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        # collector() returns [(name, help, [(labels dict, value), ...]), ...], exported as gauges
+        with self.lock:
+            self.collectors.append(collector)
+
+    def export(self):
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.export()
+        for collector in collectors:
+            for name, help, samples in collector():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(list(labels), list(labels.values()))} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+db_seconds = registry.histogram("qoe_db_seconds", "Time of database reads and write transactions", ["operation"])
+json_bytes = registry.counter("qoe_json_bytes_total", "Bytes of session files read and written", ["kind"])
+session_seconds = registry.histogram("qoe_session_seconds", "Time from the upload of a session to its MOS result")
+
+
+# Session traces
+
+_sessions_lock = threading.Lock()
+_sessions = {}      # {metric id: {"start": monotonic time, "spans": [...]}}
+
+
+def session_started(metrics_id):
+    with _sessions_lock:
+        _sessions[metrics_id] = {"start": time.monotonic(), "spans": []}
+
+def trace(metrics_id, span, **fields):
+    # Adds a span to the trace of a session that is being processed
+    with _sessions_lock:
+        session = _sessions.get(metrics_id)
+        if session is not None:
+            session["spans"].append({"span": span, "at": round(time.monotonic() - session["start"], 6), **fields})
+
+def session_finished(metrics_id, trace_path):
+    # Observes the time to MOS of the session and saves its trace if traces are enabled
+    with _sessions_lock:
+        session = _sessions.pop(metrics_id, None)
+    if session is None:
+        return
+    elapsed = time.monotonic() - session["start"]
+    session_seconds.observe(elapsed)
+    if TRACE_SESSIONS:
+        with open(trace_path, "w") as trace_file:
+            trace_file.write(json.dumps({"metric_id": metrics_id, "seconds": elapsed, "spans": session["spans"]}))
+
+def session_failed(metrics_id):
+    with _sessions_lock:
+        _sessions.pop(metrics_id, None)
@@ -0,0 +1,256 @@
+import json
+import os
+import socket
+import time
+import traceback
+
+import database
+
+
+# Job queue in the jobs table of the database, used instead of the in-process
+# scheduler when the API node and the workers are separate processes (QOE_JOB_QUEUE=sqlite).
+#
+# A job is claimed inside a write transaction, so two workers never get the same job.
+# A claimed job has a lease that its worker renews while it runs. If the worker dies,
+# the lease expires and the job is claimed again by another worker, up to MAX_ATTEMPTS
+# times. Dependencies work like in the scheduler: a job is only claimed once the jobs
+# it depends on are done (or do not exist), and fails when one of them fails.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+LEASE_SECONDS = float(os.environ.get("QOE_JOB_LEASE_SECONDS", 60))
+MAX_ATTEMPTS = int(os.environ.get("QOE_JOB_MAX_ATTEMPTS", 3))
+
+
+def encode_key(key):
+    return json.dumps(list(key) if isinstance(key, tuple) else key, separators=(",", ":"))
+
+def decode_key(encoded):
+    key = json.loads(encoded)
+    return tuple(key) if isinstance(key, list) else key
+
+def decode_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["key"] = decode_key(job["key"])
+    job["args"] = json.loads(job["args"])
+    job["deps"] = [tuple(dep) if isinstance(dep, list) else dep for dep in json.loads(job["deps"])]
+    return job
+
+def get_owner():
+    # Worker id: host and process
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue(key, stage, function, args, deps=()):
+    """
+    Add a job, unless a job with the same key is queued or running
+
+    Arguments:
+        key {hashable} -- unique job key (tuples are stored as JSON lists)
+        stage {str} -- stage of the workers that run it
+        function {str} -- name of the job function, see worker.JOB_FUNCTIONS
+        args {list} -- JSON serializable arguments
+        deps {iterable} -- keys of the jobs that have to be done first
+    """
+    now = time.time()
+    encoded_deps = [encode_key(dep) for dep in deps]
+    with database.transaction() as conn:
+        # A finished job with the same key is replaced, like the scheduler does
+        added = conn.execute(
+            "INSERT INTO jobs (key, stage, function, args, deps, state, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET stage = excluded.stage, function = excluded.function, args = excluded.args, "
+            "deps = excluded.deps, state = excluded.state, owner = NULL, lease_until = NULL, attempts = 0, error = NULL, "
+            "created = excluded.created, updated = excluded.updated WHERE jobs.state IN (?, ?)",
+            (encode_key(key), stage, function, json.dumps(args), json.dumps(encoded_deps),
+             QUEUED, now, now, DONE, FAILED)
+        ).rowcount > 0
+        # Failures are passed on when they happen, a job added after one of its dependencies failed fails now
+        if added and encoded_deps and conn.execute(
+            f"SELECT 1 FROM jobs WHERE key IN ({','.join('?' * len(encoded_deps))}) AND state = ? LIMIT 1",
+            (*encoded_deps, FAILED)
+        ).fetchone() is not None:
+            set_failed(conn, encode_key(key), "A dependency failed", now)
+
+def claim(stages, owner, key=None):
+    """
+    Take the oldest job of the given stages whose dependencies are done
+
+    Arguments:
+        stages {list} -- stages this worker runs
+        owner {str} -- worker id
+        key {hashable} -- only claim this job
+
+    Returns:
+        dict -- the claimed job, or None if there is no job ready
+    """
+    now = time.time()
+    # Dependencies are checked by SQLite, so the write lock is only held for one query
+    query = (
+        f"SELECT * FROM jobs WHERE stage IN ({','.join('?' * len(stages))}) "
+        "AND (state = ? OR (state = ? AND lease_until < ?)) "
+        "AND NOT EXISTS (SELECT 1 FROM json_each(jobs.deps) AS dep JOIN jobs AS dep_job ON dep_job.key = dep.value "
+        "WHERE dep_job.state != ?)"
+    )
+    params = [*stages, QUEUED, RUNNING, now, DONE]
+    if key is not None:
+        query += " AND key = ?"
+        params.append(encode_key(key))
+    query += " ORDER BY created LIMIT 1"
+
+    with database.transaction() as conn:
+        while True:
+            row = conn.execute(query, params).fetchone()
+            if row is None:
+                return None
+            if row["state"] == RUNNING:
+                # The worker that had it stopped renewing its lease
+                print(f"Job {row['key']} of {row['owner']} expired, attempt {row['attempts'] + 1}")
+                if row["attempts"] >= MAX_ATTEMPTS:
+                    set_failed(conn, row["key"], f"Abandoned {row['attempts']} times", now)
+                    continue
+
+            conn.execute(
+                "UPDATE jobs SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE key = ?",
+                (RUNNING, owner, now + LEASE_SECONDS, now, row["key"])
+            )
+            return decode_job(conn.execute("SELECT * FROM jobs WHERE key = ?", (row["key"],)).fetchone())
+
+def set_failed(conn, key, error, now):
+    conn.execute(
+        "UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL, error = ?, updated = ? WHERE key = ?",
+        (FAILED, error, now, key)
+    )
+    fail_dependents(conn, [key], now)
+
+def fail_dependents(conn, keys, now):
+    # Queued jobs that depend on failed jobs fail too, down the whole chain, like in the scheduler
+    while keys:
+        dependents = [row["key"] for row in conn.execute(
+            f"SELECT DISTINCT jobs.key FROM jobs, json_each(jobs.deps) AS dep "
+            f"WHERE jobs.state = ? AND dep.value IN ({','.join('?' * len(keys))})",
+            (QUEUED, *keys)
+        )]
+        conn.executemany(
+            "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE key = ?",
+            [(FAILED, "A dependency failed", now, dependent) for dependent in dependents]
+        )
+        keys = dependents
+
+def complete(key, owner):
+    # Returns False if the lease was lost and the job belongs to another worker now
+    with database.transaction() as conn:
+        return conn.execute(
+            "UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL, updated = ? WHERE key = ? AND owner = ? AND state = ?",
+            (DONE, time.time(), encode_key(key), owner, RUNNING)
+        ).rowcount > 0
+
+def fail(key, owner, error):
+    now = time.time()
+    with database.transaction() as conn:
+        failed = conn.execute(
+            "UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL, error = ?, updated = ? "
+            "WHERE key = ? AND owner = ? AND state = ?",
+            (FAILED, error, now, encode_key(key), owner, RUNNING)
+        ).rowcount > 0
+        if failed:
+            fail_dependents(conn, [encode_key(key)], now)
+        return failed
+
+def renew(owner):
+    # Extends the leases of all the running jobs of a worker
+    with database.transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND state = ?",
+            (time.time() + LEASE_SECONDS, owner, RUNNING)
+        )
+
+def requeue_expired():
+    """
+    Queue again the running jobs whose lease expired, e.g. after the workers were restarted.
+    Jobs abandoned MAX_ATTEMPTS times fail instead.
+
+    Returns:
+        int -- number of jobs queued again
+    """
+    now = time.time()
+    with database.transaction() as conn:
+        rows = conn.execute(
+            "SELECT key, attempts FROM jobs WHERE state = ? AND lease_until < ?", (RUNNING, now)
+        ).fetchall()
+        requeued = 0
+        for row in rows:
+            if row["attempts"] >= MAX_ATTEMPTS:
+                set_failed(conn, row["key"], f"Abandoned {row['attempts']} times", now)
+                continue
+            conn.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL, updated = ? WHERE key = ?",
+                (QUEUED, now, row["key"])
+            )
+            requeued += 1
+        return requeued
+
+def running_keys(stage):
+    # Keys of the jobs of a stage that a worker is running (with a lease that has not expired)
+    rows = database.get_connection().execute(
+        "SELECT key FROM jobs WHERE stage = ? AND state = ? AND lease_until >= ?", (stage, RUNNING, time.time())
+    ).fetchall()
+    return [decode_key(row["key"]) for row in rows]
+
+def run(job, functions):
+    """
+    Run a claimed job in this process and record its outcome
+
+    Arguments:
+        job {dict} -- job returned by claim
+        functions {dict} -- {function name: function}
+
+    Returns:
+        bool -- True if the job succeeded
+    """
+    try:
+        functions[job["function"]](*job["args"])
+    except Exception:
+        print(f"Job {job['key']} failed:")
+        traceback.print_exc()
+        fail(job["key"], job["owner"], traceback.format_exc())
+        return False
+    if not complete(job["key"], job["owner"]):
+        print(f"Job {job['key']} finished after its lease expired")
+    return True
+
+def wait(key, poll_interval=1.0):
+    # Waits for a job run by another worker, returns True if it succeeded
+    while True:
+        job = get(key)
+        if job is None or job["state"] == DONE:
+            return True
+        if job["state"] == FAILED:
+            return False
+        time.sleep(poll_interval)
+
+def get(key):
+    return decode_job(database.fetch_one("SELECT * FROM jobs WHERE key = ?", (encode_key(key),)))
+
+def finished_since(timestamp):
+    # Jobs done or failed after the given time, oldest first
+    rows = database.get_connection().execute(
+        "SELECT * FROM jobs WHERE updated > ? AND state IN (?, ?) ORDER BY updated", (timestamp, DONE, FAILED)
+    ).fetchall()
+    return [decode_job(row) for row in rows]
+
+def purge(older_than):
+    # Deletes finished jobs not updated in the last older_than seconds
+    with database.transaction() as conn:
+        return conn.execute(
+            "DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?", (DONE, FAILED, time.time() - older_than)
+        ).rowcount
+
+def stats():
+    stats = {}
+    for row in database.get_connection().execute("SELECT stage, state, COUNT(*) AS count FROM jobs GROUP BY stage, state"):
+        stats.setdefault(row["stage"], {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0})[row["state"]] = row["count"]
+    return stats
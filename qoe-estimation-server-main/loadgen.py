@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import io
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+import socketio
+
+import benchmark
+import dash_downloader
+import swarm_logs
+
+
+# Load generator: thousands of virtual players replaying media sessions against a running
+# QoE server, to reproduce production load on /mpd, /metrics and /result:
+#
+#   python loadgen.py http://localhost:5000 --players 2000 --traces ../resultados_despliegue/3_test
+#   python loadgen.py http://qoe:5000 --media-host 10.0.0.5 --videos 4 --mode stream --wait socket
+#
+# Every player posts its MPD URL to /mpd, sends its session (all at once to /metrics, or in
+# chunks through /session at --speed times real time) and waits for its MOS by polling
+# /result or through the "result" Socket.IO event. Sessions are replayed from the peer logs
+# of swarm deployment runs (--traces) or generated like in benchmark.py.
+#
+# The MPDs are served by a local stand-in server: the ladder of --media (a folder with a
+# manifest.mpd, e.g. the work folder of benchmark.py --keep), or a ladder encoded with ffmpeg.
+# Video k is served at /v<k>/manifest.mpd. These URLs are mirrors of one video for the server,
+# which stores it once; with --distinct-videos the bandwidths of video k are shifted by k bit/s,
+# so the server sees --videos different videos. --mpd-url uses existing MPDs instead.
+#
+# HTTP requests go through an aiohttp session with --connections keep-alive connections. The
+# report has the throughput, the latency of every endpoint, the time to MOS (from the end of
+# the upload to the result) and the time of the whole session (from the /mpd request to the result).
+
+# Segment number in the URLs of the peer logs (.../video/avc1/<quality>/seg-<number>.m4s)
+SEGMENT_PATTERN = re.compile(r"seg-(\d+)\.")
+
+
+# Sessions
+
+def load_traces(run_directories):
+    """
+    Video segment downloads of every peer of some swarm deployment runs
+
+    Returns:
+        list -- [(timestamp in ms, quality, segment number), ...] of every peer, by time
+    """
+    traces = []
+    for run_directory in run_directories:
+        logs, _ = swarm_logs.find_peer_logs(run_directory)
+        for peer_id, paths in sorted(logs.items()):
+            columns, urls, _ = swarm_logs.read_columns(paths)
+            url_info = [(swarm_logs.get_quality(url), SEGMENT_PATTERN.search(url)) for url in urls]
+            downloads = {}
+            for timestamp, url in zip(columns["timestamp"].tolist(), columns["url"].tolist()):
+                quality, segment = url_info[url]
+                if quality and segment:
+                    # The first download of every segment, other copies come from retries
+                    number = int(segment.group(1))
+                    if number not in downloads or timestamp < downloads[number][0]:
+                        downloads[number] = (timestamp, quality, number)
+            if downloads:
+                traces.append(sorted(downloads.values()))
+    return traces
+
+def trace_session(downloads, rep_ids, duration, segment_seconds, startup_segments=2):
+    """
+    Player events of a peer trace
+
+    The player starts once its first startup_segments segments have arrived and plays segment
+    k (counted from the first one) at start + k * segment_seconds plus the stalls so far; a
+    segment that arrives later stalls the playback until then. Qualities are mapped to the
+    representations from the lowest bandwidth up.
+
+    Arguments:
+        downloads {list} -- (timestamp in ms, quality, segment number) of the trace, by time
+        rep_ids {list} -- representation ids of the video, from the lowest to the highest bandwidth
+        duration {float} -- length of the video, the session is cut there
+        segment_seconds {float} -- length of the segments of the trace
+        startup_segments {int} -- segments buffered before the playback starts
+
+    Returns:
+        list -- events in the format sent by the player
+    """
+    first_number = min(number for _, _, number in downloads)
+    arrivals = {}
+    for timestamp, quality, number in downloads:
+        arrivals.setdefault(number - first_number, (timestamp, rep_ids[min(quality, len(rep_ids)) - 1]))
+
+    start_time = max(arrivals[index][0] for index in range(startup_segments) if index in arrivals)
+    rep_id = arrivals[0][1]
+    events = [{"type": "playback_started", "media_time": 0, "clock_time": start_time, "current_rep_id": rep_id}]
+    stalled = 0
+    index = 0
+    while (index + 1) * segment_seconds <= duration and index in arrivals:
+        arrival, segment_rep_id = arrivals[index]
+        media_time = index * segment_seconds
+        deadline = start_time + int(media_time * 1000) + stalled
+        if arrival > deadline:
+            events.append({"type": "stall_ini", "media_time": media_time, "clock_time": deadline})
+            events.append({"type": "stall_end", "media_time": media_time, "clock_time": arrival})
+            stalled += arrival - deadline
+        if segment_rep_id != rep_id:
+            rep_id = segment_rep_id
+            events.append({"type": "quality_change", "media_time": media_time,
+                           "clock_time": max(arrival, deadline), "current_rep_id": rep_id})
+        index += 1
+
+    media_time = max(index, 1) * segment_seconds
+    events.append({"type": "playback_ended", "media_time": media_time,
+                   "clock_time": start_time + int(media_time * 1000) + stalled})
+    return events
+
+
+# Stand-in media server
+
+class MediaHandler(SimpleHTTPRequestHandler):
+    # /v<k>/<file> serves <file> of the media folder, and the MPD with its bandwidths shifted by k
+    # when the server has distinct_videos set
+    def do_GET(self):
+        match = re.fullmatch(r"/v(\d+)/(.+)", urlparse(self.path).path)
+        if match is None:
+            self.send_error(404)
+            return
+        video, name = int(match.group(1)), match.group(2)
+        if not name.endswith(".mpd"):
+            self.path = "/" + name
+            super().do_GET()
+            return
+        try:
+            with open(os.path.join(self.directory, name), "r") as mpd_file:
+                mpd = mpd_file.read()
+        except OSError:
+            self.send_error(404)
+            return
+        if self.server.distinct_videos:
+            mpd = re.sub(r'bandwidth="(\d+)"', lambda bandwidth: f'bandwidth="{int(bandwidth.group(1)) + video}"', mpd)
+        content = mpd.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dash+xml")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_media(directory, host, distinct_videos=False):
+    # Stand-in MPD and segment server, returns (server, base URL)
+    handler = functools.partial(MediaHandler, directory=directory)
+    server = ThreadingHTTPServer((host, 0), handler)
+    server.daemon_threads = True
+    server.distinct_videos = distinct_videos
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/"
+
+def get_video_info(mpd_url, default_duration):
+    # (representation ids from the lowest to the highest bandwidth, length) of an MPD
+    response = requests.get(mpd_url)
+    response.raise_for_status()
+    representations = dash_downloader.get_representations(io.BytesIO(response.content), mpd_url)
+    presentation_duration = ET.fromstring(response.content).get("mediaPresentationDuration")
+    duration = dash_downloader.parse_duration(presentation_duration) if presentation_duration else default_duration
+    return [rep["id"] for rep in reversed(representations)], duration
+
+
+# HTTP client
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to one server, shared by all the players. Must be created
+    inside the event loop.
+
+    Arguments:
+        url {str} -- base URL of the server
+        size {int} -- maximum number of open connections
+    """
+    def __init__(self, url, size):
+        self.url = url.rstrip("/")
+        self.opened = 0
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.count_connection)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=size), trace_configs=[trace_config])
+
+    async def count_connection(self, session, context, params):
+        self.opened += 1
+
+    async def request(self, method, path, body=None):
+        """
+        Send a request with a JSON body
+
+        Returns:
+            tuple -- (status code, decoded JSON body or None)
+        """
+        async with self.session.request(method, self.url + path, json=body) as response:
+            content = await response.read()
+            if content and response.content_type == "application/json":
+                return response.status, json.loads(content)
+            return response.status, None
+
+    async def close(self):
+        await self.session.close()
+
+
+# Players
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}         # {endpoint: [seconds]}
+        self.time_to_mos = []
+        self.session_time = []
+        self.errors = {}
+
+    def add_latency(self, endpoint, seconds):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+
+    def add_error(self, error):
+        self.errors[error] = self.errors.get(error, 0) + 1
+
+async def timed_request(pool, stats, endpoint, method, path, body=None):
+    start = time.perf_counter()
+    status, content = await pool.request(method, path, body)
+    stats.add_latency(endpoint, time.perf_counter() - start)
+    if status != 200:
+        raise RuntimeError(f"{endpoint} returned {status}")
+    return content
+
+async def send_session(pool, stats, mpd_url, events, config):
+    # Sends the events of a session, returns its metric id
+    if config["mode"] == "post":
+        return (await timed_request(pool, stats, "/metrics", "POST", "/metrics", {"mpd_url": mpd_url, "metrics": events}))["metric_id"]
+
+    metrics_id = (await timed_request(pool, stats, "/session", "POST", "/session", {"mpd_url": mpd_url}))["metric_id"]
+    chunks = [events[index:index + config["chunk_events"]] for index in range(0, len(events), config["chunk_events"])]
+    start = time.perf_counter()
+    for chunk in chunks[:-1]:
+        if config["speed"] > 0:
+            # Each chunk is sent once the player has reached its last event
+            delay = (chunk[-1]["clock_time"] - events[0]["clock_time"]) / 1000 / config["speed"] - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await timed_request(pool, stats, "/session/events", "POST", f"/session/{metrics_id}/events", {"events": chunk})
+    await timed_request(pool, stats, "/session/end", "POST", f"/session/{metrics_id}/end", {"events": chunks[-1]})
+    return metrics_id
+
+async def poll_result(pool, stats, metrics_id, config):
+    while True:
+        content = await timed_request(pool, stats, "/result", "POST", "/result", {"metric_id": metrics_id})
+        if content["is_result_ready"]:
+            return content["result"]
+        await asyncio.sleep(config["poll_interval"])
+
+async def wait_result_event(server_url, metrics_id):
+    # The result event of the metric, through its own Socket.IO connection like a browser player
+    client = socketio.AsyncClient(reconnection=False)
+    result = asyncio.get_running_loop().create_future()
+
+    @client.on("result")
+    def on_result(data):
+        if data.get("metric_id") == metrics_id and not result.done():
+            result.set_result(data["result"])
+
+    await client.connect(server_url, transports=["websocket"])
+    try:
+        await client.emit("subscribe", {"metric_id": metrics_id})
+        return await result
+    finally:
+        await client.disconnect()
+
+async def play(pool, stats, mpd_url, events, config):
+    start = time.perf_counter()
+    try:
+        await timed_request(pool, stats, "/mpd", "POST", "/mpd", {"mpd_url": mpd_url})
+        metrics_id = await send_session(pool, stats, mpd_url, events, config)
+        uploaded = time.perf_counter()
+        if config["wait"] == "socket":
+            waiting = wait_result_event(config["server"], metrics_id)
+        else:
+            waiting = poll_result(pool, stats, metrics_id, config)
+        await asyncio.wait_for(waiting, config["timeout"])
+    except asyncio.TimeoutError:
+        stats.add_error("timeout")
+        return
+    except Exception as e:
+        stats.add_error(f"{type(e).__name__}: {e}")
+        return
+    end = time.perf_counter()
+    stats.time_to_mos.append(end - uploaded)
+    stats.session_time.append(end - start)
+
+async def run_players(players, config):
+    """
+    Run the virtual players, at most config["concurrency"] at the same time
+
+    Arguments:
+        players {list} -- (MPD URL, events) of every player
+        config {dict} -- options of the command line
+
+    Returns:
+        dict -- throughput, endpoint latencies, time to MOS and errors
+    """
+    pool = ConnectionPool(config["server"], config["connections"])
+    stats = Stats()
+    running = asyncio.Semaphore(config["concurrency"] or len(players))
+    start = time.perf_counter()
+
+    async def start_player(index, mpd_url, events):
+        # Players arrive evenly during the ramp-up
+        await asyncio.sleep(config["ramp"] * index / len(players))
+        async with running:
+            await play(pool, stats, mpd_url, events, config)
+            done = len(stats.session_time) + sum(stats.errors.values())
+            if done % config["report_every"] == 0:
+                print(f"{done}/{len(players)} players finished, {len(stats.session_time) / (time.perf_counter() - start):.1f} sessions/s")
+
+    try:
+        await asyncio.gather(*(start_player(index, mpd_url, events) for index, (mpd_url, events) in enumerate(players)))
+    finally:
+        await pool.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "elapsed_s": elapsed,
+        "players": len(players),
+        "completed": len(stats.session_time),
+        "sessions_per_s": len(stats.session_time) / elapsed,
+        "requests_per_s": sum(len(latencies) for latencies in stats.latencies.values()) / elapsed,
+        "connections_opened": pool.opened,
+        "endpoints": {endpoint: benchmark.summarize(latencies) for endpoint, latencies in stats.latencies.items()},
+        "time_to_mos": benchmark.summarize(stats.time_to_mos),
+        "session_time": benchmark.summarize(stats.session_time),
+        "errors": stats.errors
+    }
+
+def print_report(results):
+    print(f"{results['completed']}/{results['players']} sessions scored in {results['elapsed_s']:.1f} s: "
+          f"{results['sessions_per_s']:.1f} sessions/s, {results['requests_per_s']:.1f} requests/s, "
+          f"{results['connections_opened']} connections")
+    print(f"{'':<18}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+    rows = list(results["endpoints"].items()) + [("time to MOS", results["time_to_mos"]), ("session", results["session_time"])]
+    for name, stats in rows:
+        if stats["count"]:
+            print(f"{name:<18}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p99_ms']:>12.1f}{stats['max_ms']:>12.1f}")
+    for error, count in sorted(results["errors"].items(), key=lambda error: -error[1]):
+        print(f"{count} x {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Virtual players replaying media sessions against a QoE server")
+    parser.add_argument("server", type=str, help="URL of the QoE server (e.g. http://localhost:5000)")
+    parser.add_argument("--players", type=int, default=100, help="virtual players, one session each")
+    parser.add_argument("--concurrency", type=int, default=0, help="players running at the same time (default: all)")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which the players start")
+    parser.add_argument("--connections", type=int, default=64, help="keep-alive HTTP connections to the server")
+    parser.add_argument("--mode", choices=("post", "stream"), default="post", help="send sessions to /metrics or stream them through /session")
+    parser.add_argument("--chunk-events", type=int, default=4, help="events per request when streaming")
+    parser.add_argument("--speed", type=float, default=0, help="playback speed when streaming, 0 sends the chunks without waiting")
+    parser.add_argument("--wait", choices=("poll", "socket"), default="poll", help="wait for the MOS polling /result or with the Socket.IO event")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between /result requests")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a player waits for its MOS")
+    parser.add_argument("--traces", type=str, nargs="+", help="swarm deployment runs whose peers are replayed (resultados_despliegue/<run>)")
+    parser.add_argument("--trace-segment-seconds", type=float, default=4, help="segment length of the traces")
+    parser.add_argument("--trace-startup-segments", type=int, default=2, help="segments buffered before a replayed player starts")
+    parser.add_argument("--mpd-url", type=str, nargs="+", help="existing MPDs instead of the stand-in server")
+    parser.add_argument("--media", type=str, help="folder with a manifest.mpd and its segments (default: encode a ladder with ffmpeg)")
+    parser.add_argument("--media-host", type=str, default="127.0.0.1", help="address of the stand-in server, as seen by the QoE server")
+    parser.add_argument("--videos", type=int, default=1, help="MPD URLs served by the stand-in server")
+    parser.add_argument("--distinct-videos", action="store_true",
+                        help="change the bandwidths of every stand-in MPD, so the server does not store them as one video")
+    parser.add_argument("--ladder", type=str, default=benchmark.DEFAULT_LADDER, help="renditions encoded without --media")
+    parser.add_argument("--duration", type=int, default=60, help="video length in seconds")
+    parser.add_argument("--switch-rate", type=float, default=2, help="quality switches per minute of synthetic sessions")
+    parser.add_argument("--stall-rate", type=float, default=1, help="stalls per minute of synthetic sessions")
+    parser.add_argument("--stall-duration", type=float, default=2, help="mean stall length of synthetic sessions")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--report-every", type=int, default=100, help="players between progress lines")
+    parser.add_argument("--output", type=str, default="loadgen.json", help="JSON file with the results")
+    config = vars(parser.parse_args())
+    config["server"] = config["server"].rstrip("/")
+
+    media_server = None
+    work_directory = None
+    try:
+        if config["mpd_url"]:
+            mpd_urls = config["mpd_url"]
+        else:
+            media_directory = config["media"]
+            if media_directory is None:
+                work_directory = tempfile.mkdtemp(prefix="qoe-loadgen-")
+                print("Encoding the ladder")
+                media_directory = os.path.dirname(benchmark.generate_ladder(
+                    work_directory, benchmark.parse_ladder(config["ladder"]), config["duration"], 25, 4
+                ))
+            media_server, base_url = serve_media(os.path.abspath(media_directory), config["media_host"], config["distinct_videos"])
+            mpd_urls = [f"{base_url}v{video}/manifest.mpd" for video in range(config["videos"])]
+        videos = {mpd_url: get_video_info(mpd_url, config["duration"]) for mpd_url in mpd_urls}
+
+        generator = random.Random(config["seed"])
+        traces = load_traces(config["traces"]) if config["traces"] else []
+        if config["traces"] and not traces:
+            parser.error("No video segments found in the traces")
+        players = []
+        for index in range(config["players"]):
+            mpd_url = mpd_urls[index % len(mpd_urls)]
+            rep_ids, duration = videos[mpd_url]
+            if traces:
+                events = trace_session(generator.choice(traces), rep_ids, duration, config["trace_segment_seconds"],
+                                       config["trace_startup_segments"])
+            else:
+                events = benchmark.generate_session(duration, rep_ids, config["switch_rate"], config["stall_rate"],
+                                                    config["stall_duration"], config["seed"] + index)
+            players.append((mpd_url, events))
+        print(f"{len(players)} players on {len(mpd_urls)} videos, sessions from {'traces' if traces else 'the generator'}")
+
+        results = asyncio.run(run_players(players, config))
+    finally:
+        if media_server is not None:
+            media_server.shutdown()
+        if work_directory is not None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    print_report(results)
+    results.update({"date": datetime.datetime.now().isoformat(), "commit": benchmark.get_git_commit(), "config": config})
+    with open(config["output"], "w") as output_file:
+        output_file.write(json.dumps(results, indent=2))
+    print(f"Results saved in {config['output']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import database
+
+
+# Content-addressed cache of P.1203 results. Sessions of the same video with the same
+# quality segments and stalls get the same input, and therefore the same result, so
+# the key is computed from that compact description before any frame is loaded.
+# Entries live in the mos_cache table and the least recently used ones are deleted
+# once there are more than MAX_ENTRIES.
+
+MAX_ENTRIES = int(os.environ.get("QOE_MOS_CACHE_ENTRIES", 10000))
+
+# Options the results were computed with. Changing them changes every key.
+MODEL_OPTIONS = {
+    "mode": 3,
+    "amendment_1_audiovisual": False,
+    "amendment_1_stalling": False,
+    "amendment_1_app_2": False
+}
+
+_counters_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def session_key(video_id, quality_segments, stalls, options=MODEL_OPTIONS):
+    """
+    Key of a media session
+
+    Arguments:
+        video_id {int} -- id of the video
+        quality_segments {list} -- [rendition name, start, end] of every quality segment
+        stalls {list} -- [media time, duration] of every stall
+        options {dict} -- P.1203 options
+    """
+    canonical = json.dumps([options, video_id, quality_segments, stalls], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def count(counter, amount=1):
+    with _counters_lock:
+        _counters[counter] += amount
+
+def get(key):
+    with database.transaction() as conn:
+        row = conn.execute("SELECT result FROM mos_cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE mos_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    if row is None:
+        count("misses")
+        return None
+    count("hits")
+    return json.loads(row["result"])
+
+def put(key, video_id, result):
+    with database.transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO mos_cache (key, video_id, result, last_used) VALUES (?, ?, ?, ?)",
+            (key, video_id, json.dumps(result), time.time())
+        )
+        excess = conn.execute("SELECT COUNT(*) FROM mos_cache").fetchone()[0] - MAX_ENTRIES
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM mos_cache WHERE key IN (SELECT key FROM mos_cache ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+            count("evictions", excess)
+
+def invalidate(video_id):
+    # Results computed with the QP values of a video that is extracted again are not valid anymore
+    with database.transaction() as conn:
+        conn.execute("DELETE FROM mos_cache WHERE video_id = ?", (video_id,))
+
+def stats():
+    entries = database.get_connection().execute("SELECT COUNT(*) FROM mos_cache").fetchone()[0]
+    with _counters_lock:
+        return {"entries": entries, "max_entries": MAX_ENTRIES, **_counters}
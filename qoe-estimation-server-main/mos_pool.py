@@ -0,0 +1,69 @@
+import json
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from itu_p1203 import P1203Standalone
+
+
+# Process pool for P.1203 MOS computations. Workers are spawned (not forked) so they
+# only import this module, and not the Flask app with its threads and sockets.
+
+POOL_SIZE = int(os.environ.get("QOE_MOS_PROCESSES", os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def calculate_from_file(json_input_file_path, options=None):
+    # Runs inside a worker process. options are keyword arguments of P1203Standalone
+    # (amendment_1_audiovisual, amendment_1_stalling...).
+    with open(json_input_file_path, 'r') as file_input:
+        input_json = json.loads(file_input.read())
+    return P1203Standalone(input_json, **(options or {})).calculate_complete()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def discard_pool(pool):
+    # A worker died (e.g. killed by the OOM killer); the executor is unusable after that
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def submit(json_input_file_path, options=None):
+    # Future of the result, for callers that compute many sessions at once
+    pool = get_pool()
+    try:
+        future = pool.submit(calculate_from_file, json_input_file_path, options)
+    except BrokenProcessPool:
+        discard_pool(pool)
+        raise
+    future.add_done_callback(
+        lambda future: discard_pool(pool) if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool) else None
+    )
+    return future
+
+def calculate_complete(json_input_file_path, options=None):
+    pool = get_pool()
+    try:
+        return pool.submit(calculate_from_file, json_input_file_path, options).result()
+    except BrokenProcessPool:
+        discard_pool(pool)
+        raise
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
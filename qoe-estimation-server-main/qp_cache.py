@@ -0,0 +1,95 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+import qp_store
+
+
+# Process-wide cache of opened renditions, shared by every session that is built.
+# Entries are keyed by (video id, rendition name) and evicted in LRU order once
+# their total size goes over the byte budget. An entry is opened again when the
+# files of its rendition were replaced, e.g. extracted again by a worker process.
+
+MAX_BYTES = int(os.environ.get("QOE_QP_CACHE_BYTES", 512 * 1024 * 1024))
+
+
+class RenditionCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, video_id, name, qp_path):
+        key = (video_id, name)
+        version = get_version(qp_path, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self.size -= self.entries.pop(key)[0].nbytes
+            self.misses += 1
+
+        # Open outside the lock, other sessions can keep using the cache meanwhile
+        rendition = qp_store.open_rendition(qp_path, name)
+
+        with self.lock:
+            if key in self.entries or rendition.nbytes > self.max_bytes:
+                return rendition
+            self.entries[key] = (rendition, version)
+            self.size += rendition.nbytes
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+        return rendition
+
+    def invalidate(self, video_id):
+        # Drops every rendition of a video, e.g. before it is extracted again
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == video_id]:
+                self.size -= self.entries.pop(key)[0].nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+def get_version(qp_path, name):
+    # Inode and modification time of the rendition folder (or JSON file), which a new
+    # extraction replaces. None if the rendition is not stored.
+    path = os.path.join(qp_path, name)
+    if not os.path.isdir(path):
+        path = os.path.join(qp_path, f"{name}.json")
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+cache = RenditionCache(MAX_BYTES)
+
+
+def get_rendition(video_id, name, qp_path):
+    return cache.get(video_id, name, qp_path)
+
+def invalidate(video_id):
+    cache.invalidate(video_id)
+
+def stats():
+    return cache.stats()
@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import dash_downloader
+import extract_info
+import instrumentation
+
+
+# QP extraction service. A long-lived pool of spawned workers runs
+# extract_info.extract_from_single_file directly, without starting a new
+# interpreter per rendition. All renditions of all videos share one queue, so a
+# worker that finishes picks up the next job, whatever video it belongs to.
+#
+# Renditions whose DASH segments were kept by the downloader are split into chunks
+# of SEGMENTS_PER_CHUNK segments, so a single rendition is extracted by all the
+# workers at once. The reports of the chunks are joined in order afterwards.
+
+POOL_SIZE = int(os.environ.get("QOE_EXTRACT_PROCESSES", os.cpu_count() or 1))
+SEGMENTS_PER_CHUNK = int(os.environ.get("QOE_EXTRACT_SEGMENTS_PER_CHUNK", 4))
+EXTRACTION_MODE = 3
+
+extraction_seconds = instrumentation.registry.histogram(
+    "qoe_extraction_seconds", "QP extraction time of each rendition and of each chunk of segments", ["kind"]
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def extract_rendition(video_file, output_directory, mode=EXTRACTION_MODE):
+    # Runs inside a worker process. Errors are returned, not raised, so the caller
+    # always gets one result per rendition.
+    start = time.perf_counter()
+    try:
+        input_report = extract_info.extract_from_single_file(video_file, mode, quiet=True)
+        output_path = extract_info.save_input_report(input_report, video_file, output_directory, mode)
+    except Exception as e:
+        return {"file": video_file, "ok": False, "error": f"{e}\n{traceback.format_exc()}"}
+    return {"file": video_file, "ok": True, "output": output_path, "seconds": time.perf_counter() - start}
+
+def extract_chunk(init_file, segment_files, mode=EXTRACTION_MODE):
+    # Runs inside a worker process. The initialization segment followed by media segments
+    # is a valid fragmented MP4, extracted like a whole rendition.
+    start = time.perf_counter()
+    chunk_directory = tempfile.mkdtemp(prefix="qoe-chunk-")
+    try:
+        chunk_file = os.path.join(chunk_directory, "chunk.mp4")
+        dash_downloader.merge_segments(([init_file] if init_file else []) + segment_files, chunk_file)
+        return extract_info.extract_from_single_file(chunk_file, mode, quiet=True), time.perf_counter() - start
+    finally:
+        shutil.rmtree(chunk_directory, ignore_errors=True)
+
+def get_chunks(video_file):
+    # [(init segment, [media segments]), ...] of a rendition, or [] if it has to be extracted whole
+    name = os.path.splitext(os.path.basename(video_file))[0]
+    init_file, segment_files = dash_downloader.get_segment_files(os.path.dirname(video_file), name)
+    if init_file is None or len(segment_files) <= SEGMENTS_PER_CHUNK:
+        return []
+    return [
+        (init_file, segment_files[start:start + SEGMENTS_PER_CHUNK])
+        for start in range(0, len(segment_files), SEGMENTS_PER_CHUNK)
+    ]
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def extract_video(video_files, output_directory, mode=EXTRACTION_MODE):
+    """
+    Extract the QP values of every rendition of a video
+
+    Arguments:
+        video_files {list} -- rendition files
+        output_directory {str} -- folder where the input reports are saved
+        mode {int} -- extraction mode
+
+    Returns:
+        list -- one {"file", "ok", "output"/"error", "seconds"} dict per rendition, in the same order.
+                "seconds" is the wall-clock extraction time of the rendition.
+    """
+    start = time.perf_counter()
+    pool = get_pool()
+
+    # Submit every chunk of every rendition before waiting, so all workers are busy
+    jobs = []
+    for video_file in video_files:
+        chunks = get_chunks(video_file)
+        if chunks:
+            jobs.append([pool.submit(extract_chunk, init_file, segment_files, mode) for init_file, segment_files in chunks])
+        else:
+            jobs.append(pool.submit(extract_rendition, video_file, output_directory, mode))
+
+    results = []
+    for video_file, job in zip(video_files, jobs):
+        try:
+            if not isinstance(job, list):
+                result = job.result()
+                if result["ok"]:
+                    extraction_seconds.observe(result["seconds"], kind="rendition")
+                results.append(result)
+                continue
+            chunks = [future.result() for future in job]
+            for _, chunk_seconds in chunks:
+                extraction_seconds.observe(chunk_seconds, kind="chunk")
+            input_report = extract_info.merge_input_reports([input_report for input_report, _ in chunks])
+            output_path = extract_info.save_input_report(input_report, video_file, output_directory, mode)
+            # Chunks of all renditions run at the same time, so this is the time until the rendition was ready
+            seconds = time.perf_counter() - start
+            extraction_seconds.observe(seconds, kind="rendition")
+            results.append({"file": video_file, "ok": True, "output": output_path, "seconds": seconds})
+        except BrokenProcessPool as e:
+            discard_pool(pool)
+            results.append({"file": video_file, "ok": False, "error": f"Extraction worker died: {e}"})
+        except Exception as e:
+            results.append({"file": video_file, "ok": False, "error": f"{e}\n{traceback.format_exc()}"})
+    return results
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
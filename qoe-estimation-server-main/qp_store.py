@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+# Frame-indexed storage for extracted QP values.
+#
+# Every rendition is saved in extracted_qp/<rendition>/:
+#   header.json         -- the input report without the frame list, plus the frame layout
+#   frames.npy          -- structured array with one row per frame (scalar fields)
+#   <field>.npy         -- values of list fields (e.g. qpValues) of all frames, concatenated
+#   <field>.offsets.npy -- start of each frame inside <field>.npy (one extra entry at the end)
+#
+# The arrays are memory-mapped when read, so a session only touches the frames it needs.
+
+HEADER_FILE = "header.json"
+FRAMES_FILE = "frames.npy"
+
+
+def get_field_kind(values):
+    # Returns (kind, dtype) for one frame field, or raises ValueError if it can not be stored
+    if all(isinstance(value, bool) for value in values):
+        return "scalar", np.dtype(bool)
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        return "scalar", np.dtype(np.int64)
+    if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+        return "scalar", np.dtype(np.float64)
+    if all(isinstance(value, str) for value in values):
+        return "scalar", np.dtype(f"U{max((len(value) for value in values), default=1) or 1}")
+    if all(isinstance(value, list) for value in values):
+        items = [item for value in values for item in value]
+        if all(isinstance(item, int) and not isinstance(item, bool) for item in items):
+            return "list", np.dtype(np.int64)
+        if all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in items):
+            return "list", np.dtype(np.float64)
+    raise ValueError("Unsupported frame field values")
+
+def write_rendition(directory, input_report):
+    """
+    Save an input report in the frame-indexed format
+
+    Arguments:
+        directory {str} -- rendition folder, replaced if it already exists
+        input_report {dict} -- input report of a single rendition, as returned by the extractor
+
+    Raises ValueError if the frames can not be represented as arrays (fields that differ
+    between frames or values that are not numbers, strings or lists of numbers).
+    """
+    header = json.loads(json.dumps(input_report))
+    segment = header["I13"]["segments"][0]
+    frames = segment.pop("frames")
+
+    field_names = sorted(frames[0].keys()) if frames else []
+    if any(sorted(frame.keys()) != field_names for frame in frames):
+        raise ValueError("Frames do not share the same fields")
+
+    scalar_fields = []
+    list_fields = []
+    for name in field_names:
+        kind, dtype = get_field_kind([frame[name] for frame in frames])
+        if kind == "scalar":
+            scalar_fields.append((name, dtype))
+        else:
+            list_fields.append((name, dtype))
+
+    tmp_directory = directory + ".tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    frame_array = np.empty(len(frames), dtype=[(name, dtype) for name, dtype in scalar_fields])
+    for name, _ in scalar_fields:
+        frame_array[name] = [frame[name] for frame in frames]
+    np.save(os.path.join(tmp_directory, FRAMES_FILE), frame_array)
+
+    for name, dtype in list_fields:
+        lengths = np.array([len(frame[name]) for frame in frames], dtype=np.int64)
+        offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((item for frame in frames for item in frame[name]), dtype=dtype, count=int(offsets[-1]))
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), values)
+        np.save(os.path.join(tmp_directory, f"{name}.offsets.npy"), offsets)
+
+    header["frame_count"] = len(frames)
+    header["list_fields"] = [name for name, _ in list_fields]
+    with open(os.path.join(tmp_directory, HEADER_FILE), 'w') as header_file:
+        header_file.write(json.dumps(header))
+
+    # Replace the previous extraction only once the new one is complete
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+class Rendition:
+    # Memory-mapped rendition saved by write_rendition
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, HEADER_FILE), 'r') as header_file:
+            header_text = header_file.read()
+        self.header = json.loads(header_text)
+        self.frame_count = self.header["frame_count"]
+        self.frame_array = np.load(os.path.join(directory, FRAMES_FILE), mmap_mode='r')
+        self.list_fields = {
+            name: (np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r'),
+                   np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode='r'))
+            for name in self.header["list_fields"]
+        }
+        # Size of the data this rendition can bring into memory
+        self.nbytes = len(header_text) + self.frame_array.nbytes + sum(
+            values.nbytes + offsets.nbytes for values, offsets in self.list_fields.values()
+        )
+
+    @property
+    def segment(self):
+        # I13 segment info (codec, resolution, bitrate, fps...) without the frames
+        return self.header["I13"]["segments"][0]
+
+    def frames(self, start, end):
+        # Same result as frames[start:end] on the original frame list
+        start, end, _ = slice(start, end).indices(self.frame_count)
+        if end <= start:
+            return []
+
+        rows = self.frame_array[start:end]
+        columns = {name: rows[name].tolist() for name in rows.dtype.names or ()}
+        for name, (values, offsets) in self.list_fields.items():
+            bounds = offsets[start:end + 1]
+            flat = values[bounds[0]:bounds[-1]].tolist()
+            bounds = (bounds - bounds[0]).tolist()
+            columns[name] = [flat[bounds[i]:bounds[i + 1]] for i in range(end - start)]
+
+        names = list(columns)
+        if not names:
+            return [{} for _ in range(end - start)]
+        return [dict(zip(names, frame)) for frame in zip(*(columns[name] for name in names))]
+
+
+class JsonRendition:
+    # Rendition extracted before the frame-indexed format existed (<rendition>.json)
+
+    def __init__(self, json_path):
+        with open(json_path, 'r') as json_file:
+            json_text = json_file.read()
+        self.header = json.loads(json_text)
+        self.frame_list = self.header["I13"]["segments"][0].pop("frames")
+        self.frame_count = len(self.frame_list)
+        # Rough size of the parsed report, the objects take more memory than the text
+        self.nbytes = len(json_text)
+
+    @property
+    def segment(self):
+        return self.header["I13"]["segments"][0]
+
+    def frames(self, start, end):
+        return self.frame_list[start:end]
+
+
+def open_rendition(qp_path, name):
+    directory = os.path.join(qp_path, name)
+    if os.path.isdir(directory):
+        return Rendition(directory)
+    return JsonRendition(os.path.join(qp_path, f"{name}.json"))
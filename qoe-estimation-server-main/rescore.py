@@ -0,0 +1,280 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import database
+import event_store
+import mos_cache
+import mos_pool
+import session_input
+import timeline
+
+
+# Offline re-scoring of stored media sessions, e.g. after changing the P.1203 options:
+#
+#   python rescore.py --amendment-1-stalling
+#   python rescore.py --mode 1
+#   python rescore.py --videos 3 7 --since 2024-05-01
+#
+# Sessions are processed video by video, so the QP values of a video are loaded once for
+# all its sessions, and identical sessions (same video, quality segments and stalls) are
+# computed once. MOS values are computed in the process pool of mos_pool (QOE_MOS_PROCESSES,
+# one process per core by default) and written in batches.
+#
+# With the options of the server (mos_cache.MODEL_OPTIONS), the results replace the stored
+# ones in the database. Results of other options are saved next to them as
+# <id>-result-<options hash>.json, and the stored results, MOS keys and MOS cache are left as they
+# are, so the server keeps answering with its own options.
+#
+# The ids of the re-scored sessions are appended to video_db/rescore/<options>.jsonl after
+# every batch, so an interrupted run started again with the same options skips them.
+# Do not run it while the server computes the same sessions.
+
+STATE_DIR = os.path.join("video_db", "rescore")
+
+AMENDMENT_OPTIONS = ("amendment_1_audiovisual", "amendment_1_stalling", "amendment_1_app_2")
+# P.1203 modes that can be computed from the stored QP values (extracted in mode 3). Mode 2
+# needs the QP values of part of the frames only, which the extraction does not produce.
+MODES = (0, 1, 3)
+
+
+def get_options_id(options):
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+def load_state(state_path):
+    # Ids of the sessions already re-scored by previous runs
+    done = set()
+    if os.path.exists(state_path):
+        with open(state_path, "r") as state_file:
+            for line in state_file:
+                if line.strip():
+                    done.update(json.loads(line))
+    return done
+
+def select_sessions(video_ids=None, metric_ids=None, since=None, scored_only=False):
+    """
+    Sessions to re-score, ordered by video
+
+    Arguments:
+        video_ids {list} -- only sessions of these videos
+        metric_ids {list} -- only these sessions
+        since {str} -- only sessions uploaded on or after this date (YYYY-MM-DD[ HH:MM:SS])
+        scored_only {bool} -- only sessions that already have a result
+
+    Returns:
+        list -- (metric id, video id) of every session
+    """
+    query = "SELECT id, mpd_url FROM metrics WHERE mpd_url IS NOT NULL"
+    params = []
+    if video_ids:
+        query += f" AND mpd_url IN ({','.join('?' * len(video_ids))})"
+        params += video_ids
+    if metric_ids:
+        query += f" AND id IN ({','.join('?' * len(metric_ids))})"
+        params += metric_ids
+    if since:
+        query += " AND date >= ?"
+        params.append(since)
+    if scored_only:
+        query += " AND result_obtained = 1"
+    query += " ORDER BY mpd_url, id"
+    return [(row["id"], row["mpd_url"]) for row in database.get_connection().execute(query, params)]
+
+def is_rendition_extracted(video, name):
+    if video["qp_extracted"]:
+        return True
+    rendition = database.get_rendition(video["id"], name)
+    return rendition is not None and rendition["qp_extracted"]
+
+def apply_mode(input_json, mode):
+    # Mode 3 uses the whole frames, mode 1 their types and sizes only, mode 0 no frames at all
+    for segment in input_json["I13"]["segments"]:
+        if mode == 0:
+            segment.pop("frames", None)
+        elif mode == 1:
+            segment["frames"] = [{name: value for name, value in frame.items() if name != "qpValues"} for frame in segment["frames"]]
+    return input_json
+
+def get_input_path(metrics_id):
+    return os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-rescore-input.json")
+
+def write_results(results, state_path, options_id=None):
+    # results: [(metric id, MOS key, P.1203 result)]. One transaction for the whole batch.
+    # Results of options other than the server's (options_id) only go to their own files.
+    suffix = "" if options_id is None else f"-{options_id}"
+    for metrics_id, _, result in results:
+        with open(os.path.join("video_db", "metrics", str(metrics_id), f"{metrics_id}-result{suffix}.json"), "w") as file_result:
+            file_result.write(json.dumps(result))
+
+    if options_id is None:
+        with database.transaction() as conn:
+            conn.executemany(
+                "UPDATE metrics SET result = ?, result_obtained = 1, mos_key = ? WHERE id = ?",
+                [
+                    (json.dumps({"O23": result["O23"], "O35": result["O35"], "O46": result["O46"]}), mos_key, metrics_id)
+                    for metrics_id, mos_key, result in results
+                ]
+            )
+
+    with open(state_path, "a") as state_file:
+        state_file.write(json.dumps([metrics_id for metrics_id, _, _ in results]) + "\n")
+
+def rescore(sessions, options, state_path, batch_size=100):
+    """
+    Compute the MOS of the given sessions again
+
+    Arguments:
+        sessions {list} -- (metric id, video id) of every session, grouped by video
+        options {dict} -- model options, see mos_cache.MODEL_OPTIONS
+        state_path {str} -- file with the ids of the sessions already re-scored
+        batch_size {int} -- sessions written to the database at once
+
+    Returns:
+        dict -- number of sessions re-scored, computed, taken from the cache and skipped
+    """
+    p1203_options = {option: options[option] for option in AMENDMENT_OPTIONS}
+    # The MOS cache and the stored results only hold results of the options of the server
+    server_options = options == mos_cache.MODEL_OPTIONS
+    options_id = None if server_options else get_options_id(options)
+    max_pending = 2 * mos_pool.POOL_SIZE
+
+    counts = {"rescored": 0, "computed": 0, "cached": 0, "skipped": 0, "failed": 0}
+    pending = {}        # {future: (MOS key, video id, input path)}
+    waiting = {}        # {MOS key: [metric ids]}
+    batch = []
+    start = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - start
+        rate = counts["rescored"] / elapsed if elapsed > 0 else 0
+        remaining = len(sessions) - counts["rescored"] - counts["skipped"] - counts["failed"]
+        eta = f", {remaining / rate:.0f} s left" if rate > 0 else ""
+        print(f"{counts['rescored']}/{len(sessions)} sessions re-scored ({counts['computed']} computed, "
+              f"{counts['cached']} cached, {counts['skipped'] + counts['failed']} not scored), {rate:.1f}/s{eta}")
+
+    def add_results(mos_key, result):
+        for metrics_id in waiting.pop(mos_key):
+            batch.append((metrics_id, mos_key, result))
+            counts["rescored"] += 1
+        if len(batch) >= batch_size:
+            write_results(batch, state_path, options_id)
+            batch.clear()
+            report()
+
+    def collect(return_when):
+        done, _ = wait(list(pending), return_when=return_when)
+        for future in done:
+            mos_key, video_id, input_path = pending.pop(future)
+            os.remove(input_path)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"MOS computation failed for sessions {waiting[mos_key]}: {e}")
+                counts["failed"] += len(waiting.pop(mos_key))
+                continue
+            counts["computed"] += 1
+            if server_options:
+                mos_cache.put(mos_key, video_id, result)
+            add_results(mos_key, result)
+
+    for video_id, video_sessions in itertools.groupby(sessions, key=lambda session: session[1]):
+        video_sessions = [metrics_id for metrics_id, _ in video_sessions]
+        video = database.get_video(video_id)
+        if video is None:
+            print(f"Video {video_id} not found, skipping its {len(video_sessions)} sessions")
+            counts["skipped"] += len(video_sessions)
+            continue
+        rep_id_rel = video["bitrates"]
+
+        for metrics_id in video_sessions:
+            try:
+                stalls, quality_segments = timeline.get_timeline(event_store.load_columns(metrics_id))
+            except FileNotFoundError:
+                print(f"No events for session {metrics_id}, skipping it")
+                counts["skipped"] += 1
+                continue
+            if not quality_segments or any(segment[0] not in rep_id_rel for segment in quality_segments):
+                print(f"Session {metrics_id} has no quality segments of video {video_id}, skipping it")
+                counts["skipped"] += 1
+                continue
+            names = {rep_id_rel[segment[0]] for segment in quality_segments}
+            if not all(is_rendition_extracted(video, name) for name in names):
+                print(f"QP values of the renditions of session {metrics_id} are not extracted, skipping it")
+                counts["skipped"] += 1
+                continue
+
+            mos_key = mos_cache.session_key(
+                video_id,
+                [[rep_id_rel[segment[0]], segment[1], segment[2]] for segment in quality_segments],
+                stalls,
+                options
+            )
+            if mos_key in waiting:
+                # Identical to a session being computed
+                waiting[mos_key].append(metrics_id)
+                continue
+            waiting[mos_key] = [metrics_id]
+
+            cached_result = mos_cache.get(mos_key) if server_options else None
+            if cached_result is not None:
+                counts["cached"] += 1
+                add_results(mos_key, cached_result)
+                continue
+
+            input_path = get_input_path(metrics_id)
+            with open(input_path, "w") as input_file:
+                input_json = session_input.build_input(video_id, rep_id_rel, stalls, quality_segments)
+                input_file.write(json.dumps(apply_mode(input_json, options["mode"])))
+            pending[mos_pool.submit(input_path, p1203_options)] = (mos_key, video_id, input_path)
+            while len(pending) >= max_pending:
+                collect(FIRST_COMPLETED)
+
+    while pending:
+        collect(FIRST_COMPLETED)
+    if batch:
+        write_results(batch, state_path, options_id)
+    report()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the MOS of stored media sessions again")
+    parser.add_argument("--videos", type=int, nargs="+", help="only sessions of these videos")
+    parser.add_argument("--metrics", type=int, nargs="+", help="only these sessions")
+    parser.add_argument("--since", type=str, help="only sessions uploaded on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--scored-only", action="store_true", help="only sessions that already have a result")
+    parser.add_argument("--mode", type=int, choices=MODES, default=mos_cache.MODEL_OPTIONS["mode"], help="P.1203 mode")
+    for option in AMENDMENT_OPTIONS:
+        parser.add_argument(f"--{option.replace('_', '-')}", action="store_true", help=f"enable {option} in P.1203")
+    parser.add_argument("--batch-size", type=int, default=100, help="sessions written to the database at once")
+    parser.add_argument("--restart", action="store_true", help="re-score the sessions of a previous run with the same options too")
+    argsdict = vars(parser.parse_args())
+
+    database.init_db()
+    options = dict(mos_cache.MODEL_OPTIONS, mode=argsdict["mode"], **{option: argsdict[option] for option in AMENDMENT_OPTIONS})
+    os.makedirs(STATE_DIR, exist_ok=True)
+    state_path = os.path.join(STATE_DIR, f"{get_options_id(options)}.jsonl")
+    if argsdict["restart"] and os.path.exists(state_path):
+        os.remove(state_path)
+
+    done = load_state(state_path)
+    sessions = [
+        session for session in select_sessions(argsdict["videos"], argsdict["metrics"], argsdict["since"], argsdict["scored_only"])
+        if session[0] not in done
+    ]
+    print(f"Re-scoring {len(sessions)} sessions with {options} ({len(done)} done by previous runs, state in {state_path})")
+
+    try:
+        counts = rescore(sessions, options, state_path, argsdict["batch_size"])
+    finally:
+        mos_pool.shutdown()
+    print(f"Finished: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import sys
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Job pipeline: every job runs in the bounded worker pool of its stage as soon as
+# all the jobs it depends on have finished. There is no polling, a job that
+# finishes hands its dependents to their pools directly.
+
+WAITING = "waiting"     # Waiting for dependencies
+QUEUED = "queued"       # Dependencies finished, waiting for a free worker
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, key, stage, target, args):
+        self.key = key
+        self.stage = stage
+        self.target = target
+        self.args = args
+        self.state = WAITING
+        self.pending_deps = set()
+        self.dependents = []
+        self.finished = threading.Event()
+        # monotonic times of the state changes, for the latency metrics
+        self.created_at = time.monotonic()
+        self.queued_at = None
+        self.started_at = None
+        self.finished_at = None
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.state == DONE
+
+
+class Scheduler:
+    def __init__(self, pool_sizes, on_finish=None):
+        # pool_sizes -- {stage name: number of workers}
+        # on_finish -- called with every job that finishes, fails or is cancelled (without the lock,
+        #              so it may submit jobs)
+        self.on_finish = on_finish
+        self.lock = threading.Lock()
+        self.jobs = {}
+        # Keys of the jobs that failed, so jobs submitted later that depend on them fail too.
+        # A key is forgotten when it is submitted again.
+        self.failed = set()
+        self.pool_sizes = dict(pool_sizes)
+        self.pools = {
+            stage: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{stage}-worker")
+            for stage, size in self.pool_sizes.items()
+        }
+
+    def submit(self, key, stage, target, *args, deps=()):
+        """
+        Schedule target(*args) in the pool of the given stage.
+
+        Arguments:
+            key {hashable} -- unique job key; submitting a key that is still pending returns the existing job
+            stage {str} -- name of the worker pool
+            target {callable} -- function to run
+            deps {iterable} -- keys of the jobs that have to finish first. Keys that are not
+                               pending anymore (or never were) count as finished, unless
+                               they failed: then the job fails right away.
+        """
+        failed = []
+        with self.lock:
+            if key in self.jobs:
+                return self.jobs[key]
+
+            self.failed.discard(key)
+            job = Job(key, stage, target, args)
+            self.jobs[key] = job
+            failed_dep = next((dep_key for dep_key in deps if dep_key in self.failed), None)
+            if failed_dep is not None:
+                print(f"Job {key} cancelled, dependency {failed_dep} failed", file=sys.stderr)
+                failed = self.fail(job)
+            else:
+                for dep_key in deps:
+                    dep = self.jobs.get(dep_key)
+                    if dep is not None:
+                        dep.dependents.append(job)
+                        job.pending_deps.add(dep_key)
+
+            ready = not failed and not job.pending_deps
+            if ready:
+                job.state = QUEUED
+                job.queued_at = job.created_at
+
+        self.notify_finish(failed)
+        if ready:
+            self.pools[stage].submit(self.run, job)
+        return job
+
+    def get(self, key):
+        with self.lock:
+            return self.jobs.get(key)
+
+    def run(self, job):
+        with self.lock:
+            job.state = RUNNING
+            job.started_at = time.monotonic()
+        try:
+            job.target(*job.args)
+            succeeded = True
+        except Exception:
+            print(f"Job {job.key} failed:", file=sys.stderr)
+            traceback.print_exc()
+            succeeded = False
+        self.finish(job, succeeded)
+
+    def finish(self, job, succeeded):
+        ready = []
+        with self.lock:
+            if succeeded:
+                job.state = DONE
+                job.finished_at = time.monotonic()
+                del self.jobs[job.key]
+                for dependent in job.dependents:
+                    dependent.pending_deps.discard(job.key)
+                    if not dependent.pending_deps and dependent.state == WAITING:
+                        dependent.state = QUEUED
+                        dependent.queued_at = job.finished_at
+                        ready.append(dependent)
+                job.finished.set()
+                finished = [job]
+            else:
+                finished = self.fail(job)
+
+        self.notify_finish(finished)
+        for dependent in ready:
+            self.pools[dependent.stage].submit(self.run, dependent)
+
+    def fail(self, job):
+        # Called with the lock held. A failed job also fails everything that depends on it.
+        # Returns the failed jobs, to notify once the lock is released.
+        job.state = FAILED
+        job.finished_at = time.monotonic()
+        self.jobs.pop(job.key, None)
+        self.failed.add(job.key)
+        job.finished.set()
+        failed = [job]
+        for dependent in job.dependents:
+            if dependent.state == WAITING:
+                print(f"Job {dependent.key} cancelled, dependency {job.key} failed", file=sys.stderr)
+                failed.extend(self.fail(dependent))
+        return failed
+
+    def notify_finish(self, jobs):
+        if self.on_finish is None:
+            return
+        for job in jobs:
+            try:
+                self.on_finish(job)
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                stage: {"workers": size, WAITING: 0, QUEUED: 0, RUNNING: 0}
+                for stage, size in self.pool_sizes.items()
+            }
+            for job in self.jobs.values():
+                stats[job.stage][job.state] += 1
+        return stats
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
@@ -0,0 +1,72 @@
+import os
+
+import qp_cache
+
+
+# P.1203 input of a media session, built from its quality segments and stalls and the
+# QP values of the renditions it played. Shared by the server and the offline tools,
+# which must not import the Flask app.
+
+
+def get_qp_path(mpd_id):
+    return os.path.join("video_db", "videos", str(mpd_id), "extracted_qp")
+
+def build_i13_segment(rendition, segment):
+    # I13 segment of a [representation id, start, end] quality segment
+    segment_fps = rendition.segment["fps"]
+    return {
+        "codec": rendition.segment["codec"],
+        "start": segment[1],
+        "duration": segment[2] - segment[1],
+        "resolution": rendition.segment["resolution"],
+        "bitrate": rendition.segment["bitrate"],
+        "fps": segment_fps,
+        "frames": rendition.frames(round(segment[1]*segment_fps), round(segment[2]*segment_fps))
+    }
+
+def build_input(mpd_id, rep_id_rel, stalls, quality_segments, prepared_segments=None):
+    """
+    P.1203 input of a media session
+
+    Arguments:
+        mpd_id {int} -- id of the video
+        rep_id_rel {dict} -- {representation id: rendition name} of the video
+        stalls {list} -- [media time, duration] of every stall
+        quality_segments {list} -- [representation id, start, end] of every quality segment
+        prepared_segments {dict} -- I13 segments already built, by index of their quality segment
+
+    Returns:
+        dict -- input with the I11, I13, I23 and IGen parameters
+    """
+    prepared_segments = prepared_segments or {}
+    qp_path = get_qp_path(mpd_id)
+
+    # Only open the needed renditions. Frames are read from disk only for the ranges of the segments.
+    needed_qp_values = {}
+    for quality_segment in quality_segments:
+        seg_rep = quality_segment[0]
+        if seg_rep not in needed_qp_values.keys():
+            needed_qp_values[seg_rep] = qp_cache.get_rendition(mpd_id, rep_id_rel[seg_rep], qp_path)
+
+    # 1st (most important): I13 - video info
+    segments_list_i13 = []
+    for index, segment in enumerate(quality_segments):
+        built_segment = prepared_segments.get(index)
+        if built_segment is None:
+            built_segment = build_i13_segment(needed_qp_values[segment[0]], segment)
+        segments_list_i13.append(built_segment)
+    i13 = {"streamId": 42, "segments": segments_list_i13}
+
+    # 2nd: I11 - audio info
+    i11 = needed_qp_values[quality_segments[0][0]].header["I11"]
+
+    # 2nd: I23 - stall info
+    i23 = {
+        "streamId": 42,
+        "stalling": stalls
+    }
+
+    # 3rd: IGen - player hardware info
+    iGen = needed_qp_values[quality_segments[0][0]].header["IGen"]
+
+    return {"I11": i11, "I13": i13, "I23": i23, "IGen": iGen}
@@ -13,6 +13,7 @@ var eventList = []
 
 var metricId
 var resultLoopId
+var socket
 
 function scrollToBottom() {
     eventsElement.scrollTop = eventsElement.scrollHeight;
@@ -32,7 +33,10 @@ function sendMetrics(metrics) {
     .then(response => {
         if (response.status === 200) {
             console.log("Processing media session events and data: ", response.status)
-            response.json().then(data => metricId = data["metric_id"])
+            response.json().then(data => {
+                metricId = data["metric_id"]
+                waitForResult()
+            })
         } else {
             console.log("Error sending metrics data to server: ", response.status)
         }
@@ -40,6 +44,47 @@ function sendMetrics(metrics) {
     .catch(error => console.error('Error sending metrics data to server: ', error));
 }
 
+function showResult(result) {
+    clearInterval(resultLoopId)
+    var resultMOSElement = document.createElement("p")
+    resultMOSElement.innerHTML =
+        'Overall MOS result: ' + result["O46"] + '<br>' +
+        'Stalling quality: ' + result["O23"] + '<br>' +
+        'Audiovisual quality: ' + result["O35"]
+    resultsElement.appendChild(resultMOSElement)
+}
+
+function waitForResult() {
+    // Results are pushed over Socket.IO. Polling /result is only used without a socket connection.
+    if (socket && socket.connected) {
+        socket.emit("subscribe", {"metric_id": metricId})
+    } else {
+        resultLoopId = setInterval(getResult, 3000)
+    }
+}
+
+function initSocket() {
+    if (typeof io === "undefined") return
+    socket = io()
+    socket.on("connect", () => {
+        // (Re)subscribe if a result was being polled or the connection was lost while waiting
+        if (!isNaN(metricId) && metricId >= 0) {
+            clearInterval(resultLoopId)
+            socket.emit("subscribe", {"metric_id": metricId})
+        }
+    })
+    socket.on("progress", data => {
+        if (data["metric_id"] === metricId) console.log("MOS extraction stage: ", data["stage"])
+    })
+    socket.on("result", data => {
+        if (data["metric_id"] === metricId) {
+            console.log("Result ready: ", data["result"])
+            metricId = undefined
+            showResult(data["result"])
+        }
+    })
+}
+
 function getResult() {
     if (!isNaN(metricId) && metricId >= 0) {
         fetch('/result', {
@@ -50,16 +95,10 @@ function getResult() {
         .then(response => {
             if (response.status === 200) {
                 response.json().then(data => {
-                    if(data["is_result_ready"]) {
+                    if(data["is_result_ready"] && data["metric_id"] === metricId) {
                         console.log("Result ready: ", data["result"])
-                        clearInterval(resultLoopId)
-                        // window.alert("MOS result: " + data.result)
-                        var resultMOSElement = document.createElement("p")
-                        resultMOSElement.innerHTML =
-                            'Overall MOS result: ' + data.result["O46"] + '<br>' +
-                            'Stalling quality: ' + data.result["O23"] + '<br>' +
-                            'Audiovisual quality: ' + data.result["O35"]
-                        resultsElement.appendChild(resultMOSElement)
+                        metricId = undefined
+                        showResult(data["result"])
                     }
                 })
             } else {
@@ -152,11 +191,8 @@ function processEvent(e) {
             scrollToBottom()
 
             eventList.push(eventObject)
-            sendMetrics(eventList)
+            sendMetrics(eventList) // The MOS result is requested once the server returns the metric id
             eventList = [] // Reset event list when video is changed
-
-            // Begin trying to get the MOS result
-            resultLoopId = setInterval(getResult, 3000)
             return null;
     }
     if (eventObject) {
@@ -188,6 +224,7 @@ function init(url) {
 function changeVideo() {
 
     clearInterval(resultLoopId)
+    metricId = undefined
 
     eventsElement.innerHTML = ''
     resultsElement.innerHTML = ''
@@ -229,4 +266,6 @@ document.addEventListener('DOMContentLoaded', function () {
     // set behavior of the button
     sendButtonElement = document.querySelector(".input-url button");
     sendButtonElement.onclick = changeVideo
+
+    initSocket()
 });
\ No newline at end of file
@@ -0,0 +1,355 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# Analysis of the fragment logs of a swarm deployment (resultados_despliegue/<run>), the
+# Python version of the MATLAB scripts of each run:
+#   relacionar_nodos_peerid.m -> relacion_nodos_peerid.csv (node name of every peer)
+#   resumen_por_peer.m        -> resumen_peers.csv (downloads, contribution and qualities per peer)
+#   tratar_resultados.m       -> log_analisis.csv (HTTP and P2P bytes and active peers per interval)
+#
+#   python swarm_logs.py ../resultados_despliegue/nat_test --interval 10
+#
+# Every peer writes a JSON array of {peerId, url, source, fromPeerId, bytes, timestamp}
+# records, copied in the run folder, in group/ and in <NODE>/explorer/. The copies of a
+# peer are read once (or merged record by record if they differ). Files are streamed into
+# NumPy columns by a pool of processes, one peer at a time, so memory grows with the
+# largest log and not with the run. A second pass over the saved columns computes the
+# interval buckets once the start of the run is known.
+
+SOURCES = ("http", "peer")
+
+QUALITY_PATTERN = re.compile(r"/video/[^/]+/(\d+)/")
+
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+READ_CHUNK_CHARS = 1 << 20
+COLUMN_CHUNK_RECORDS = 1 << 16
+
+
+def iter_json_array(path, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Objects of a JSON file holding an array of objects, read in chunks
+
+    Arguments:
+        path {str} -- JSON file
+        chunk_chars {int} -- characters read at a time
+
+    Returns:
+        generator -- dicts, in file order
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as json_file:
+        buffer = json_file.read(chunk_chars).lstrip()
+        if not buffer:
+            return
+        if buffer[0] != "[":
+            raise ValueError(f"{path} is not a JSON array")
+        position = 1
+        eof = False
+        while True:
+            # Skip separators up to the next object
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError("Buffer exhausted", buffer, position)
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Object cut by the end of the chunk
+                if eof:
+                    raise ValueError(f"Truncated JSON array in {path}")
+                chunk = json_file.read(chunk_chars)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield value
+            position = end
+
+def intern(table, value):
+    return table.setdefault(value, len(table))
+
+def get_quality(url, pattern=QUALITY_PATTERN):
+    # Quality level of a video segment URL (.../video/<codec>/<level>/...), 0 for other URLs
+    match = pattern.search(url)
+    return int(match.group(1)) if match else 0
+
+def parse_timestamps(values):
+    # ISO 8601 UTC timestamps (2025-06-19T08:08:16.826Z) -> int64 milliseconds since the epoch
+    return np.array([value.rstrip("Z") for value in values], dtype="datetime64[ms]").astype(np.int64)
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as log_file:
+        for block in iter(lambda: log_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_columns(paths):
+    """
+    Columns of the records of the copies of a peer log
+
+    Arguments:
+        paths {list} -- copies of the log
+
+    Returns:
+        tuple -- ({column name: numpy array}, [url of each url index], [peer id of each peer index])
+    """
+    # Identical copies are read once
+    distinct = {}
+    for path in paths:
+        distinct.setdefault((os.path.getsize(path), file_digest(path)), path)
+
+    urls = {}
+    peers = {}
+    chunks = {"timestamp": [], "bytes": [], "source": [], "url": [], "from_peer": []}
+    buffers = {name: [] for name in chunks}
+
+    def flush():
+        if buffers["timestamp"]:
+            chunks["timestamp"].append(parse_timestamps(buffers["timestamp"]))
+            chunks["bytes"].append(np.array(buffers["bytes"], dtype=np.int64))
+            chunks["source"].append(np.array(buffers["source"], dtype=np.int8))
+            chunks["url"].append(np.array(buffers["url"], dtype=np.int32))
+            chunks["from_peer"].append(np.array(buffers["from_peer"], dtype=np.int32))
+            for buffer in buffers.values():
+                buffer.clear()
+
+    for path in distinct.values():
+        for record in iter_json_array(path):
+            size = record.get("bytes", 0)
+            source = str(record.get("source", "")).lower()
+            buffers["timestamp"].append(record["timestamp"])
+            buffers["bytes"].append(size if isinstance(size, int) else int(float(size)))
+            buffers["source"].append(SOURCES.index(source) if source in SOURCES else -1)
+            buffers["url"].append(intern(urls, record.get("url", "")))
+            buffers["from_peer"].append(intern(peers, record.get("fromPeerId") or ""))
+            if len(buffers["timestamp"]) >= COLUMN_CHUNK_RECORDS:
+                flush()
+    flush()
+
+    columns = {
+        name: np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64 if name in ("timestamp", "bytes") else np.int32)
+        for name, arrays in chunks.items()
+    }
+    if len(distinct) > 1:
+        # Copies that differ (e.g. one was cut): keep every distinct record once
+        stacked = np.stack([columns[name].astype(np.int64) for name in chunks], axis=1)
+        _, first = np.unique(stacked, axis=0, return_index=True)
+        first.sort()
+        columns = {name: values[first] for name, values in columns.items()}
+    return columns, list(urls), list(peers)
+
+def summarize_peer(peer_id, paths, columns_directory, qualities):
+    """
+    Read the log of a peer and summarize it. Runs in a worker process.
+
+    Arguments:
+        peer_id {str} -- peer id (name of its log file)
+        paths {list} -- copies of its log
+        columns_directory {str} -- folder where the timestamp, bytes and source columns are saved
+        qualities {list} -- quality levels counted
+
+    Returns:
+        dict -- records, start and end (ms), downloaded bytes by source, bytes sent to every
+                other peer, segments of every quality and path of the saved columns
+    """
+    columns, urls, peers = read_columns(paths)
+    summary = {"peer_id": peer_id, "records": len(columns["timestamp"]), "start": None, "end": None}
+    if summary["records"]:
+        summary["start"] = int(columns["timestamp"].min())
+        summary["end"] = int(columns["timestamp"].max())
+
+    for index, source in enumerate(SOURCES):
+        summary[f"download_{source}"] = int(columns["bytes"][columns["source"] == index].sum())
+
+    # Bytes this peer received from each other peer, i.e. their contribution
+    sent = np.bincount(columns["from_peer"], weights=columns["bytes"], minlength=len(peers))
+    summary["received_from"] = {peer: int(total) for peer, total in zip(peers, sent) if peer and total}
+
+    url_qualities = np.array([get_quality(url) for url in urls], dtype=np.int32)
+    record_qualities = url_qualities[columns["url"]] if len(urls) else np.zeros(0, dtype=np.int32)
+    summary["qualities"] = {quality: int((record_qualities == quality).sum()) for quality in qualities}
+
+    summary["columns"] = os.path.join(columns_directory, f"{peer_id}.npz")
+    np.savez(summary["columns"], timestamp=columns["timestamp"], bytes=columns["bytes"], source=columns["source"])
+    return summary
+
+def bin_peer(columns_path, start, interval_ms, bin_count):
+    """
+    Bytes downloaded by a peer in every interval of the run. Runs in a worker process.
+
+    Returns:
+        tuple -- (HTTP bytes per interval, P2P bytes per interval, first and last interval
+                  with records, or None if it has none)
+    """
+    with np.load(columns_path) as columns:
+        timestamps, sizes, sources = columns["timestamp"], columns["bytes"], columns["source"]
+    # Like tratar_resultados.m, records after the last whole interval are not counted
+    bins = (timestamps - start) // interval_ms
+    valid = (bins >= 0) & (bins < bin_count)
+    bins, sizes, sources = bins[valid], sizes[valid], sources[valid]
+    per_source = [
+        np.bincount(bins[sources == index], weights=sizes[sources == index], minlength=bin_count).astype(np.int64)
+        for index in range(len(SOURCES))
+    ]
+    active = (int(bins.min()), int(bins.max())) if len(bins) else None
+    return per_source[0], per_source[1], active
+
+
+# Run folders
+
+def find_peer_logs(run_directory):
+    """
+    Log files of the peers of a run and the node each peer ran on
+
+    Returns:
+        tuple -- ({peer id: [copies of its log]}, {peer id: node name})
+    """
+    logs = {}
+    nodes = {}
+    for path in sorted(glob.glob(os.path.join(run_directory, "*.json"))) + sorted(glob.glob(os.path.join(run_directory, "group", "*.json"))):
+        logs.setdefault(os.path.splitext(os.path.basename(path))[0], []).append(path)
+    for path in sorted(glob.glob(os.path.join(run_directory, "*", "explorer", "*.json"))):
+        peer_id = os.path.splitext(os.path.basename(path))[0]
+        logs.setdefault(peer_id, []).append(path)
+        nodes.setdefault(peer_id, os.path.basename(os.path.dirname(os.path.dirname(path))))
+    return logs, nodes
+
+def read_node_map(run_directory):
+    # {peer id: node name} of an existing relacion_nodos_peerid.csv
+    path = os.path.join(run_directory, "relacion_nodos_peerid.csv")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as csv_file:
+        lines = csv_file.read().splitlines()[1:]
+    return {line.split(",")[1]: line.split(",")[0] for line in lines if line.count(",") == 1}
+
+def format_time(milliseconds):
+    # MATLAB datetime format (19-Jun-2025 08:08:06), truncated to the second
+    if milliseconds is None:
+        return ""
+    moment = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=milliseconds // 1000)
+    return f"{moment.day:02d}-{MONTHS[moment.month - 1]}-{moment.year} {moment:%H:%M:%S}"
+
+def write_csv(path, header, rows):
+    with open(path, "w", encoding="utf-8") as csv_file:
+        csv_file.write(",".join(header) + "\n")
+        for row in rows:
+            csv_file.write(",".join(str(value) for value in row) + "\n")
+
+
+def analyze_run(run_directory, interval=10, qualities=(1, 2, 3), processes=None, log_name="log_analisis.csv"):
+    """
+    Write relacion_nodos_peerid.csv, resumen_peers.csv and the interval log of a run
+
+    Arguments:
+        run_directory {str} -- folder of the run
+        interval {float} -- length of the intervals of the log, in seconds
+        qualities {tuple} -- quality levels counted per peer
+        processes {int} -- worker processes (default: one per CPU core)
+        log_name {str} -- file name of the interval log
+
+    Returns:
+        dict -- {"peers": summaries sorted by start, "log": [(start ms, HTTP, P2P, active peers)]}
+    """
+    logs, nodes = find_peer_logs(run_directory)
+    if not logs:
+        raise FileNotFoundError(f"No peer logs in {run_directory}")
+    nodes = {**read_node_map(run_directory), **nodes}
+
+    with tempfile.TemporaryDirectory(prefix="swarm-logs-") as columns_directory, \
+            ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        futures = [
+            pool.submit(summarize_peer, peer_id, paths, columns_directory, list(qualities))
+            for peer_id, paths in sorted(logs.items())
+        ]
+        summaries = [future.result() for future in futures]
+
+        # Intervals from the first record of the run, like tratar_resultados.m
+        with_records = [summary for summary in summaries if summary["records"]]
+        interval_ms = int(round(interval * 1000))
+        start = min(summary["start"] for summary in with_records) if with_records else 0
+        end = max(summary["end"] for summary in with_records) if with_records else 0
+        bin_count = (end - start) // interval_ms
+        http_bytes = np.zeros(bin_count, dtype=np.int64)
+        p2p_bytes = np.zeros(bin_count, dtype=np.int64)
+        active_changes = np.zeros(bin_count + 1, dtype=np.int64)
+        binned = [pool.submit(bin_peer, summary["columns"], start, interval_ms, bin_count) for summary in with_records]
+        for future in binned:
+            peer_http, peer_p2p, active = future.result()
+            http_bytes += peer_http
+            p2p_bytes += peer_p2p
+            if active is not None:
+                active_changes[active[0]] += 1
+                active_changes[active[1] + 1] -= 1
+        active_peers = np.cumsum(active_changes)[:bin_count]
+
+    # Contribution of a peer: bytes the other peers received from it
+    contributions = {}
+    for summary in summaries:
+        for peer_id, total in summary["received_from"].items():
+            contributions[peer_id] = contributions.get(peer_id, 0) + total
+
+    if nodes:
+        write_csv(
+            os.path.join(run_directory, "relacion_nodos_peerid.csv"), ["NombreOrdenador", "PeerId"],
+            sorted(((node, peer_id) for peer_id, node in nodes.items() if peer_id in logs), key=lambda row: row[0])
+        )
+
+    # Sorted by start, peers without records last
+    summaries.sort(key=lambda summary: (summary["start"] is None, summary["start"] or 0))
+    write_csv(
+        os.path.join(run_directory, "resumen_peers.csv"),
+        ["NombreOrdenador", "Inicio", "Fin", "DescargaPeer", "DescargaHTTP", "AportePeer"] + [f"Q{quality}" for quality in qualities],
+        [
+            [
+                nodes.get(summary["peer_id"], summary["peer_id"]), format_time(summary["start"]), format_time(summary["end"]),
+                summary["download_peer"], summary["download_http"], contributions.get(summary["peer_id"], 0)
+            ] + [summary["qualities"][quality] for quality in qualities]
+            for summary in summaries
+        ]
+    )
+
+    log = [
+        (start + index * interval_ms, int(http_bytes[index]), int(p2p_bytes[index]), int(active_peers[index]))
+        for index in range(bin_count)
+    ]
+    write_csv(
+        os.path.join(run_directory, log_name), ["Tiempo", "HTTP_Bytes", "P2P_Bytes", "Nodos_Activos"],
+        [(format_time(row[0]), *row[1:]) for row in log]
+    )
+    print(f"{len(summaries)} peers, {sum(summary['records'] for summary in summaries)} records, "
+          f"{(end - start) / 1000:.1f} s of reception in {bin_count} intervals of {interval} s")
+    return {"peers": summaries, "log": log}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summaries of the fragment logs of a swarm deployment")
+    parser.add_argument("runs", type=str, nargs="+", help="run folders (resultados_despliegue/<run>)")
+    parser.add_argument("--interval", type=float, default=10, help="length of the intervals of the log, in seconds")
+    parser.add_argument("--qualities", type=int, nargs="+", default=[1, 2, 3], help="quality levels counted per peer")
+    parser.add_argument("--processes", type=int, help="worker processes (default: one per CPU core)")
+    parser.add_argument("--log-name", type=str, default="log_analisis.csv", help="file name of the interval log")
+    argsdict = vars(parser.parse_args())
+
+    for run_directory in argsdict["runs"]:
+        print(f"Analyzing {run_directory}")
+        analyze_run(run_directory, argsdict["interval"], tuple(argsdict["qualities"]), argsdict["processes"], argsdict["log_name"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import threading
+
+import numpy as np
+
+from swarm_logs import SOURCES, parse_timestamps
+
+
+# Live aggregates of the segment transfers of a swarm, fed by the peers while a test runs
+# (POST /swarm/records) instead of collecting their logs afterwards. Records are the ones of
+# the peer logs analyzed by swarm_logs.py: {peerId, url, source, fromPeerId, bytes, timestamp}.
+#
+# Transfers are added to ring buffers of WINDOW_BINS intervals of INTERVAL_SECONDS, which
+# follow the newest record: HTTP and P2P bytes per interval, and download and upload bytes
+# of every peer per interval. Memory is fixed by WINDOW_BINS and MAX_PEERS; when a new peer
+# arrives and there is no free slot, the peer seen least recently is forgotten.
+
+INTERVAL_SECONDS = float(os.environ.get("QOE_SWARM_INTERVAL_SECONDS", 10))
+WINDOW_BINS = int(os.environ.get("QOE_SWARM_WINDOW_BINS", 60))
+MAX_PEERS = int(os.environ.get("QOE_SWARM_MAX_PEERS", 4096))
+
+# Columns of the per-peer buffer
+DOWNLOAD_HTTP, DOWNLOAD_P2P, UPLOAD = range(3)
+
+NO_BIN = np.iinfo(np.int64).min
+
+
+class SwarmTelemetry:
+    def __init__(self, interval_seconds, window_bins, max_peers):
+        self.interval_ms = int(round(interval_seconds * 1000))
+        self.window_bins = window_bins
+        self.max_peers = max_peers
+        self.lock = threading.Lock()
+        self.head = None        # newest interval (time // interval) with records
+        self.source_bytes = np.zeros((window_bins, len(SOURCES)), dtype=np.int64)
+        self.peer_bytes = np.zeros((window_bins, max_peers, 3), dtype=np.int64)
+        # Intervals of the first and last download of every peer, and of its last record of any kind
+        self.first_bin = np.full(max_peers, NO_BIN, dtype=np.int64)
+        self.last_bin = np.full(max_peers, NO_BIN, dtype=np.int64)
+        self.seen_bin = np.full(max_peers, NO_BIN, dtype=np.int64)
+        self.slots = {}                 # {peer id: slot}
+        self.peer_ids = [None] * max_peers
+        self.records = 0
+        self.dropped = 0
+        self.evictions = 0
+        self.version = 0                # changes with every batch, for pushes
+
+    def get_slots(self, peer_ids, bin_number):
+        # Slot of every peer id, -1 for peers that did not fit
+        slots = {}
+        candidates = None
+        for peer_id in peer_ids:
+            slot = self.slots.get(peer_id)
+            if slot is None:
+                if len(self.slots) < self.max_peers:
+                    slot = len(self.slots)
+                else:
+                    # Forget the peer seen least recently, unless it is part of this batch
+                    if candidates is None:
+                        taken = {self.slots[peer_id] for peer_id in peer_ids if peer_id in self.slots}
+                        candidates = (int(candidate) for candidate in np.argsort(self.seen_bin, kind="stable") if int(candidate) not in taken)
+                    slot = next(candidates, -1)
+                    if slot < 0 or self.seen_bin[slot] >= bin_number:
+                        slots[peer_id] = -1
+                        continue
+                    del self.slots[self.peer_ids[slot]]
+                    self.peer_bytes[:, slot, :] = 0
+                    self.first_bin[slot] = self.last_bin[slot] = NO_BIN
+                    self.evictions += 1
+                self.slots[peer_id] = slot
+                self.peer_ids[slot] = peer_id
+            self.seen_bin[slot] = max(self.seen_bin[slot], bin_number)
+            slots[peer_id] = slot
+        return slots
+
+    def advance(self, bin_number):
+        # Moves the window so bin_number is its newest interval, clearing the intervals it enters
+        if self.head is None:
+            self.head = bin_number
+            return
+        if bin_number <= self.head:
+            return
+        cleared = np.arange(self.head + 1, min(bin_number, self.head + self.window_bins) + 1) % self.window_bins
+        self.source_bytes[cleared] = 0
+        self.peer_bytes[cleared] = 0
+        self.head = bin_number
+
+    def add_records(self, records):
+        """
+        Add a batch of transfer records
+
+        Arguments:
+            records {list} -- {peerId, source, fromPeerId, bytes, timestamp} dicts; timestamps are
+                              ISO 8601 UTC strings or milliseconds since the epoch
+
+        Returns:
+            tuple -- (records added, records dropped because they were older than the window)
+        """
+        if not records:
+            return 0, 0
+        timestamps = [record["timestamp"] for record in records]
+        if isinstance(timestamps[0], str):
+            times = parse_timestamps(timestamps)
+        else:
+            times = np.array(timestamps, dtype=np.int64)
+        bins = times // self.interval_ms
+        sizes = np.array([record.get("bytes", 0) for record in records], dtype=np.int64)
+        sources = np.array([
+            SOURCES.index(source) if source in SOURCES else -1
+            for source in (str(record.get("source", "")).lower() for record in records)
+        ], dtype=np.int64)
+        peer_ids = [record.get("peerId") or "" for record in records]
+        from_ids = [record.get("fromPeerId") or "" for record in records]
+
+        with self.lock:
+            self.advance(int(bins.max()))
+            newest = self.head
+            in_window = bins > newest - self.window_bins
+            slots = self.get_slots(dict.fromkeys(peer_id for peer_id in peer_ids + from_ids if peer_id), newest)
+            slots[""] = -1
+            peer_slots = np.array([slots[peer_id] for peer_id in peer_ids], dtype=np.int64)
+            from_slots = np.array([slots[peer_id] for peer_id in from_ids], dtype=np.int64)
+            ring = bins % self.window_bins
+
+            counted = in_window & (sources >= 0)
+            np.add.at(self.source_bytes, (ring[counted], sources[counted]), sizes[counted])
+
+            downloads = counted & (peer_slots >= 0)
+            np.add.at(self.peer_bytes, (ring[downloads], peer_slots[downloads], sources[downloads]), sizes[downloads])
+            uploads = counted & (sources == SOURCES.index("peer")) & (from_slots >= 0)
+            np.add.at(self.peer_bytes, (ring[uploads], from_slots[uploads], UPLOAD), sizes[uploads])
+
+            # A peer is active from its first to its last download, like in swarm_logs.py
+            active = in_window & (peer_slots >= 0)
+            first = np.where(self.first_bin == NO_BIN, np.iinfo(np.int64).max, self.first_bin)
+            np.minimum.at(first, peer_slots[active], bins[active])
+            self.first_bin = np.where(first == np.iinfo(np.int64).max, NO_BIN, first)
+            np.maximum.at(self.last_bin, peer_slots[active], bins[active])
+
+            added = int(in_window.sum())
+            self.records += added
+            self.dropped += len(records) - added
+            self.version += 1
+        return added, len(records) - added
+
+    def snapshot(self):
+        """
+        Aggregates of the window
+
+        Returns:
+            dict -- intervals (start in ms since the epoch, HTTP and P2P bytes, active peers),
+                    peers (download and upload bytes in the window) and counters
+        """
+        with self.lock:
+            if self.head is None:
+                return {"interval": self.interval_ms / 1000, "intervals": [], "peers": [], **self.counters()}
+            bin_numbers = np.arange(self.head - self.window_bins + 1, self.head + 1)
+            source_bytes = self.source_bytes[bin_numbers % self.window_bins]
+            used = np.flatnonzero(self.last_bin != NO_BIN)
+            first = np.clip(self.first_bin[used], bin_numbers[0], bin_numbers[-1] + 1) - bin_numbers[0]
+            last = np.clip(self.last_bin[used], bin_numbers[0] - 1, bin_numbers[-1]) - bin_numbers[0]
+            visible = last >= first
+            changes = np.zeros(self.window_bins + 1, dtype=np.int64)
+            np.add.at(changes, first[visible], 1)
+            np.add.at(changes, last[visible] + 1, -1)
+            active = np.cumsum(changes)[:self.window_bins]
+            peer_totals = self.peer_bytes.sum(axis=0)
+            peers = [
+                {
+                    "peer_id": peer_id,
+                    "download_http": int(peer_totals[slot, DOWNLOAD_HTTP]),
+                    "download_p2p": int(peer_totals[slot, DOWNLOAD_P2P]),
+                    "upload": int(peer_totals[slot, UPLOAD])
+                }
+                for peer_id, slot in sorted(self.slots.items()) if peer_totals[slot].any()
+            ]
+            counters = self.counters()
+
+        # Intervals before the first record are left out
+        start = int(np.argmax((source_bytes.sum(axis=1) > 0) | (active > 0)))
+        intervals = [
+            {
+                "start": int(bin_number) * self.interval_ms,
+                "http_bytes": int(http_bytes),
+                "p2p_bytes": int(p2p_bytes),
+                "active_peers": int(active_peers)
+            }
+            for bin_number, (http_bytes, p2p_bytes), active_peers in zip(bin_numbers[start:], source_bytes[start:], active[start:])
+        ]
+        return {"interval": self.interval_ms / 1000, "intervals": intervals, "peers": peers, **counters}
+
+    def counters(self):
+        return {"records": self.records, "dropped": self.dropped, "peers_evicted": self.evictions}
+
+
+telemetry = SwarmTelemetry(INTERVAL_SECONDS, WINDOW_BINS, MAX_PEERS)
+
+
+def add_records(records):
+    return telemetry.add_records(records)
+
+def snapshot():
+    return telemetry.snapshot()
+
+def get_version():
+    return telemetry.version
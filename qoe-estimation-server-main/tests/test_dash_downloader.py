@@ -0,0 +1,271 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dash_downloader
+
+
+# Resume logic of the DASH downloader, against a local HTTP server that can cut a
+# response short, ignore Range headers or send fewer bytes than asked.
+
+SEGMENT_SIZE = 10 * 1024
+
+TEMPLATE_MPD = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT12S">
+ <Period>
+  <AdaptationSet mimeType="video/mp4">
+   <SegmentTemplate timescale="1000" duration="4000" initialization="init-$RepresentationID$.m4s" media="chunk-$RepresentationID$-$Number$.m4s"/>
+   <Representation id="0" bandwidth="1000000"/>
+  </AdaptationSet>
+ </Period>
+</MPD>
+"""
+
+LIST_MPD = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT8S">
+ <Period>
+  <AdaptationSet mimeType="video/mp4">
+   <Representation id="0" bandwidth="1000000">
+    <BaseURL>video.mp4</BaseURL>
+    <SegmentList>
+     <Initialization range="0-1023"/>
+     <SegmentURL mediaRange="1024-6143"/>
+     <SegmentURL mediaRange="6144-10239"/>
+    </SegmentList>
+   </Representation>
+  </AdaptationSet>
+ </Period>
+</MPD>
+"""
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # Files and behaviour are set on the server, see MediaServer
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.lstrip("/")
+        range_header = self.headers.get("Range")
+        server.requests.append((path, range_header))
+
+        if path not in server.files:
+            self.send_error(404)
+            return
+        content = server.files[path]
+
+        first, status = 0, 200
+        if range_header and not server.ignore_range:
+            first, last = range_header[len("bytes="):].split("-")
+            first = int(first)
+            if first >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            last = int(last) if last else len(content) - 1
+            content = content[first:last + 1]
+            status = 206
+        if path in server.short:
+            content = content[:server.short[path]]
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {first}-{first + len(content) - 1}/{len(server.files[path])}")
+        self.end_headers()
+
+        cut = server.cut.pop(path, None)
+        # Drop the connection in the middle of the body, like a network failure
+        self.wfile.write(content if cut is None else content[:cut])
+        self.wfile.flush()
+        if cut is not None:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.files = files
+        self.requests = []
+        # {path: bytes sent before the connection is dropped}, once per path
+        self.cut = {}
+        # {path: bytes actually sent}
+        self.short = {}
+        self.ignore_range = False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+def segment_content(name):
+    # Different bytes for every file, so a segment stored in the wrong place is noticed
+    return (name.encode() * SEGMENT_SIZE)[:SEGMENT_SIZE]
+
+
+class SegmentDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Small chunks, so an interrupted response leaves a partial segment on disk
+        patcher = mock.patch.object(dash_downloader, "CHUNK_SIZE", 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def start_server(self, files):
+        server = MediaServer(files)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def get_representations(self, server, mpd):
+        mpd_path = os.path.join(self.directory, "manifest.mpd")
+        with open(mpd_path, "w") as mpd_file:
+            mpd_file.write(mpd)
+        return dash_downloader.get_representations(mpd_path, server.url + "manifest.mpd")
+
+    def download(self, representations):
+        downloader = dash_downloader.SegmentDownloader(threads=2)
+        self.addCleanup(downloader.executor.shutdown)
+        return downloader.download(representations, self.directory, {"0": "1-1"})
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, "segments", "1-1", f"{index:06d}.m4s")
+
+    def test_interrupted_segment_resumes_from_part_file(self):
+        files = {name: segment_content(name) for name in ["init-0.m4s", "chunk-0-1.m4s", "chunk-0-2.m4s", "chunk-0-3.m4s"]}
+        server = self.start_server(files)
+        representations = self.get_representations(server, TEMPLATE_MPD)
+        server.cut["chunk-0-2.m4s"] = 4 * 1024 + 100
+
+        with self.assertRaises(IOError):
+            self.download(representations)
+        part_size = os.path.getsize(self.segment_path(2) + ".part")
+        self.assertTrue(0 < part_size < SEGMENT_SIZE)
+        self.assertFalse(os.path.exists(self.segment_path(2)))
+
+        server.requests.clear()
+        merged = self.download(representations)
+
+        # Only the rest of the interrupted segment is fetched, the others come from the manifest
+        self.assertEqual(server.requests, [("chunk-0-2.m4s", f"bytes={part_size}-")])
+        self.assertFalse(os.path.exists(self.segment_path(2) + ".part"))
+        with open(merged["0"], "rb") as merged_file:
+            self.assertEqual(merged_file.read(), b"".join(files.values()))
+
+        manifest = dash_downloader.Manifest(os.path.join(self.directory, "segments", dash_downloader.MANIFEST_FILE))
+        self.assertEqual(manifest.entries["1-1/000002.m4s"]["sha256"], dash_downloader.file_sha256(self.segment_path(2)))
+
+    def test_complete_download_restarts_from_manifest(self):
+        files = {name: segment_content(name) for name in ["init-0.m4s", "chunk-0-1.m4s", "chunk-0-2.m4s", "chunk-0-3.m4s"]}
+        server = self.start_server(files)
+        representations = self.get_representations(server, TEMPLATE_MPD)
+        self.download(representations)
+
+        server.requests.clear()
+        self.download(representations)
+        self.assertEqual(server.requests, [])
+
+        # A segment changed on disk no longer matches its manifest entry and is fetched again
+        with open(self.segment_path(1), "r+b") as segment_file:
+            segment_file.write(b"corrupted")
+        merged = self.download(representations)
+        self.assertEqual(server.requests, [("chunk-0-1.m4s", None)])
+        with open(merged["0"], "rb") as merged_file:
+            self.assertEqual(merged_file.read(), b"".join(files.values()))
+
+    def crash_before_rename(self, index):
+        # State left by a process stopped after writing the last byte of a segment:
+        # the whole segment in its .part file and no manifest entry
+        os.replace(self.segment_path(index), self.segment_path(index) + ".part")
+        manifest_path = os.path.join(self.directory, "segments", dash_downloader.MANIFEST_FILE)
+        with open(manifest_path) as manifest_file:
+            lines = [line for line in manifest_file if f'"1-1/{index:06d}.m4s"' not in line]
+        with open(manifest_path, "w") as manifest_file:
+            manifest_file.writelines(lines)
+
+    def test_complete_part_file_is_kept(self):
+        files = {name: segment_content(name) for name in ["init-0.m4s", "chunk-0-1.m4s", "chunk-0-2.m4s", "chunk-0-3.m4s"]}
+        server = self.start_server(files)
+        representations = self.get_representations(server, TEMPLATE_MPD)
+        self.download(representations)
+        self.crash_before_rename(2)
+
+        server.requests.clear()
+        merged = self.download(representations)
+
+        # The server answers 416 to a range after the end of the file, the part is complete
+        self.assertEqual(server.requests, [("chunk-0-2.m4s", f"bytes={SEGMENT_SIZE}-")])
+        self.assertFalse(os.path.exists(self.segment_path(2) + ".part"))
+        with open(merged["0"], "rb") as merged_file:
+            self.assertEqual(merged_file.read(), b"".join(files.values()))
+
+        server.requests.clear()
+        self.download(representations)
+        self.assertEqual(server.requests, [])
+
+    def test_complete_byte_range_part_file_is_not_fetched(self):
+        content = segment_content("video.mp4")
+        server = self.start_server({"video.mp4": content})
+        representations = self.get_representations(server, LIST_MPD)
+        self.download(representations)
+        self.crash_before_rename(1)
+
+        server.requests.clear()
+        merged = self.download(representations)
+        self.assertEqual(server.requests, [])
+        with open(merged["0"], "rb") as merged_file:
+            self.assertEqual(merged_file.read(), content)
+
+    def test_server_ignoring_range_restarts_segment(self):
+        files = {name: segment_content(name) for name in ["init-0.m4s", "chunk-0-1.m4s", "chunk-0-2.m4s", "chunk-0-3.m4s"]}
+        server = self.start_server(files)
+        representations = self.get_representations(server, TEMPLATE_MPD)
+        server.cut["chunk-0-3.m4s"] = 3 * 1024 + 10
+
+        with self.assertRaises(IOError):
+            self.download(representations)
+        self.assertTrue(os.path.exists(self.segment_path(3) + ".part"))
+
+        server.ignore_range = True
+        self.download(representations)
+        with open(self.segment_path(3), "rb") as segment_file:
+            self.assertEqual(segment_file.read(), files["chunk-0-3.m4s"])
+
+    def test_short_byte_range_segment_is_rejected(self):
+        content = segment_content("video.mp4")
+        server = self.start_server({"video.mp4": content})
+        representations = self.get_representations(server, LIST_MPD)
+        server.short["video.mp4"] = 1000
+
+        with self.assertRaises(IOError):
+            self.download(representations)
+        # The short segments are not kept, so the next run does not resume from them
+        for index in range(3):
+            self.assertFalse(os.path.exists(self.segment_path(index)))
+            self.assertFalse(os.path.exists(self.segment_path(index) + ".part"))
+
+        server.short.clear()
+        merged = self.download(representations)
+        with open(merged["0"], "rb") as merged_file:
+            self.assertEqual(merged_file.read(), content)
+
+
+if __name__ == "__main__":
+    unittest.main()
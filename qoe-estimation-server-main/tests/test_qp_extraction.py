@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dash_downloader
+
+try:
+    import extract_info
+    import qp_extraction
+except ImportError:
+    extract_info = qp_extraction = None
+
+
+# Chunked QP extraction: the report joined from the chunks of a rendition has to match
+# the report of the whole rendition extracted in one pass. Needs ffmpeg and itu_p1203.
+
+FPS = 24
+SEGMENT_SECONDS = 1
+SEGMENTS = 10
+SEGMENTS_PER_CHUNK = 4
+MODE = 3
+# Frame fields that hold times, checked by test_timestamps
+TIMESTAMP_FIELDS = ("dts", "pts")
+
+
+@unittest.skipUnless(
+    qp_extraction is not None and shutil.which("ffmpeg") and shutil.which("ffprobe"),
+    "needs ffmpeg and itu_p1203"
+)
+class ChunkedExtractionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix="qoe-test-")
+        dash_directory = os.path.join(cls.directory, "dash")
+        os.makedirs(dash_directory)
+        # One keyframe at the start of every segment, like the ladders of benchmark.py
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size=320x180:rate={FPS}:duration={SEGMENTS * SEGMENT_SECONDS}",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-b:v", "300k",
+            "-g", str(FPS * SEGMENT_SECONDS), "-keyint_min", str(FPS * SEGMENT_SECONDS), "-sc_threshold", "0",
+            "-f", "dash", "-seg_duration", str(SEGMENT_SECONDS), "-use_template", "1", "-use_timeline", "0",
+            "-init_seg_name", "init-$RepresentationID$.m4s",
+            "-media_seg_name", "chunk-$RepresentationID$-$Number%05d$.m4s",
+            os.path.join(dash_directory, "manifest.mpd")
+        ], check=True)
+
+        # Same layout as a rendition kept by the downloader: its segments and the joined file
+        segment_directory = os.path.join(cls.directory, "segments", "video")
+        os.makedirs(segment_directory)
+        segment_files = ["init-0.m4s"] + sorted(name for name in os.listdir(dash_directory) if name.startswith("chunk-0-"))
+        for index, name in enumerate(segment_files):
+            shutil.copy(os.path.join(dash_directory, name), os.path.join(segment_directory, f"{index:06d}.m4s"))
+        cls.video_file = os.path.join(cls.directory, "video.mp4")
+        init_file, media_files = dash_downloader.get_segment_files(cls.directory, "video")
+        dash_downloader.merge_segments([init_file] + media_files, cls.video_file)
+
+        with mock.patch.object(qp_extraction, "SEGMENTS_PER_CHUNK", SEGMENTS_PER_CHUNK):
+            cls.chunks = qp_extraction.get_chunks(cls.video_file)
+        cls.whole = extract_info.extract_from_single_file(cls.video_file, MODE, quiet=True)
+        cls.merged = extract_info.merge_input_reports([
+            qp_extraction.extract_chunk(init_file, media_files, MODE)[0] for init_file, media_files in cls.chunks
+        ])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def test_chunks(self):
+        self.assertEqual([len(media_files) for _, media_files in self.chunks], [4, 4, 2])
+
+    def test_frames_match(self):
+        whole_frames = self.whole["I13"]["segments"][0]["frames"]
+        merged_frames = self.merged["I13"]["segments"][0]["frames"]
+        self.assertEqual(len(merged_frames), SEGMENTS * SEGMENT_SECONDS * FPS)
+        self.assertEqual(len(merged_frames), len(whole_frames))
+        strip = lambda frame: {name: value for name, value in frame.items() if name not in TIMESTAMP_FIELDS}
+        for index, (merged_frame, whole_frame) in enumerate(zip(merged_frames, whole_frames)):
+            self.assertEqual(strip(merged_frame), strip(whole_frame), f"frame {index}")
+
+    def test_keyframes_at_chunk_starts(self):
+        frames = self.merged["I13"]["segments"][0]["frames"]
+        chunk_frames = SEGMENTS_PER_CHUNK * SEGMENT_SECONDS * FPS
+        keyframes = [index for index, frame in enumerate(frames) if frame["frameType"] == "I"]
+        self.assertEqual(keyframes, list(range(0, len(frames), SEGMENT_SECONDS * FPS)))
+        for start in range(0, len(frames), chunk_frames):
+            self.assertEqual(frames[start]["frameType"], "I", f"chunk starting at frame {start}")
+
+    def test_timestamps(self):
+        whole_segment = self.whole["I13"]["segments"][0]
+        merged_segment = self.merged["I13"]["segments"][0]
+        self.assertAlmostEqual(merged_segment["duration"], whole_segment["duration"], delta=1 / FPS)
+        self.assertAlmostEqual(merged_segment["duration"], SEGMENTS * SEGMENT_SECONDS, delta=1 / FPS)
+        for field in TIMESTAMP_FIELDS:
+            if field not in whole_segment["frames"][0]:
+                continue
+            merged_times = [frame[field] for frame in merged_segment["frames"]]
+            self.assertEqual(merged_times, [frame[field] for frame in whole_segment["frames"]], field)
+
+
+if __name__ == "__main__":
+    unittest.main()
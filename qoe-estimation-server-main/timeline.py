@@ -0,0 +1,204 @@
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+import event_store
+
+
+# Reconstruction of the playback timeline (stalls and quality segments) from the
+# events recorded by the player: playback_started, quality_change, stall_ini,
+# stall_end and playback_ended.
+#
+# get_stalls and get_quality_segments walk the event list. get_timeline computes the
+# same result with array operations on the columns of event_store, which is much
+# faster for long sessions, and SessionTimeline builds it while the events arrive.
+
+QUALITY_EVENTS = ("playback_started", "quality_change", "playback_ended")
+
+
+def get_stalls(metrics):
+    # [[media time, duration in seconds], ...] of every stall
+    stalls = [[0,0]]    # Adds an initial stall of 0s to avoid timestamp shift during MOS extraction.
+    stall_found = False
+    start_timestamp = 0
+    media_timestamp = 0
+    for metric_st in metrics:
+        if metric_st["type"] == "stall_ini":
+            media_timestamp = metric_st["media_time"]
+            start_timestamp = metric_st["clock_time"]
+            stall_found = True
+        elif stall_found and metric_st["type"] == "stall_end":
+            stall_found = False
+            end_timestamp = metric_st["clock_time"]
+            duration = (end_timestamp - start_timestamp) / 1000
+            if not media_timestamp == 0 and not start_timestamp == 0:
+                stalls.append([media_timestamp, duration])
+    return stalls
+
+def get_quality_segments(metrics):
+    # [[representation id, start, end], ...] of every quality segment
+    quality_changes = []
+    for metric_qp in metrics:
+        if metric_qp["type"] == "playback_started":
+            quality_changes.append([metric_qp["current_rep_id"], metric_qp["media_time"]])
+        elif metric_qp["type"] == "quality_change":
+            quality_changes.append([metric_qp["current_rep_id"], metric_qp["media_time"]])
+        elif metric_qp["type"] == "playback_ended":
+            quality_changes.append(["end", metric_qp["media_time"]])
+
+    quality_segments = []
+    for q_index, q_change in enumerate(quality_changes):
+        if q_index + 1 < len(quality_changes):
+            seg_ini = quality_changes[q_index][1]
+            seg_end = quality_changes[q_index + 1][1]
+            curr_rep_id = q_change[0]
+            quality_segments.append([curr_rep_id, seg_ini, seg_end])
+    return quality_segments
+
+def get_type_mask(columns, types, names):
+    # Events whose type is one of names
+    codes = [index for index, value in enumerate(types) if value in names]
+    return np.isin(columns["type"], codes)
+
+def get_times(columns, field, indexes):
+    # Values of a time column as Python numbers, integers where the player sent integers
+    _, int_flag = event_store.TIME_FLAGS[field]
+    values = columns[field][indexes].tolist()
+    for position in np.flatnonzero(columns["flags"][indexes] & int_flag).tolist():
+        values[position] = int(values[position])
+    return values
+
+def get_timeline(columns):
+    """
+    Stalls and quality segments of a session, same result as get_stalls and get_quality_segments
+
+    Arguments:
+        columns {dict} -- event columns, as returned by event_store.load_columns or event_store.to_columns
+
+    Returns:
+        tuple -- (stalls, quality_segments)
+    """
+    types = [json.loads(value) for value in columns["types"].tolist()]
+
+    # Stalls: a stall_end closes a stall only when the previous stall event is a stall_ini
+    stall_indexes = np.flatnonzero(get_type_mask(columns, types, ("stall_ini", "stall_end")))
+    is_ini = columns["type"][stall_indexes] == (types.index("stall_ini") if "stall_ini" in types else -1)
+    closing = np.flatnonzero(~is_ini[1:] & is_ini[:-1])
+    ini_indexes = stall_indexes[closing]
+    end_indexes = stall_indexes[closing + 1]
+    # Stalls that start at media time 0 or clock time 0 are not counted
+    valid = (columns["media_time"][ini_indexes] != 0) & (columns["clock_time"][ini_indexes] != 0)
+    ini_indexes = ini_indexes[valid]
+    end_indexes = end_indexes[valid]
+    durations = ((columns["clock_time"][end_indexes] - columns["clock_time"][ini_indexes]) / 1000).tolist()
+    stalls = [[0,0]] + list(map(list, zip(get_times(columns, "media_time", ini_indexes), durations)))
+
+    # Quality segments: from each quality change to the next one
+    change_indexes = np.flatnonzero(get_type_mask(columns, types, QUALITY_EVENTS))
+    # Index -1 (event without representation id) picks the None at the end
+    rep_ids = np.array([json.loads(value) for value in columns["rep_ids"].tolist()] + [None], dtype=object)
+    change_reps = rep_ids[columns["current_rep_id"][change_indexes]]
+    ended = columns["type"][change_indexes] == (types.index("playback_ended") if "playback_ended" in types else -1)
+    change_reps[ended] = "end"
+    change_reps = change_reps.tolist()
+    change_times = get_times(columns, "media_time", change_indexes)
+    quality_segments = list(map(list, zip(change_reps[:-1], change_times[:-1], change_times[1:])))
+
+    return stalls, quality_segments
+
+
+class SessionTimeline:
+    # Same stalls and quality segments as get_stalls and get_quality_segments, built
+    # incrementally while the events of a session arrive in chunks
+
+    def __init__(self):
+        self.stalls = [[0,0]]
+        self.quality_segments = []
+        self.stall_found = False
+        self.stall_start_timestamp = 0
+        self.stall_media_timestamp = 0
+        self.last_quality_change = None
+        self.ended = False
+
+    def add_events(self, events):
+        # Returns the quality segments closed by these events
+        closed_segments = []
+        for event in events:
+            if event["type"] == "stall_ini":
+                self.stall_media_timestamp = event["media_time"]
+                self.stall_start_timestamp = event["clock_time"]
+                self.stall_found = True
+            elif self.stall_found and event["type"] == "stall_end":
+                self.stall_found = False
+                duration = (event["clock_time"] - self.stall_start_timestamp) / 1000
+                if not self.stall_media_timestamp == 0 and not self.stall_start_timestamp == 0:
+                    self.stalls.append([self.stall_media_timestamp, duration])
+            elif event["type"] in ("playback_started", "quality_change", "playback_ended"):
+                if event["type"] == "playback_ended":
+                    quality_change = ["end", event["media_time"]]
+                    self.ended = True
+                else:
+                    quality_change = [event["current_rep_id"], event["media_time"]]
+                if self.last_quality_change is not None:
+                    segment = [self.last_quality_change[0], self.last_quality_change[1], quality_change[1]]
+                    self.quality_segments.append(segment)
+                    closed_segments.append(segment)
+                self.last_quality_change = quality_change
+        return closed_segments
+
+
+def generate_session(event_count, seed=0):
+    # Synthetic session with stalls and quality changes, for the benchmark
+    generator = random.Random(seed)
+    media_time = 0.0
+    clock_time = 1700000000000
+    events = [{"type": "playback_started", "media_time": 0, "clock_time": clock_time, "current_rep_id": "video/avc1/1"}]
+    while len(events) < event_count - 1:
+        media_time += generator.uniform(0.1, 2)
+        clock_time += generator.randint(100, 2000)
+        event_type = generator.choice(("quality_change", "stall_ini", "stall_end", "stall_end", "stall_ini"))
+        event = {"type": event_type, "media_time": round(media_time, 3), "clock_time": clock_time}
+        if event_type == "quality_change":
+            event["current_rep_id"] = f"video/avc1/{generator.randint(1, 3)}"
+        events.append(event)
+    events.append({"type": "playback_ended", "media_time": round(media_time, 3), "clock_time": clock_time})
+    return events
+
+def benchmark(event_counts, repeat):
+    # Timeline of a session already in memory, and of a session read from its columns
+    # (the list of events has to be rebuilt for the loops)
+    def measure(function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    def loop_timeline(events):
+        return get_stalls(events), get_quality_segments(events)
+
+    for event_count in event_counts:
+        events = generate_session(event_count)
+        columns = event_store.to_columns(events)
+        if get_timeline(columns) != loop_timeline(events):
+            raise AssertionError(f"Results differ for {event_count} events")
+
+        loops = measure(lambda: loop_timeline(events))
+        loops_from_columns = measure(lambda: loop_timeline(event_store.from_columns(columns)))
+        arrays = measure(lambda: get_timeline(columns))
+        print(f"{event_count:>9} events: loops {loops:9.3f} ms, loops from columns {loops_from_columns:9.3f} ms, "
+              f"arrays {arrays:9.3f} ms ({loops / arrays:5.1f}x, {loops_from_columns / arrays:5.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the timeline reconstruction")
+    parser.add_argument("--events", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="events per session")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per session size")
+    argsdict = vars(parser.parse_args())
+    benchmark(argsdict["events"], argsdict["repeat"])
+
+
+if __name__ == "__main__":
+    main()
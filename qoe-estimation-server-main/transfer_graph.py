@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import swarm_logs
+
+
+# On-disk index of the segment transfers of swarm deployments, as a time-varying graph
+# between peers, to answer questions such as "which peers did SERVITEL05 pull from between
+# t1 and t2" or "who served the most of these segments" without reading the logs again:
+#
+#   python transfer_graph.py build graph ../resultados_despliegue/1_test ../resultados_despliegue/3_test
+#   python transfer_graph.py sources graph SERVITEL05 --run 3_test --start 2025-06-19T13:20:00 --end 2025-06-19T13:25:00
+#   python transfer_graph.py top graph "video/avc1/1/seg-1[0-9].m4s" --per-segment
+#
+# A store is a folder with meta.json (runs, interned peer ids with their node names, segment
+# URLs) and NumPy arrays opened as memory maps:
+#   time, to, from, url, bytes  -- one entry per transfer, sorted by time. to is the peer that
+#                                  downloaded, from the peer that served it (-1 for HTTP)
+#   in_order, in_rows, in_indptr
+#                               -- CSR adjacency per time bucket: rows are the (peer, bucket) pairs
+#                                  with transfers, key peer * bucket_count + bucket, and the ones
+#                                  downloaded by a peer in row r are in_order[in_indptr[r]:in_indptr[r+1]].
+#                                  Rows of a peer are contiguous, so a time range is a single slice
+#   out_order, out_rows, out_indptr
+#                               -- same for the P2P transfers served by each peer
+#   url_order, url_indptr       -- the transfers of each segment URL
+
+HTTP = -1
+BUCKET_SECONDS = 60
+
+ARRAYS = (
+    "time", "to", "from", "url", "bytes",
+    "in_order", "in_rows", "in_indptr", "out_order", "out_rows", "out_indptr", "url_order", "url_indptr"
+)
+
+
+def read_peer(peer_id, paths):
+    # Transfers of a peer with local url and peer tables. Runs in a worker process.
+    columns, urls, peers = swarm_logs.read_columns(paths)
+    return peer_id, columns, urls, peers
+
+def get_csr(keys):
+    """
+    Sparse CSR index of the entries by key
+
+    Arguments:
+        keys {numpy array} -- row key of every entry, entries with the same key keep their order
+
+    Returns:
+        tuple -- (entries sorted by key, keys of the rows, start of every row in that order plus the end)
+    """
+    order = np.argsort(keys, kind="stable").astype(np.int64)
+    rows, counts = np.unique(keys, return_counts=True)
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return order, rows.astype(np.int64), indptr
+
+def build(store_directory, run_directories, bucket_seconds=BUCKET_SECONDS, processes=None):
+    """
+    Index the peer logs of some runs
+
+    Arguments:
+        store_directory {str} -- folder of the store, replaced if it exists
+        run_directories {list} -- run folders (resultados_despliegue/<run>)
+        bucket_seconds {float} -- time bucket of the adjacency index
+        processes {int} -- worker processes reading logs (default: one per CPU core)
+    """
+    runs = []
+    peers = {}          # {peer id: index}
+    peer_info = []      # [{"id", "run", "node"}]
+    urls = {}
+    chunks = {name: [] for name in ("time", "to", "from", "url", "bytes")}
+
+    def intern_peer(peer_id, run, node=None):
+        index = peers.get(peer_id)
+        if index is None:
+            index = peers[peer_id] = len(peer_info)
+            peer_info.append({"id": peer_id, "run": run, "node": node})
+        elif node is not None and peer_info[index]["node"] is None:
+            peer_info[index]["node"] = node
+        return index
+
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        for run_directory in run_directories:
+            run = os.path.basename(os.path.normpath(run_directory))
+            logs, nodes = swarm_logs.find_peer_logs(run_directory)
+            nodes = {**swarm_logs.read_node_map(run_directory), **nodes}
+            runs.append(run)
+            for peer_id, node in sorted(nodes.items()):
+                intern_peer(peer_id, run, node)
+
+            futures = [pool.submit(read_peer, peer_id, paths) for peer_id, paths in sorted(logs.items())]
+            for future in futures:
+                peer_id, columns, local_urls, local_peers = future.result()
+                # Local tables of the log -> store tables
+                url_map = np.array([urls.setdefault(url, len(urls)) for url in local_urls], dtype=np.int32)
+                peer_map = np.array([intern_peer(local, run) if local else HTTP for local in local_peers], dtype=np.int32)
+                from_peers = peer_map[columns["from_peer"]] if len(peer_map) else np.zeros(0, dtype=np.int32)
+                from_peers[columns["source"] != swarm_logs.SOURCES.index("peer")] = HTTP
+                chunks["time"].append(columns["timestamp"])
+                chunks["to"].append(np.full(len(columns["timestamp"]), intern_peer(peer_id, run), dtype=np.int32))
+                chunks["from"].append(from_peers.astype(np.int32))
+                chunks["url"].append(url_map[columns["url"]] if len(url_map) else np.zeros(0, dtype=np.int32))
+                chunks["bytes"].append(columns["bytes"])
+
+    edges = {name: np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64) for name, arrays in chunks.items()}
+    order = np.argsort(edges["time"], kind="stable")
+    edges = {name: values[order] for name, values in edges.items()}
+
+    peer_count = len(peer_info)
+    bucket_ms = int(round(bucket_seconds * 1000))
+    first_bucket = int(edges["time"][0] // bucket_ms) if len(order) else 0
+    buckets = (edges["time"] // bucket_ms - first_bucket).astype(np.int64)
+    bucket_count = int(buckets[-1]) + 1 if len(order) else 0
+
+    arrays = dict(edges)
+    arrays["in_order"], arrays["in_rows"], arrays["in_indptr"] = get_csr(edges["to"] * bucket_count + buckets)
+    served = np.flatnonzero(edges["from"] != HTTP)
+    out_order, arrays["out_rows"], arrays["out_indptr"] = get_csr(edges["from"][served] * bucket_count + buckets[served])
+    arrays["out_order"] = served[out_order]
+    arrays["url_order"], _, arrays["url_indptr"] = get_csr(edges["url"])
+
+    os.makedirs(store_directory, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(store_directory, f"{name}.npy"), arrays[name])
+    with open(os.path.join(store_directory, "meta.json"), "w") as meta_file:
+        meta_file.write(json.dumps({
+            "runs": runs,
+            "bucket_ms": bucket_ms,
+            "first_bucket": first_bucket,
+            "bucket_count": bucket_count,
+            "peers": peer_info,
+            "urls": list(urls)
+        }))
+    print(f"Indexed {len(order)} transfers of {peer_count} peers and {len(urls)} URLs from {len(runs)} runs")
+
+
+class TransferGraph:
+    def __init__(self, store_directory):
+        with open(os.path.join(store_directory, "meta.json"), "r") as meta_file:
+            meta = json.loads(meta_file.read())
+        self.runs = meta["runs"]
+        self.bucket_ms = meta["bucket_ms"]
+        self.first_bucket = meta["first_bucket"]
+        self.bucket_count = meta["bucket_count"]
+        self.peers = meta["peers"]
+        self.urls = meta["urls"]
+        self.arrays = {name: np.load(os.path.join(store_directory, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+
+    def find_peers(self, name, run=None):
+        # Indexes of the peers with this node name or peer id, optionally only of one run
+        return [
+            index for index, peer in enumerate(self.peers)
+            if name in (peer["node"], peer["id"]) and (run is None or peer["run"] == run)
+        ]
+
+    def label(self, index):
+        if index == HTTP:
+            return "http"
+        peer = self.peers[index]
+        return f"{peer['node'] or peer['id']} ({peer['run']})"
+
+    def get_bucket_range(self, start, end):
+        first = 0 if start is None else max(0, start // self.bucket_ms - self.first_bucket)
+        last = self.bucket_count - 1 if end is None else min(self.bucket_count - 1, end // self.bucket_ms - self.first_bucket)
+        return int(first), int(last)
+
+    def get_adjacent(self, direction, peers, start=None, end=None):
+        # Transfers downloaded (direction "in") or served ("out") by some peers in [start, end)
+        order = self.arrays[f"{direction}_order"]
+        rows = self.arrays[f"{direction}_rows"]
+        indptr = self.arrays[f"{direction}_indptr"]
+        first, last = self.get_bucket_range(start, end)
+        slices = []
+        for peer in peers:
+            low = np.searchsorted(rows, peer * self.bucket_count + first, side="left")
+            high = np.searchsorted(rows, peer * self.bucket_count + last, side="right")
+            slices.append(order[indptr[low]:indptr[high]])
+        transfers = np.concatenate(slices) if slices else np.zeros(0, dtype=np.int64)
+        return self.filter_time(transfers, start, end)
+
+    def filter_time(self, transfers, start, end):
+        times = self.arrays["time"][transfers]
+        keep = np.ones(len(transfers), dtype=bool)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times < end
+        return transfers[keep]
+
+    def aggregate(self, transfers, column, limit=None):
+        """
+        Transfers grouped by the peer in one of their columns
+
+        Returns:
+            list -- (label, bytes, transfers) by decreasing bytes
+        """
+        # HTTP (-1) is counted in an extra last slot
+        peers = np.asarray(self.arrays[column][transfers], dtype=np.int64)
+        slots = np.where(peers == HTTP, len(self.peers), peers)
+        sizes = np.bincount(slots, weights=self.arrays["bytes"][transfers], minlength=len(self.peers) + 1)
+        counts = np.bincount(slots, minlength=len(self.peers) + 1)
+        ranked = [slot for slot in np.argsort(-sizes, kind="stable") if counts[slot]][:limit]
+        return [
+            (self.label(HTTP if slot == len(self.peers) else int(slot)), int(sizes[slot]), int(counts[slot]))
+            for slot in ranked
+        ]
+
+    def sources(self, peers, start=None, end=None):
+        # Who the peers downloaded from
+        return self.aggregate(self.get_adjacent("in", peers, start, end), "from")
+
+    def served(self, peers, start=None, end=None):
+        # Who downloaded from the peers
+        return self.aggregate(self.get_adjacent("out", peers, start, end), "to")
+
+    def find_urls(self, pattern):
+        # Indexes of the segment URLs matching a regular expression
+        expression = re.compile(pattern)
+        return [index for index, url in enumerate(self.urls) if expression.search(url)]
+
+    def get_url_transfers(self, url_index, run=None):
+        order = self.arrays["url_order"]
+        indptr = self.arrays["url_indptr"]
+        transfers = np.asarray(order[indptr[url_index]:indptr[url_index + 1]])
+        if run is not None:
+            runs = np.array([peer["run"] == run for peer in self.peers])
+            transfers = transfers[runs[self.arrays["to"][transfers]]]
+        return transfers
+
+    def top_contributors(self, url_indexes, limit=10, run=None):
+        # Peers (and HTTP) that served the most bytes of some segments
+        slices = [self.get_url_transfers(url_index, run) for url_index in url_indexes]
+        transfers = np.concatenate(slices) if slices else np.zeros(0, dtype=np.int64)
+        return self.aggregate(transfers, "from", limit)
+
+
+# CLI
+
+def parse_time(value):
+    # ISO 8601 UTC time -> milliseconds since the epoch
+    if value is None:
+        return None
+    return int(np.datetime64(value.rstrip("Z"), "ms").astype(np.int64))
+
+def print_rows(rows, elapsed):
+    for label, size, count in rows:
+        print(f"{label:<48} {size:>14} bytes {count:>8} transfers")
+    print(f"{len(rows)} rows in {elapsed * 1000:.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Index of the segment transfers between peers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="index the logs of some runs")
+    build_parser.add_argument("store", type=str, help="store folder")
+    build_parser.add_argument("runs", type=str, nargs="+", help="run folders (resultados_despliegue/<run>)")
+    build_parser.add_argument("--bucket-seconds", type=float, default=BUCKET_SECONDS, help="time bucket of the index")
+    build_parser.add_argument("--processes", type=int, help="worker processes (default: one per CPU core)")
+
+    for command, help in (("sources", "peers a node downloaded from"), ("served", "peers that downloaded from a node")):
+        peer_parser = subparsers.add_parser(command, help=help)
+        peer_parser.add_argument("store", type=str, help="store folder")
+        peer_parser.add_argument("peer", type=str, help="node name (e.g. SERVITEL05) or peer id")
+        peer_parser.add_argument("--run", type=str, help="only the peer of this run")
+        peer_parser.add_argument("--start", type=str, help="from this UTC time (e.g. 2025-06-19T08:10:00)")
+        peer_parser.add_argument("--end", type=str, help="until this UTC time")
+
+    top_parser = subparsers.add_parser("top", help="top contributors of the segments matching a regular expression")
+    top_parser.add_argument("store", type=str, help="store folder")
+    top_parser.add_argument("pattern", type=str, help="regular expression of the segment URLs")
+    top_parser.add_argument("--run", type=str, help="only transfers of this run")
+    top_parser.add_argument("-k", "--limit", type=int, default=10, help="contributors listed")
+    top_parser.add_argument("--per-segment", action="store_true", help="list the contributors of every segment")
+    argsdict = vars(parser.parse_args())
+
+    if argsdict["command"] == "build":
+        build(argsdict["store"], argsdict["runs"], argsdict["bucket_seconds"], argsdict["processes"])
+        return
+
+    graph = TransferGraph(argsdict["store"])
+    start_time = time.perf_counter()
+    if argsdict["command"] in ("sources", "served"):
+        peers = graph.find_peers(argsdict["peer"], argsdict["run"])
+        if not peers:
+            parser.error(f"Unknown peer {argsdict['peer']}")
+        query = graph.sources if argsdict["command"] == "sources" else graph.served
+        rows = query(peers, parse_time(argsdict["start"]), parse_time(argsdict["end"]))
+        print_rows(rows, time.perf_counter() - start_time)
+    elif argsdict["per_segment"]:
+        for url_index in graph.find_urls(argsdict["pattern"]):
+            print(graph.urls[url_index])
+            for label, size, count in graph.top_contributors([url_index], argsdict["limit"], argsdict["run"]):
+                print(f"    {label:<44} {size:>14} bytes {count:>8} transfers")
+        print(f"Done in {(time.perf_counter() - start_time) * 1000:.2f} ms")
+    else:
+        rows = graph.top_contributors(graph.find_urls(argsdict["pattern"]), argsdict["limit"], argsdict["run"])
+        print_rows(rows, time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    main()
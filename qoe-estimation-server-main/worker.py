@@ -0,0 +1,112 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The worker only makes sense with the shared job queue, set it before app reads it
+os.environ.setdefault("QOE_JOB_QUEUE", "sqlite")
+
+import app
+import instrumentation
+import job_queue
+
+
+# Worker process of the job queue: runs the download, extraction, input and MOS jobs
+# added by the API process (app.py with QOE_JOB_QUEUE=sqlite). Start as many as needed,
+# on this machine or on others that share the video_db folder:
+#
+#   python worker.py                          -- every stage
+#   python worker.py --stages mos --mos 8     -- a MOS-only worker
+#
+# Each stage has its own threads, so a long MOS job never blocks downloads.
+
+STAGES = ("download", "extract", "input", "mos")
+
+RETENTION_SECONDS = float(os.environ.get("QOE_JOB_RETENTION_SECONDS", 24 * 3600))
+
+
+def run_stage(stage, owner, poll_interval, stop):
+    # Claims and runs the jobs of a stage until stop is set
+    while not stop.is_set():
+        try:
+            job = job_queue.claim([stage], owner)
+        except Exception as e:
+            print(f"Error claiming a {stage} job: {e}", file=sys.stderr)
+            job = None
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+
+        start = time.time()
+        print(f"Running job {job['key']} (attempt {job['attempts']})")
+        succeeded = job_queue.run(job, app.JOB_FUNCTIONS)
+        app.jobs_total.inc(stage=stage, state="done" if succeeded else "failed")
+        app.job_wait_seconds.observe(start - job["created"], stage=stage)
+        app.job_run_seconds.observe(time.time() - start, stage=stage)
+
+def heartbeat(owner, stop):
+    # Renews the leases of the running jobs and deletes old finished jobs
+    last_purge = 0
+    while not stop.wait(job_queue.LEASE_SECONDS / 3):
+        try:
+            job_queue.renew(owner)
+            if time.time() - last_purge > 3600:
+                last_purge = time.time()
+                purged = job_queue.purge(RETENTION_SECONDS)
+                if purged:
+                    print(f"Deleted {purged} finished jobs")
+        except Exception as e:
+            print(f"Error renewing the leases of {owner}: {e}", file=sys.stderr)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Prometheus endpoint of the worker, its jobs are not seen by the API process
+    def do_GET(self):
+        body = instrumentation.registry.export().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Job queue worker")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="stages this worker runs")
+    for stage, threads in app.scheduler.stats().items():
+        parser.add_argument(f"--{stage}", type=int, default=threads["workers"], help=f"threads of the {stage} stage")
+    parser.add_argument("--poll-interval", type=float, default=app.QUEUE_POLL_SECONDS, help="seconds between claims when idle")
+    parser.add_argument("--metrics-port", type=int, help="serve the metrics of this worker on this port")
+    argsdict = vars(parser.parse_args())
+
+    owner = job_queue.get_owner()
+    stop = threading.Event()
+    threads = [threading.Thread(target=heartbeat, args=(owner, stop), daemon=True)]
+    for stage in argsdict["stages"]:
+        threads += [
+            threading.Thread(target=run_stage, args=(stage, owner, argsdict["poll_interval"], stop), daemon=True)
+            for _ in range(argsdict[stage])
+        ]
+    for thread in threads:
+        thread.start()
+
+    if argsdict["metrics_port"] is not None:
+        server = ThreadingHTTPServer(("0.0.0.0", argsdict["metrics_port"]), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"Worker {owner} running {', '.join(f'{stage} x{argsdict[stage]}' for stage in argsdict['stages'])}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # Running jobs are abandoned, their leases expire and other workers take them
+        print("Stopping worker")
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()